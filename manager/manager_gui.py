@@ -22,12 +22,26 @@ class ServerSocketError(Exception):
         return repr(self.msg)
 
 class ServerSocket:
-    def __init__(self, name, password, port):
+    # The 'm1' manager is lazy. The server asks it for the queries
+    # every tick. The 'm2' manager (push mode) keeps the connection.
+    # It sends the queries at any time and the server pushes the
+    # changed clients and games with the sequence number.
+    def __init__(self, name, password, port, push=True):
         self._sock_file = None
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.sock.connect((socket.gethostname(), port))
         self.name = name
         self.password = password
+        self.push = push
+        self.send_lock = threading.Lock()
+
+        # The status pushed by server. It is valid after receiving
+        # the full status.
+        self.status_lock = threading.Lock()
+        self.status_seq = None
+        self.clients = dict()
+        self.games = dict()
+        self.synced = threading.Event()
         self.running = True
         self.loop = threading.Thread(
                         target=self.receive_loop,
@@ -37,6 +51,8 @@ class ServerSocket:
         self.loop.start()
         self.query_queue = queue.Queue()
         self.client_status_queue = queue.Queue()
+        self.api_response_queue = queue.Queue()
+        self.next_api_id = 0
 
     def handle_command(self, cmd, block=False):
         cmd_list = cmd.split()
@@ -45,13 +61,32 @@ class ServerSocket:
             print("There is no inputs.")
             return
         if cmd_list[0] == "client_status":
-            self.query_queue.put(("client_status", query))
+            self.put_query("client_status", query)
         elif cmd_list[0] == "command":
             val = str()
             cmd_list.pop(0)
             for v in cmd_list:
                 val += "{} ".format(v)
-            self.query_queue.put(("command", val.strip()))
+            self.put_query("command", val.strip())
+
+    def put_query(self, key, query):
+        if not self.push:
+            # Wait for the server asking.
+            self.query_queue.put((key, query))
+            return
+        # Do not send anything before the full status. The
+        # server is still reading the handshake.
+        self.synced.wait()
+        self.send_line(json.dumps({ key : query }, indent=None, separators=(',', ':')))
+
+    def send_line(self, msg):
+        # The receive loop thread reads the socket file. Send
+        # with the socket directly.
+        with self.send_lock:
+            try:
+                self.sock.sendall("{}\n".format(msg).encode("utf-8"))
+            except:
+                raise ServerSocketError(self, "Can not send massage to server.")
 
     def abort(self):
         self.running = False
@@ -74,6 +109,12 @@ class ServerSocket:
                     self.handle_password()
                 elif msg_list[0] == "client_status":
                     self.handle_client_status(msg)
+                elif msg_list[0] == "api_response":
+                    self.handle_api_response(msg)
+                elif msg_list[0] == "status_full":
+                    self.handle_status_full(msg)
+                elif msg_list[0] == "status_delta":
+                    self.handle_status_delta(msg)
                 elif msg_list[0] == "queries":
                     self.handle_queries()
             self.close()
@@ -82,7 +123,7 @@ class ServerSocket:
 
 
     def handle_protocol(self):
-        self.send("m1")
+        self.send("m2" if self.push else "m1")
 
     def handle_username(self):
         self.send(self.name)
@@ -94,12 +135,47 @@ class ServerSocket:
         msg = msg[len("client_status"):]
         self.client_status_queue.put(json.loads(msg))
 
+    def handle_status_full(self, msg):
+        status = json.loads(msg[len("status_full"):])
+        with self.status_lock:
+            self.status_seq = status["seq"]
+            self.clients = status["clients"]
+            self.games = status["games"]
+        self.synced.set()
+
+    def handle_status_delta(self, msg):
+        delta = json.loads(msg[len("status_delta"):])
+        with self.status_lock:
+            if self.status_seq is None:
+                # Waiting for the full status.
+                return
+            if delta["seq"] != self.status_seq + 1:
+                # Miss some deltas. Ask for the full status again.
+                self.status_seq = None
+                self.send_line(json.dumps({ "resync" : True }))
+                return
+            self.status_seq = delta["seq"]
+            for records, changed in [(self.clients, delta["clients"]), (self.games, delta["games"])]:
+                for k, v in changed.items():
+                    if v is None:
+                        records.pop(k, None)
+                    else:
+                        records[k] = v
+
+    def handle_api_response(self, msg):
+        msg = msg[len("api_response"):]
+        self.api_response_queue.put(json.loads(msg))
+
     def handle_queries(self):
         queries = dict()
 
         while not self.query_queue.empty():
             key, query = self.query_queue.get(block=True, timeout=0)
-            queries[key] = query
+            if key == "api":
+                # Merge all API requests into one batch.
+                queries.setdefault(key, list()).extend(query)
+            else:
+                queries[key] = query
 
         if len(queries) == 0:
             self.send("")
@@ -109,6 +185,17 @@ class ServerSocket:
     def send_command(self, cmd):
         self.handle_command("command {}".format(cmd))
 
+    def send_profile(self, action, pid=None, mode=None):
+        # Start or stop the profiler of master or worker.
+        profile = "profile {}".format(action)
+        if pid is not None:
+            profile += " {}".format(pid)
+            if mode is not None:
+                profile += " {}".format(mode)
+        elif mode is not None:
+            profile += " master {}".format(mode)
+        self.handle_command("command {}".format(profile))
+
     def send_match(self,
                    black_fid,
                    white_fid,
@@ -132,7 +219,26 @@ class ServerSocket:
             match += " store {}".format(store_path)
         self.handle_command("command {}".format(match))
 
+    def send_api(self, requests):
+        # Send a batch of API requests. Each request is (op, args).
+        # Return the request ids. See the 'server/api.py'.
+        batch = list()
+        for op, args in requests:
+            batch.append({ "id" : self.next_api_id, "op" : op, "args" : args })
+            self.next_api_id += 1
+        self.put_query("api", batch)
+        return [ req["id"] for req in batch ]
+
+    def get_api_response(self, timeout=9999):
+        # Return the responses of one batch.
+        return self.api_response_queue.get(block=True, timeout=timeout)
+
     def get_client_status(self):
+        if self.push:
+            # The status is pushed by server. No need to ask.
+            self.synced.wait()
+            with self.status_lock:
+                return { k : dict(v) for k, v in self.clients.items() }
         self.handle_command("client_status")
         out = self.client_status_queue.get(block=True, timeout=9999)
         return out
@@ -0,0 +1,113 @@
+import socket
+
+# The admission control of new connections. The master accepts the
+# connections without waiting for them. Each address has a token bucket
+# of connection rate. The accepted socket finishes the handshake in the
+# 'Handshake' state machine across ticks. So a slow or flooding client
+# never stalls the master loop.
+
+# The handshake line longer than it is invalid.
+MAX_LINE_BYTES = 4096
+
+class RateLimiter:
+    def __init__(self, rate, burst):
+        self.rate = rate # The tokens per second.
+        self.burst = burst # The bucket size.
+        self.buckets = dict() # address -> [tokens, last time]
+
+    def allow(self, addr, now):
+        # Take one token. Return False if the bucket is empty.
+        if self.rate is None:
+            return True
+        bucket = self.buckets.get(addr, None)
+        if bucket is None:
+            bucket = [self.burst, now]
+            self.buckets[addr] = bucket
+        tokens, last = bucket
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            return False
+        bucket[0] = tokens - 1
+        return True
+
+    def prune(self, now):
+        # Remove the full buckets. They are the same as the new ones.
+        if self.rate is None:
+            return
+        for addr in [ k for k, (tokens, last) in self.buckets.items()
+                          if tokens + (now - last) * self.rate >= self.burst ]:
+            self.buckets.pop(addr)
+
+class HandshakeError(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return repr(self.msg)
+
+class Handshake:
+    # Ask the protocol, username and password one by one without
+    # blocking. The replies are kept in 'lines'.
+    REQUESTS = ["protocol genmove_analyze", "username", "password"]
+
+    def __init__(self, sock, addr, deadline):
+        self.sock = sock
+        self.addr = addr
+        self.fid = sock.fileno()
+        self.deadline = deadline
+        self.lines = list()
+        self._in_buf = bytes()
+        self.sock.setblocking(False)
+        self._send_request()
+
+    def done(self):
+        return len(self.lines) == len(self.REQUESTS)
+
+    def on_readable(self):
+        # Read the replies. Return True if the handshake is done.
+        try:
+            data = self.sock.recv(MAX_LINE_BYTES)
+        except BlockingIOError:
+            return False
+        except OSError:
+            raise HandshakeError("Can not read massage from client.")
+        if len(data) == 0:
+            raise HandshakeError("The client is closed.")
+        self._in_buf += data
+
+        while not self.done():
+            line, sep, rest = self._in_buf.partition(b"\n")
+            if len(sep) == 0:
+                if len(self._in_buf) > MAX_LINE_BYTES:
+                    raise HandshakeError("The line is too long.")
+                break
+            self._in_buf = rest
+            self.lines.append(line.decode("utf-8", errors="replace").strip())
+            if not self.done():
+                self._send_request()
+
+        if self.done():
+            # The socket is blocking again for the clients.
+            self.sock.setblocking(True)
+            return True
+        return False
+
+    def take_unread(self):
+        # The bytes sent after the handshake.
+        data = self._in_buf
+        self._in_buf = bytes()
+        return data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _send_request(self):
+        try:
+            self.sock.send("{}\n".format(self.REQUESTS[len(self.lines)]).encode("utf-8"))
+        except OSError:
+            raise HandshakeError("Can not send massage to client.")
@@ -0,0 +1,293 @@
+import os
+import time
+
+import config
+
+# The typed control API on the manager channel. The manager sends
+# a batch of requests in the query key "api",
+#
+#     { "api" : [ { "id" : 1, "op" : "submit_match", "args" : {...} }, ... ] }
+#
+# and the master replies one "api_response" line. The responses are
+# in the same order as the requests,
+#
+#     api_response [ { "id" : 1, "status" : "ok", "result" : {...} },
+#                    { "id" : 2, "status" : "error", "error" : "..." } ]
+#
+# The supported operations are here.
+#     submit_match: push the match into the pending queue
+#     cancel_match: remove the match from the pending queue
+#      query_games: the running games
+#    query_workers: the worker processes
+#    query_pending: the pending matches
+#    query_clients: the connected clients
+#    query_results: the recent finished games
+#    submit_series: start the match series between two engines
+#      stop_series: stop submitting the games of series
+#     query_series: the series and their results
+#    query_ratings: the online and batch ratings of engines
+#      query_pools: the instances and results of engine pools
+#
+# The monitor manager can only do the query operations.
+
+class ApiError(Exception):
+    pass
+
+# The optional match fields and their types.
+MATCH_FIELDS = {
+    "main_time"  : int,
+    "board_size" : int,
+    "komi"       : float,
+    "rule"       : str,
+    "sgf"        : str,
+    "opening"    : str,
+    "store"      : str
+}
+
+def is_int(v):
+    # The JSON 'true' and 'false' are ints in Python.
+    return isinstance(v, int) and not isinstance(v, bool)
+
+def parse_player(v):
+    # The player is given by fid (int) or engine name (str).
+    if is_int(v):
+        return { "fid" : v, "name" : None }
+    if isinstance(v, str) and len(v) > 0:
+        return { "fid" : None, "name" : v }
+    raise ApiError("Invalid player {}.".format(v))
+
+def parse_setting(args):
+    setting = dict()
+    for k, t in MATCH_FIELDS.items():
+        if k not in args:
+            continue
+        if isinstance(args[k], bool):
+            raise ApiError("Invalid field {}.".format(k))
+        try:
+            setting[k] = t(args[k])
+        except (TypeError, ValueError):
+            raise ApiError("Invalid field {}.".format(k))
+    store = setting.get("store", None)
+    if store is not None:
+        for v in store.split(os.sep):
+            if v == "." or v == "..":
+                raise ApiError("Invalid store path {}.".format(store))
+    return setting
+
+def parse_schedule(args):
+    # The priority class and the submitter. The submitter is the
+    # manager name if it is not given.
+    priority = args.get("priority", None)
+    submitter = args.get("submitter", None)
+    if priority is not None and not isinstance(priority, str):
+        raise ApiError("Invalid field priority.")
+    if submitter is not None and (not isinstance(submitter, str) or len(submitter) == 0):
+        raise ApiError("Invalid field submitter.")
+    return priority, submitter
+
+def op_submit_match(master, args):
+    setting = parse_setting(args)
+    priority, submitter = parse_schedule(args)
+    black = parse_player(args.get("black", None))
+    white = parse_player(args.get("white", None))
+    try:
+        match_id = master.submit_match(
+                       black, white, setting, priority=priority, submitter=submitter)
+    except ValueError as e:
+        raise ApiError(str(e))
+    return { "match_id" : match_id }
+
+def op_cancel_match(master, args):
+    match_id = args.get("match_id", None)
+    if not is_int(match_id):
+        raise ApiError("Invalid field match_id.")
+    if not master.cancel_match(match_id):
+        raise ApiError("There is no pending match {}.".format(match_id))
+    return { "match_id" : match_id }
+
+def op_submit_series(master, args):
+    # The players 'a' and 'b' alternate the colors. The 'games' is
+    # the maximum number of games. The optional 'sprt' is like
+    # { "elo0" : 0, "elo1" : 5, "alpha" : 0.05, "beta" : 0.05,
+    #   "model" : "pentanomial" }.
+    setting = parse_setting(args)
+    priority, submitter = parse_schedule(args)
+    a = parse_player(args.get("a", None))
+    b = parse_player(args.get("b", None))
+    games = args.get("games", None)
+    concurrency = args.get("concurrency", 1)
+    openings = args.get("openings", None)
+    opening_order = args.get("order", None)
+    if not is_int(games) or not is_int(concurrency):
+        raise ApiError("Invalid field games or concurrency.")
+    if openings is not None and not isinstance(openings, str):
+        raise ApiError("Invalid field openings.")
+    if opening_order is not None and not isinstance(opening_order, str):
+        raise ApiError("Invalid field order.")
+    sprt = args.get("sprt", None)
+    if sprt is not None and (not isinstance(sprt, dict) or \
+                                 "elo0" not in sprt or "elo1" not in sprt):
+        raise ApiError("Invalid field sprt.")
+    try:
+        series_id = master.create_series(
+                        a, b, games, setting, concurrency, openings, sprt, opening_order,
+                        priority, submitter)
+    except (TypeError, ValueError) as e:
+        raise ApiError(str(e))
+    return { "series_id" : series_id }
+
+def op_stop_series(master, args):
+    series_id = args.get("series_id", None)
+    if not is_int(series_id):
+        raise ApiError("Invalid field series_id.")
+    if not master.stop_series(series_id, "stopped by API"):
+        raise ApiError("There is no series {}.".format(series_id))
+    return { "series_id" : series_id }
+
+def op_query_series(master, args):
+    # Return all series if 'series_id' is not given.
+    series_id = args.get("series_id", None)
+    if series_id is not None and not is_int(series_id):
+        raise ApiError("Invalid field series_id.")
+    records = [ s.get_record() for k, s in master.series_pool.items()
+                    if series_id is None or k == series_id ]
+    return { "series" : records }
+
+def op_query_ratings(master, args):
+    # Return the ratings of 'names' or all engines.
+    names = args.get("names", None)
+    if names is not None and not isinstance(names, list):
+        raise ApiError("Invalid field names.")
+    records = [ r for r in master.rating.get_records()
+                    if names is None or r["name"] in names ]
+    return { "ratings" : records, "games" : master.rating.games }
+
+def op_query_pools(master, args):
+    # Return the pools of 'names' or all pools.
+    names = args.get("names", None)
+    if names is not None and not isinstance(names, list):
+        raise ApiError("Invalid field names.")
+    records = [ r for r in master.pools.get_records(master.client_index, master.client_pool)
+                    if names is None or r["name"] in names ]
+    return { "pools" : records }
+
+def op_query_games(master, args):
+    games = list()
+    for gid, task in master.game_tasks.items():
+        games.append({
+            "gid"      : gid,
+            "pid"      : task["pid"],
+            "match_id" : task.get("match_id", None),
+            "black"    : { "fid" : task["black"], "name" : task["black_name"] },
+            "white"    : { "fid" : task["white"], "name" : task["white_name"] },
+            "date"     : task["date"]
+        })
+    return { "games" : games }
+
+def op_query_workers(master, args):
+    workers = list()
+    for pid, p in master.process_pool.items():
+        workers.append({
+            "pid"   : pid,
+            "load"  : p["load"],
+            "alive" : p["proc"].is_alive(),
+            "idle"  : time.time() - p["idle"] if p["load"] == 0 else 0
+        })
+    return { "workers" : workers }
+
+def op_query_pending(master, args):
+    return { "matches" : [ master.get_match_record(m) for m in master.pending_matches ] }
+
+def op_query_clients(master, args):
+    clients = list()
+    for fid, c in master.client_pool.items():
+        clients.append({
+            "fid"    : fid,
+            "name"   : c["socket"].name,
+            "type"   : c["socket"].type,
+            "status" : c["status"],
+            "gid"    : c["gid"],
+            "pid"    : c["pid"],
+            "rtt"    : c["socket"].rtt,
+            "host"   : c["socket"].host,
+            "cost"   : c["socket"].cost,
+            "slots"  : c["socket"].slots,
+            "gids"   : sorted(c["gids"])
+        })
+    return { "clients" : clients }
+
+def op_query_results(master, args):
+    # Return the results after the sequence number 'after'.
+    after = args.get("after", -1)
+    if not is_int(after):
+        raise ApiError("Invalid field after.")
+    limit = args.get("limit", config.API_MAX_RESULTS)
+    if not is_int(limit) or limit <= 0:
+        raise ApiError("Invalid field limit.")
+    results = [ r for r in master.recent_results if r["seq"] > after ]
+    return { "results" : results[:limit] }
+
+API_OPS = {
+    "submit_match"  : op_submit_match,
+    "cancel_match"  : op_cancel_match,
+    "query_games"   : op_query_games,
+    "query_workers" : op_query_workers,
+    "query_pending" : op_query_pending,
+    "query_clients" : op_query_clients,
+    "query_results" : op_query_results,
+    "submit_series" : op_submit_series,
+    "stop_series"   : op_stop_series,
+    "query_series"  : op_query_series,
+    "query_ratings" : op_query_ratings,
+    "query_pools"   : op_query_pools
+}
+
+# The operations which do not change the server.
+READ_ONLY_OPS = set([
+    "query_games",
+    "query_workers",
+    "query_pending",
+    "query_clients",
+    "query_results",
+    "query_series",
+    "query_ratings",
+    "query_pools"
+])
+
+def handle_api(master, requests, role="admin", submitter=None):
+    # Do the requests in order. One failed request does not stop
+    # the others. The 'submitter' is the default submitter of the
+    # submitted matches.
+    responses = list()
+    if not isinstance(requests, list):
+        requests = [requests]
+    for req in requests:
+        if not isinstance(req, dict):
+            responses.append({ "id" : None, "status" : "error", "error" : "Invalid request." })
+            continue
+        rid = req.get("id", None)
+        op_name = req.get("op", None)
+        op = API_OPS.get(op_name, None) if isinstance(op_name, str) else None
+        args = req.get("args", dict())
+        if op is None:
+            responses.append({ "id" : rid, "status" : "error", "error" : "Unknown op {}.".format(op_name) })
+            continue
+        if not isinstance(args, dict):
+            responses.append({ "id" : rid, "status" : "error", "error" : "Invalid args." })
+            continue
+        if role != "admin" and op_name not in READ_ONLY_OPS:
+            responses.append({ "id" : rid, "status" : "error", "error" : "Permission denied." })
+            continue
+        if submitter is not None and "submitter" not in args:
+            args = dict(args, submitter=submitter)
+        try:
+            responses.append({ "id" : rid, "status" : "ok", "result" : op(master, args) })
+        except ApiError as e:
+            responses.append({ "id" : rid, "status" : "error", "error" : str(e) })
+        except Exception as e:
+            # The unexpected error fails this request only. Never let
+            # it stop the master.
+            master.logger.info(
+                "The API request {} failed.".format(op_name), exc_info=True)
+            responses.append({ "id" : rid, "status" : "error", "error" : "Internal error: {}".format(e) })
+    return responses
@@ -0,0 +1,50 @@
+# The resource budgets of hosts. The engine declares its resource cost
+# in the protocol handshake, like 'e1 genmove_analyze cost 16' for one
+# engine of 16 threads. The engines from the same address share one
+# host. The master only starts the game if the playing engines of each
+# host do not cost more than its budget, so the engines on one host are
+# never oversubscribed.
+#
+# The waiting engines cost nothing. The cost is reserved when the game
+# starts and is released when the game is over or lost.
+
+class HostBudgets:
+    def __init__(self, budgets, default_budget):
+        self.budgets = budgets # host -> budget
+        self.default_budget = default_budget # None is unlimited.
+        self.used = dict() # host -> reserved cost
+
+    def get_budget(self, host):
+        return self.budgets.get(host, self.default_budget)
+
+    def get_free(self, host):
+        # Return the free budget or None if it is unlimited.
+        budget = self.get_budget(host)
+        if budget is None:
+            return None
+        return budget - self.used.get(host, 0)
+
+    def fits(self, costs):
+        # The 'costs' is the list of (host, cost). Both engines of one
+        # game may be on the same host.
+        need = dict()
+        for host, cost in costs:
+            need[host] = need.get(host, 0) + cost
+        for host, cost in need.items():
+            free = self.get_free(host)
+            if free is not None and cost > free:
+                return False
+        return True
+
+    def reserve(self, costs):
+        for host, cost in costs:
+            self.used[host] = self.used.get(host, 0) + cost
+
+    def release(self, costs):
+        for host, cost in costs:
+            self.used[host] = max(0, self.used.get(host, 0) - cost)
+
+    def get_status(self):
+        # The list of (host, used, budget).
+        hosts = set(self.used.keys()) | set(self.budgets.keys())
+        return [ (host, self.used.get(host, 0), self.get_budget(host)) for host in sorted(hosts) ]
@@ -10,6 +10,9 @@ def master_loop():
     commands_queue = list()
     sleeping_time = 0.2
 
+    # Warm restart from the last snapshot.
+    master.restore_snapshot(commands_queue)
+
     # The main loop is running.
     try:
         while True:
@@ -19,16 +22,35 @@ def master_loop():
             # 2nd. Try to receive the command.
             master.handle_manager(commands_queue)
 
-            # 3rd. Check the input command.
+            # 3rd. Serve the observers.
+            master.handle_observers()
+
+            # 4th. Check the input command.
             read_list, _, _ = select.select([sys.stdin], [], [], 0)
             if read_list:
                 cmd = sys.stdin.readline().strip()
                 commands_queue.append(cmd)
             master.handle_command(commands_queue)
 
-            # 4th. Check the finished clients.
+            # 5th. Check the finished clients.
             master.handle_finished_clients()
 
+            # 6th. Start the pending matches and pair the free
+            #      engines.
+            master.handle_series()
+            master.handle_pending_matches()
+            master.handle_pairing()
+
+            # 7th. Supervise the worker processes.
+            master.handle_processes()
+
+            # 8th. Update the metrics.
+            master.handle_metrics(commands_queue)
+
+            # 9th. Save the master state and ratings.
+            master.handle_snapshot(commands_queue)
+            master.handle_rating()
+
             # Sleep some time in order to avoid
             # busy waiting.
             time.sleep(sleeping_time)
@@ -1,3 +1,5 @@
+import socket
+
 import config
 
 class ClientSocketError(Exception):
@@ -21,43 +23,103 @@ class ClientSocket:
         self.fid = None
         self.support_analysis = False
 
+        # The address of client and the resource cost of engine. The
+        # engines from one address share the host budget.
+        self.host = None
+        self.cost = config.DEFAULT_ENGINE_COST
+
+        # The number of games the engine plays at once over this
+        # connection. See 'multigame.py'.
+        self.slots = 1
+
+        # The last heartbeat round trip time in second. The minimum
+        # one is the best estimation of network lag because the others
+        # include the delay of master loop.
+        self.rtt = None
+        self.min_rtt = None
+
+        # The worker process which holds the socket.
+        self.owner = None
+
+        # The number of the unanswered replies left in the socket.
+        # The next reader should drop them first.
+        self.stale_lines = 0
+        self._probe_buf = bytes()
+
+        # The bytes sent right after the handshake. The session reads
+        # them first.
+        self.unread = bytes()
+
         # We should remove the client later if crash is true.
         self.crash = False
 
-        # Type is manager or engine.
+        # Type is manager, engine or observer.
         self.type = None
 
-    def setup_socket(self, sock):
-        if self.sock is not None:
-            self.close()
-            self.sock = None
-        else:
-            self.sock = sock
-            self.fid = sock.fileno()
+        # The manager of 'm2' protocol keeps the connection and
+        # receives the status pushed by master.
+        self.push = False
 
-        self.create_sockfile()
-        msg = self.request_protocol()
-        parameters = msg.split()
+        # The role of manager. The 'admin' can control the server. The
+        # 'monitor' can only read the status.
+        self.role = None
 
-        if parameters[0] == "e1":
+    def setup_handshake(self, sock, protocol, username, password):
+        # Set up the client by the replies of handshake. The master
+        # collects them without blocking.
+        self.sock = sock
+        self.fid = sock.fileno()
+        parameters = protocol.split()
+
+        if len(parameters) == 0:
+            raise ClientSocketError(self, "Do not soppurt this client version.")
+        elif parameters[0] == "e1":
             # The engine client.
             self.support_analysis = "genmove_analyze" in parameters
             self.type = "engine"
+            if "cost" in parameters:
+                # The declared resource cost, like 'cost 16'.
+                try:
+                    self.cost = float(parameters[parameters.index("cost") + 1])
+                except (IndexError, ValueError):
+                    raise ClientSocketError(self, "Invalid engine cost.")
+                if self.cost < 0:
+                    raise ClientSocketError(self, "Invalid engine cost.")
+            if "multigame" in parameters:
+                # The concurrent games, like 'multigame 4'.
+                try:
+                    self.slots = int(parameters[parameters.index("multigame") + 1])
+                except (IndexError, ValueError):
+                    raise ClientSocketError(self, "Invalid multigame.")
+                if self.slots < 1:
+                    raise ClientSocketError(self, "Invalid multigame.")
+                self.slots = min(self.slots, config.MAX_MULTIGAME)
         elif parameters[0] == "m1":
             # The manager client.
             self.type = "manager"
+        elif parameters[0] == "m2":
+            # The push mode manager client.
+            self.type = "manager"
+            self.push = True
+        elif parameters[0] == "o1":
+            # The observer client. It watches the live games.
+            self.type = "observer"
         else:
             raise ClientSocketError(self, "Do not soppurt this client version.")
 
-        self.name = self.request_username().strip()
-        password = self.request_password()
+        self.name = username.strip()
         if self.type == "manager":
-            if password != config.MANAGER_PASSWORD:
+            if password == config.MANAGER_PASSWORD:
+                self.role = "admin"
+            elif config.MONITOR_PASSWORD is not None and \
+                     password == config.MONITOR_PASSWORD:
+                self.role = "monitor"
+            else:
+                self.crash = True
+        elif self.type == "observer":
+            if config.OBSERVER_PASSWORD is not None and \
+                   password != config.OBSERVER_PASSWORD:
                 self.crash = True
-
-        # Close the socket file because the we can not push socket file
-        # onto process queue. 
-        self.close_sockfile()
 
     def request_poll(self):
         # Not a stand protocal. The effect is to
@@ -67,6 +129,41 @@ class ClientSocket:
         except ClientSocketError as e:
             pass
 
+    def send_probe(self):
+        # Non-blocking version of 'request_poll'. Only send the
+        # request here. The reply is collected by 'receive_probe'.
+        try:
+            self._probe_buf = bytes()
+            self.sock.send("username\n".encode("utf-8"), socket.MSG_DONTWAIT)
+        except:
+            raise ClientSocketError(self, "Can not send massage to client.")
+
+    def receive_probe(self):
+        # Try to collect the reply of the probe without blocking.
+        # Return None if the reply is not complete.
+        try:
+            data = self.sock.recv(4096, socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return None
+        except:
+            raise ClientSocketError(self, "Can not read massage from client.")
+        if len(data) == 0:
+            raise ClientSocketError(self, "The client is closed.")
+
+        self._probe_buf += data
+        if self._probe_buf.find(b"\n") < 0:
+            return None
+        line, _, _ = self._probe_buf.partition(b"\n")
+        self._probe_buf = bytes()
+        return line.decode("utf-8", errors="replace").strip()
+
+    def drop_stale_lines(self):
+        # Drop the unanswered replies, like the late reply of
+        # heartbeat probe. The socket file should be created.
+        while self.stale_lines > 0:
+            self.stale_lines -= 1
+            self.receive()
+
     def request_queries(self):
         # It is for manager client. Try get query from
         # client.
@@ -98,12 +195,12 @@ class ClientSocket:
                             komi,
                             main_time_msec,
                             player_a_name,
-                            player_b_name):
+                            player_b_name,
+                            game_id=0):
         # Send the game information to serve, including game id,
         # board size, komi, main think time in milliseconds and 
         # player name. The client should initialize the game.
         # There is no return value.
-        game_id = 0
         param = "{} {} {} {} {} {}".format(
                     game_id,
                     board_size,
@@ -140,6 +237,12 @@ class ClientSocket:
     def close(self):
         try:
             self.close_sockfile()
+            try:
+                # The workers may still hold the duplicated descriptor.
+                # Shut down the connection in order to close it at all.
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
             self.sock.close()
             self.sock = None
             self.fid = None
@@ -149,6 +252,16 @@ class ClientSocket:
             self.fid = None
             raise ClientSocketError(self, "Can not close the client socket.")
 
+    def release(self):
+        # Only close the local file descriptor. The connection is
+        # still alive because the master holds it.
+        try:
+            self.close_sockfile()
+            self.sock.close()
+        except:
+            pass
+        self.sock = None
+
     def create_sockfile(self):
         # We must create socket file before sending the
         # message.
@@ -159,9 +272,8 @@ class ClientSocket:
             raise ClientSocketError(self, "Can not create the socket file.")
 
     def close_sockfile(self):
-        # Close the socket file before pushing onto the
-        # process queue because socket file can not be
-        # converted to bytes type.
+        # Close the socket file before other readers use the
+        # socket because the socket file may buffer the message.
         try:
             if self._sock_file is not None:
                 self._sock_file.close()
@@ -2,6 +2,16 @@ SERVER_PORT = 1919
 
 NUM_WORKERS = 1
 
+MIN_WORKERS = 1
+
+MAX_WORKERS = None
+
+WORKER_MAX_LOAD = 8
+
+WORKER_IDLE_SECONDS = 300
+
+SUPERVISE_INTERVAL = 1
+
 DEFAULT_MAIN_SECOND = 900
 
 DEFAULT_BOARD_SIZE = 9
@@ -10,8 +20,138 @@ DEFAULT_KOMI = 7
 
 DEFAULT_STORE_DIR = "default"
 
+AUTO_PAIRING = False
+
+PAIRING_INTERVAL = 1
+
+PAIRING_HISTORY = 64
+
+PAIRING_SETTING = dict()
+
+PAIRING_POLICY = "random"
+
+PAIRING_REPEAT_PENALTY = 1
+
+PAIRING_NEIGHBORS = 8
+
+SPRT_ALPHA = 0.05
+
+SPRT_BETA = 0.05
+
+SPRT_MODEL = "pentanomial"
+
+OPENING_ORDER = "sequential"
+
+DEFAULT_PRIORITY = "normal"
+
+PRIORITY_AGEING = 1800
+
+FAIR_SHARE_HALF_LIFE = 3600
+
+SUBMITTER_WEIGHTS = dict()
+
+POOL_WEIGHTS = dict()
+
+RATING_FILE = "rating.json"
+
+RATING_INITIAL = 1500
+
+RATING_RD_INITIAL = 350
+
+RATING_RD_MIN = 30
+
+RATING_RD_PER_DAY = 10
+
+RATING_PRIOR_GAMES = 2
+
+RATING_BATCH_INTERVAL = 600
+
 WGO_PATH = None
 
 DATA_DIR_ROOT = [".", "data"]
 
 MANAGER_PASSWORD = "a123456789"
+
+MONITOR_PASSWORD = None
+
+MAX_MANAGER_SESSIONS = 16
+
+MANAGER_PUSH_BUFFER = 16 * 1024 * 1024
+
+LISTEN_BACKLOG = 128
+
+MAX_ENGINES = 1024
+
+MAX_HANDSHAKES = 64
+
+MAX_HANDSHAKES_PER_ADDR = 4
+
+MAX_WAITING_CONNECTIONS = 256
+
+HANDSHAKE_TIMEOUT = 10
+
+CONNECT_RATE = 1
+
+CONNECT_BURST = 20
+
+DEFAULT_ENGINE_COST = 1
+
+HOST_BUDGETS = dict()
+
+DEFAULT_HOST_BUDGET = None
+
+MAX_MULTIGAME = 16
+
+OBSERVER_PASSWORD = None
+
+MAX_OBSERVERS = 256
+
+OBSERVER_BUFFER = 4 * 1024 * 1024
+
+HTTP_HOST = "127.0.0.1"
+
+HTTP_PORT = 1921
+
+HTTP_MAX_EVENTS = 4096
+
+HTTP_CACHE_SECONDS = 86400
+
+SGF_FLUSH_INTERVAL = 5
+
+LOG_FILE = "log.txt"
+
+LOG_FORMAT = "text"
+
+LOG_ROTATE = "size"
+
+LOG_MAX_BYTES = 64 * 1024 * 1024
+
+LOG_ROTATE_WHEN = "midnight"
+
+LOG_BACKUP_COUNT = 10
+
+METRICS_HOST = "127.0.0.1"
+
+METRICS_PORT = 1920
+
+METRICS_INTERVAL = 1
+
+METRICS_REPORT_INTERVAL = 1
+
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+GAME_TRACE = False
+
+SNAPSHOT_FILE = "snapshot.json"
+
+SNAPSHOT_INTERVAL = 10
+
+RESTORE_TIMEOUT = 600
+
+API_MAX_RESULTS = 1000
+
+HEARTBEAT_INTERVAL = 10
+
+HEARTBEAT_TIMEOUT = 5
+
+HEARTBEAT_MAX_MISSES = 3
@@ -0,0 +1,72 @@
+import heapq
+
+# The order of pending matches. Each match has the priority class and
+# the submitter, like the manager name or the team. The matches are
+# started in this order.
+#
+#     1. The higher class first. The match waiting for 'ageing' seconds
+#        is promoted one class, but never into 'urgent' by ageing.
+#     2. The smaller share first. The share is the recent games of the
+#        submitter divided by its weight, plus the mean share of the
+#        two engine pools. The recent games decay with 'half_life'.
+#     3. The earlier match first.
+#
+# So one large batch can not starve the others. Each submitter and pool
+# gets the games in proportion to its weight when they all wait.
+
+PRIORITY_CLASSES = ["urgent", "high", "normal", "batch"]
+
+class FairShareScheduler:
+    def __init__(self, submitter_weights, pool_weights, half_life, ageing):
+        self.weights = {
+            "submitter" : submitter_weights,
+            "pool"      : pool_weights
+        }
+        self.half_life = half_life
+        self.ageing = ageing # None disables the ageing.
+        self.usage = dict() # (kind, name) -> [decayed games, last time]
+
+    def get_usage(self, kind, name, now):
+        u = self.usage.get((kind, name), None)
+        if u is None:
+            return 0
+        games, last = u
+        return games * 0.5 ** (max(0, now - last) / self.half_life)
+
+    def get_share(self, kind, name, now):
+        weight = self.weights[kind].get(name, 1)
+        if weight <= 0:
+            return float("inf")
+        return self.get_usage(kind, name, now) / weight
+
+    def charge(self, match, now):
+        # The match is started.
+        keys = [("submitter", match["submitter"])]
+        keys.extend([ ("pool", p["name"]) for p in [match["black"], match["white"]] ])
+        for kind, name in keys:
+            self.usage[(kind, name)] = [self.get_usage(kind, name, now) + 1, now]
+
+    def get_class(self, match, now):
+        rank = PRIORITY_CLASSES.index(match["priority"])
+        if self.ageing is not None and rank > 1:
+            rank = max(1, rank - int((now - match["submitted"]) / self.ageing))
+        return rank
+
+    def get_key(self, match, now):
+        pools = [ self.get_share("pool", p["name"], now) for p in [match["black"], match["white"]] ]
+        share = self.get_share("submitter", match["submitter"], now) + sum(pools) / 2
+        return (self.get_class(match, now), share, match["submitted"], match["match_id"])
+
+    def order(self, matches, now):
+        # Yield the matches in order. The caller charges the started
+        # match, so the keys only grow. Check the key again before
+        # yielding it.
+        heap = [ (self.get_key(m, now), i) for i, m in enumerate(matches) ]
+        heapq.heapify(heap)
+        while len(heap) > 0:
+            key, i = heapq.heappop(heap)
+            new_key = self.get_key(matches[i], now)
+            if new_key != key and len(heap) > 0 and new_key > heap[0][0]:
+                heapq.heappush(heap, (new_key, i))
+                continue
+            yield matches[i]
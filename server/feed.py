@@ -0,0 +1,81 @@
+import json
+import threading
+
+# The live events of games in the worker. Only the games watched by
+# observers are published. Each event is serialized once here and the
+# master fans the line out to all observers of the game.
+#
+# The events are here.
+#      setup: the players and game setting
+#       move: one move with the time left and analysis
+#     result: the game result, it is the last event
+#       sync: the setup and all moves so far for the new watcher, it
+#             replaces all previous events of the game
+
+def dump_event(event):
+    return json.dumps(event, indent=None, separators=(",", ":"))
+
+class GameFeed:
+    def __init__(self, event_queue):
+        self.event_queue = event_queue
+        self._lock = threading.Lock()
+        self.watched = set() # The watched gids.
+        self.games = dict() # gid -> { "setup", "moves" }
+
+    # The events are published with the lock held, so the new watcher
+    # never sees one move both in the sync event and after it.
+
+    def open(self, gid):
+        # The game is accepted by the worker. It can be watched
+        # before it is set up.
+        with self._lock:
+            self.games[gid] = { "setup" : None, "moves" : list() }
+
+    def start(self, gid, setup):
+        event = { "e" : "setup", "gid" : gid }
+        event.update(setup)
+        with self._lock:
+            game = self.games.get(gid, None)
+            if game is not None:
+                game["setup"] = setup
+            self.publish(gid, event)
+
+    def move(self, gid, move):
+        event = { "e" : "move", "gid" : gid }
+        event.update(move)
+        with self._lock:
+            game = self.games.get(gid, None)
+            if game is not None:
+                game["moves"].append(move)
+            self.publish(gid, event)
+
+    def finish(self, gid, result):
+        event = { "e" : "result", "gid" : gid }
+        event.update(result)
+        with self._lock:
+            self.publish(gid, event, end=True)
+            self.games.pop(gid, None)
+            self.watched.discard(gid)
+
+    def watch(self, gid, on):
+        # The master asks to start or stop publishing the game. Send
+        # the whole game so far to the new watcher.
+        with self._lock:
+            if not on:
+                self.watched.discard(gid)
+                return
+            game = self.games.get(gid, None)
+            if game is None:
+                return
+            self.watched.add(gid)
+            if game["setup"] is None:
+                return
+            event = { "e" : "sync", "gid" : gid, "moves" : list(game["moves"]) }
+            event.update(game["setup"])
+            self.event_queue.put((gid, dump_event(event), False))
+
+    def publish(self, gid, event, end=False):
+        # Should hold the lock.
+        if gid not in self.watched:
+            return
+        self.event_queue.put((gid, dump_event(event), end))
@@ -0,0 +1,50 @@
+import socket
+import json
+
+from client import ClientSocket
+
+# The master hands the client sockets over to the workers via
+# SCM_RIGHTS on a unix socket pair. The master always keeps its own
+# file descriptor, so it can hand the same client over to another
+# worker later. The worker keeps the duplicated descriptor until the
+# master asks it to release the client. An engine playing many games
+# in the same worker is transferred only once.
+
+MAX_HANDOFF_SIZE = 4096
+
+def create_channel():
+    # The SEQPACKET socket keeps the message boundary. One message
+    # carries one client.
+    return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+def send_client(channel, client):
+    # Send the client file descriptor and the basic client
+    # information to the worker.
+    info = {
+        "fid"              : client.fid,
+        "name"             : client.name,
+        "type"             : client.type,
+        "support_analysis" : client.support_analysis,
+        "slots"            : client.slots
+    }
+    msg = json.dumps(info, indent=None, separators=(',', ':')).encode("utf-8")
+    socket.send_fds(channel, [msg], [client.sock.fileno()])
+
+def recv_client(channel):
+    # Receive the client from the master. The 'fid' is still the
+    # master's fid because the master uses it as client id.
+    msg, fds, _, _ = socket.recv_fds(channel, MAX_HANDOFF_SIZE, 1)
+    if len(fds) != 1:
+        for fd in fds:
+            socket.close(fd)
+        raise Exception("Invalid client handoff.")
+    info = json.loads(msg.decode("utf-8"))
+
+    c = ClientSocket()
+    c.sock = socket.socket(fileno=fds[0])
+    c.fid = info["fid"]
+    c.name = info["name"]
+    c.type = info["type"]
+    c.support_analysis = info["support_analysis"]
+    c.slots = info["slots"]
+    return c
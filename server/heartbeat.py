@@ -0,0 +1,119 @@
+import heapq
+import random
+
+class HeartbeatScheduler:
+    # Schedule the heartbeat probes of the waiting clients. Every
+    # client owns a due time in the heap, so each tick only touches
+    # the clients whose probes are due instead of scanning the
+    # whole pool.
+    #
+    # The life of one probe is here.
+    #     due: (send the probe) => sent => (get the reply) => due
+    #     due: (send the probe) => sent => (timeout) => miss => sent
+    # The client is dead after missing 'max_misses' timeouts in a row.
+
+    def __init__(self, interval, timeout, max_misses):
+        self.interval = interval
+        self.timeout = timeout
+        self.max_misses = max(max_misses, 1)
+
+        # The heap contains (due time, fid, token). The token is
+        # used for lazy deletion. The heap entry is invalid if its
+        # token is different from the entry token.
+        self._heap = list()
+        self._entries = dict()
+        self._next_token = 0
+
+        # The fids which are waiting for the reply.
+        self._pending = set()
+
+    def _push(self, fid, due):
+        entry = self._entries[fid]
+        self._next_token += 1
+        entry["token"] = self._next_token
+        heapq.heappush(self._heap, (due, fid, entry["token"]))
+
+    def add(self, fid, now):
+        # Start to watch the client. The first due time is
+        # randomized in order to spread the probes.
+        self._pending.discard(fid)
+        self._entries[fid] = {
+            "token"  : None,
+            "sent"   : None, # The time of sending the probe.
+            "misses" : 0,    # The number of missing probes in a row.
+            "rtt"    : None  # The last round trip time in second.
+        }
+        self._push(fid, now + random.uniform(0, self.interval))
+
+    def remove(self, fid):
+        # Stop watching the client. Return true if there is
+        # an unanswered probe. The reply will be still in the
+        # socket so the next reader should drop it.
+        entry = self._entries.pop(fid, None)
+        self._pending.discard(fid)
+        if entry is None:
+            return False
+        return entry["sent"] is not None
+
+    def is_pending(self, fid):
+        entry = self._entries.get(fid, None)
+        return entry is not None and entry["sent"] is not None
+
+    def pending_fids(self):
+        return self._pending
+
+    def get_rtt(self, fid):
+        entry = self._entries.get(fid, None)
+        if entry is None:
+            return None
+        return entry["rtt"]
+
+    def poll(self, now):
+        # Pop all due entries. Return the fids which should be
+        # probed now and the fids which miss too many probes.
+        probes = list()
+        dead = list()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            _, fid, token = heapq.heappop(self._heap)
+            entry = self._entries.get(fid, None)
+            if entry is None or entry["token"] != token:
+                # The stale heap entry.
+                continue
+
+            if entry["sent"] is not None:
+                # The probe was not answered in time. Do not send
+                # another one because there should be at most one
+                # unanswered request in the socket. Keep waiting for
+                # the same reply.
+                entry["misses"] += 1
+                if entry["misses"] >= self.max_misses:
+                    self._entries.pop(fid)
+                    self._pending.discard(fid)
+                    dead.append(fid)
+                else:
+                    self._push(fid, now + self.timeout)
+                continue
+            probes.append(fid)
+        return probes, dead
+
+    def sent(self, fid, now):
+        # The probe is sent. Wait for the reply until timeout.
+        entry = self._entries.get(fid, None)
+        if entry is None:
+            return
+        entry["sent"] = now
+        self._pending.add(fid)
+        self._push(fid, now + self.timeout)
+
+    def received(self, fid, now):
+        # The probe is answered. Record the round trip time and
+        # schedule the next probe.
+        entry = self._entries.get(fid, None)
+        if entry is None or entry["sent"] is None:
+            return None
+        entry["rtt"] = now - entry["sent"]
+        entry["sent"] = None
+        entry["misses"] = 0
+        self._pending.discard(fid)
+        self._push(fid, now + self.interval)
+        return entry["rtt"]
@@ -0,0 +1,116 @@
+import threading
+
+# The HDR-style histogram. The values are recorded in microseconds.
+# The small values are counted exactly. The large values share the
+# log-linear buckets, so the relative error is bounded by the sub
+# bucket resolution and the memory does not grow with the range.
+
+SUB_BUCKET_BITS = 7 # About 2 significant digits.
+
+class Histogram:
+    def __init__(self, counts=None):
+        self.sub_bucket_count = 1 << SUB_BUCKET_BITS
+        self.half_count = self.sub_bucket_count >> 1
+        self.counts = dict() # bucket index -> count
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+        if counts is not None:
+            self.merge(counts)
+
+    def _get_index(self, v):
+        if v < self.sub_bucket_count:
+            return v
+        shift = v.bit_length() - SUB_BUCKET_BITS
+        sub = v >> shift
+        return (shift + 1) * self.half_count + (sub - self.half_count)
+
+    def _get_value(self, index):
+        # The lowest value of the bucket.
+        if index < self.sub_bucket_count:
+            return index
+        shift = index // self.half_count - 1
+        sub = index % self.half_count + self.half_count
+        return sub << shift
+
+    def record(self, seconds):
+        v = max(int(seconds * 1e6), 0)
+        i = self._get_index(v)
+        self.counts[i] = self.counts.get(i, 0) + 1
+        self.total += 1
+        self.sum += v
+        self.max = max(self.max, v)
+
+    def merge(self, other):
+        # Merge the other histogram or its dict form.
+        if isinstance(other, Histogram):
+            other = other.to_dict()
+        for i, n in other["counts"].items():
+            i = int(i)
+            self.counts[i] = self.counts.get(i, 0) + n
+        self.total += other["total"]
+        self.sum += other["sum"]
+        self.max = max(self.max, other["max"])
+
+    def percentile(self, p):
+        # Return the value in second.
+        if self.total == 0:
+            return 0.0
+        target = max(1, int(round(p / 100 * self.total)))
+        acc = 0
+        for i in sorted(self.counts.keys()):
+            acc += self.counts[i]
+            if acc >= target:
+                return min(self._get_value(i), self.max) / 1e6
+        return self.max / 1e6
+
+    def mean(self):
+        if self.total == 0:
+            return 0.0
+        return self.sum / self.total / 1e6
+
+    def to_dict(self):
+        return {
+            "counts" : dict(self.counts),
+            "total"  : self.total,
+            "sum"    : self.sum,
+            "max"    : self.max
+        }
+
+class LatencyRecorder:
+    # Keep the histograms by (scope, key, metric). For example,
+    #     ("engine", "leela", "think")
+    #     ("worker", 0, "sgf_write")
+    # The game threads record the values. The worker loop flushes
+    # them to master.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = dict()
+
+    def record(self, scope, key, metric, seconds):
+        with self._lock:
+            h = self.histograms.get((scope, key, metric), None)
+            if h is None:
+                h = Histogram()
+                self.histograms[(scope, key, metric)] = h
+            h.record(seconds)
+
+    def merge(self, deltas):
+        # The deltas is the list of (scope, key, metric, dict form).
+        with self._lock:
+            for scope, key, metric, d in deltas:
+                h = self.histograms.get((scope, key, metric), None)
+                if h is None:
+                    h = Histogram()
+                    self.histograms[(scope, key, metric)] = h
+                h.merge(d)
+
+    def flush(self):
+        # Return and clean the recorded histograms.
+        with self._lock:
+            histograms, self.histograms = self.histograms, dict()
+        return [ (scope, key, metric, h.to_dict()) for (scope, key, metric), h in histograms.items() ]
+
+    def items(self):
+        with self._lock:
+            return sorted(self.histograms.items(), key=lambda kv: tuple(str(v) for v in kv[0]))
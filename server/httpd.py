@@ -0,0 +1,311 @@
+import email.utils
+import html
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from client import ClientSocketError
+
+# The embedded HTTP server for viewers. It runs in the daemon threads
+# of master and never touches the master state directly. The requests
+# which need the master are pushed onto 'requests' and the master loop
+# answers them.
+#
+#           /: the running games
+#  /view/<gid>: the viewer page of the live game
+#  /live/<gid>: the Server-Sent Events of the live game
+#  /data/<path>: the SGF, HTML and trace files and the WGo files
+
+# The file is regarded as finished if it is not changed for so many
+# seconds. The finished files can be cached by the browsers.
+SETTLED_SECONDS = 60
+
+# The directories under the data root which can be served.
+SERVED_DIRS = ["sgf", "html", "trace"]
+
+CONTENT_TYPES = {
+    ".sgf"   : "application/x-go-sgf; charset=utf-8",
+    ".html"  : "text/html; charset=utf-8",
+    ".trace" : "application/x-ndjson; charset=utf-8",
+    ".js"    : "application/javascript",
+    ".css"   : "text/css",
+    ".png"   : "image/png",
+    ".svg"   : "image/svg+xml"
+}
+
+class LiveStream:
+    # The SSE viewer of one game. The master writes the serialized
+    # events and the handler thread sends them. It looks like the
+    # session of observer hub.
+    def __init__(self, key, gid, max_events):
+        self.key = key
+        self.gid = gid
+        self.crash = False
+        self.closed = False
+        self._queue = queue.Queue(max_events)
+
+    def write(self, line):
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        try:
+            self._queue.put_nowait(line)
+        except queue.Full:
+            raise ClientSocketError(self, "The live stream is full.")
+
+    def flush(self):
+        pass
+
+    def read_lines(self):
+        return list()
+
+    def close(self):
+        # Stop after sending the remaining events.
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def get(self, timeout):
+        # Return None if the stream is over.
+        while True:
+            try:
+                return self._queue.get(timeout=timeout)
+            except queue.Empty:
+                if self.closed:
+                    return None
+                raise
+
+def get_view_page(gid, wgo_path):
+    # The viewer page draws the board with WGo.js if it is available,
+    # otherwise only lists the moves. It updates the board by the live
+    # events and never reloads the SGF.
+    scripts = ""
+    if wgo_path is not None:
+        scripts = \
+            "<script type=\"text/javascript\" src=\"/data/{0}/wgo.min.js\"></script>" \
+            "<link type=\"text/css\" href=\"/data/{0}/wgo.player.css\" rel=\"stylesheet\"/>".format(wgo_path)
+    return \
+        "<!DOCTYPE HTML>" \
+        "<html>" \
+        "<head>" \
+        "<meta charset=\"utf-8\">" \
+        "<title>Live game {0}</title>" \
+        "{1}" \
+        "</head>" \
+        "<body>" \
+        "<div id=\"info\">Waiting for the game {0}...</div>" \
+        "<div id=\"board\" style=\"width: 600px\"></div>" \
+        "<ol id=\"moves\"></ol>" \
+        "<script type=\"text/javascript\">" \
+        "var letters = \"abcdefghjklmnopqrstuvwxyz\";" \
+        "var info = document.getElementById(\"info\");" \
+        "var elem = document.getElementById(\"board\");" \
+        "var list = document.getElementById(\"moves\");" \
+        "var size = 19, board = null, game = null, ready = false, title = \"\";" \
+        "var clocks = {{ b : \"\", w : \"\" }};" \
+        "function reset(ev) {{" \
+        "  size = ev.board_size; ready = true; list.innerHTML = \"\";" \
+        "  title = ev.black + \" (B) vs \" + ev.white + \" (W), komi \" + ev.komi;" \
+        "  info.textContent = title;" \
+        "  if (window.WGo) {{" \
+        "    elem.innerHTML = \"\";" \
+        "    board = new WGo.Board(elem, {{ width : 600, size : size }});" \
+        "    game = new WGo.Game(size);" \
+        "  }}" \
+        "}}" \
+        "function play(mv) {{" \
+        "  var li = document.createElement(\"li\");" \
+        "  li.textContent = mv.c.toUpperCase() + \" \" + mv.m;" \
+        "  list.appendChild(li);" \
+        "  clocks[mv.c] = Math.round(mv.t) + \"s\";" \
+        "  info.textContent = title + \", B \" + clocks.b + \" W \" + clocks.w;" \
+        "  if (board === null || mv.m === \"pass\" || mv.m === \"resign\") return;" \
+        "  var x = letters.indexOf(mv.m[0]), y = size - parseInt(mv.m.substring(1));" \
+        "  var c = mv.c === \"b\" ? WGo.B : WGo.W;" \
+        "  var captured = game.play(x, y, c);" \
+        "  if (Array.isArray(captured)) {{" \
+        "    captured.forEach(function(s) {{ board.removeObjectsAt(s.x, s.y); }});" \
+        "  }}" \
+        "  board.addObject({{ x : x, y : y, c : c }});" \
+        "}}" \
+        "var source = new EventSource(\"/live/{0}\");" \
+        "source.onmessage = function(msg) {{" \
+        "  var ev = JSON.parse(msg.data);" \
+        "  if (ev.e === \"setup\" || ev.e === \"sync\") {{" \
+        "    reset(ev);" \
+        "    (ev.moves || []).forEach(play);" \
+        "  }} else if (ev.e === \"move\") {{" \
+        "    if (ready) play(ev);" \
+        "  }} else if (ev.e === \"result\" || ev.e === \"lost\" || ev.e === \"error\") {{" \
+        "    info.textContent += \", \" + (ev.r || ev.msg || \"lost\");" \
+        "    source.close();" \
+        "  }}" \
+        "}};" \
+        "</script>" \
+        "</body>" \
+        "</html>".format(gid, scripts)
+
+class LiveServer:
+    def __init__(self, host, port, data_root, wgo_path, max_events, cache_seconds):
+        self.requests = queue.Queue() # The requests for master.
+        self._next_key = 0
+        self._key_lock = threading.Lock()
+        server = self
+
+        served_dirs = list(SERVED_DIRS)
+        if wgo_path is not None:
+            served_dirs.append(os.path.normpath(wgo_path))
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                parts = [ v for v in path.split("/") if len(v) > 0 ]
+                try:
+                    if len(parts) == 0:
+                        self.send_index()
+                    elif parts[0] == "view" and len(parts) == 2:
+                        self.send_body(get_view_page(int(parts[1]), wgo_path), "text/html; charset=utf-8")
+                    elif parts[0] == "live" and len(parts) == 2:
+                        self.send_live(int(parts[1]))
+                    elif parts[0] == "data" and len(parts) >= 2:
+                        self.send_data("/".join(parts[1:]))
+                    else:
+                        self.send_error(404)
+                except ValueError:
+                    self.send_error(404)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            def send_body(self, body, content_type):
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_index(self):
+                # Ask master for the running games.
+                reply = queue.Queue()
+                server.requests.put(("games", reply))
+                try:
+                    games = reply.get(timeout=5)
+                except queue.Empty:
+                    self.send_error(503)
+                    return
+                # The engine names are given by the engines. Escape
+                # them.
+                items = "".join([
+                    "<li><a href=\"/view/{0}\">{0}</a>: {1} (B) vs {2} (W)</li>".format(
+                        html.escape(str(g["gid"])), html.escape(g["black"]), html.escape(g["white"]))
+                    for g in games ])
+                self.send_body(
+                    "<!DOCTYPE HTML><html><head><meta charset=\"utf-8\">"
+                    "<title>Live games</title></head><body><ul>{}</ul>"
+                    "</body></html>".format(items),
+                    "text/html; charset=utf-8")
+
+            def send_live(self, gid):
+                stream = server.open_stream(gid, max_events)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                try:
+                    while True:
+                        try:
+                            line = stream.get(timeout=15)
+                        except queue.Empty:
+                            # Keep the connection alive and detect
+                            # the closed browser.
+                            self.wfile.write(b": keep-alive\n\n")
+                            self.wfile.flush()
+                            continue
+                        if line is None:
+                            break
+                        self.wfile.write(b"data: " + line + b"\n\n")
+                        self.wfile.flush()
+                finally:
+                    server.requests.put(("close", stream))
+
+            def send_data(self, rel_path):
+                # Only serve the files under the served directories.
+                rel_path = os.path.normpath(rel_path)
+                if rel_path.startswith("..") or os.path.isabs(rel_path) or \
+                       not any([ rel_path == d or rel_path.startswith(d + os.sep) for d in served_dirs ]):
+                    self.send_error(404)
+                    return
+                full_path = os.path.join(data_root, rel_path)
+                if not os.path.isfile(full_path):
+                    self.send_error(404)
+                    return
+
+                st = os.stat(full_path)
+                etag = "\"{:x}-{:x}\"".format(int(st.st_mtime * 1000), st.st_size)
+                if time.time() - st.st_mtime > SETTLED_SECONDS:
+                    cache_control = "public, max-age={}".format(cache_seconds)
+                else:
+                    # The file of running game may be rewritten.
+                    cache_control = "no-cache"
+
+                if self.headers.get("If-None-Match", None) == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", cache_control)
+                    self.end_headers()
+                    return
+
+                _, ext = os.path.splitext(full_path)
+                with open(full_path, 'rb') as f:
+                    self.send_response(200)
+                    self.send_header("Content-Type", CONTENT_TYPES.get(ext, "application/octet-stream"))
+                    self.send_header("Content-Length", str(st.st_size))
+                    self.send_header("ETag", etag)
+                    self.send_header("Last-Modified", email.utils.formatdate(st.st_mtime, usegmt=True))
+                    self.send_header("Cache-Control", cache_control)
+                    self.end_headers()
+                    self.wfile.flush()
+                    # Copy the file in the kernel.
+                    self.connection.sendfile(f)
+
+            def log_message(self, *args):
+                # Do not write the access log to stderr.
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+                          target=self.httpd.serve_forever,
+                          daemon=True
+                      )
+        self.thread.start()
+
+    def open_stream(self, gid, max_events):
+        with self._key_lock:
+            key = ("live", self._next_key)
+            self._next_key += 1
+        stream = LiveStream(key, gid, max_events)
+        self.requests.put(("watch", stream))
+        return stream
+
+    def poll(self):
+        # Return all requests for master.
+        out = list()
+        while True:
+            try:
+                out.append(self.requests.get(block=False))
+            except queue.Empty:
+                break
+        return out
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
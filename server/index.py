@@ -0,0 +1,159 @@
+import random
+
+class IndexedSet:
+    # The set supports O(1) add, remove and random choice. The
+    # items are kept in a list and the positions are kept in a
+    # dict. Remove the item by swapping it with the last one.
+
+    def __init__(self):
+        self._items = list()
+        self._pos = dict()
+
+    def add(self, item):
+        if item in self._pos:
+            return
+        self._pos[item] = len(self._items)
+        self._items.append(item)
+
+    def discard(self, item):
+        i = self._pos.pop(item, None)
+        if i is None:
+            return
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._pos[last] = i
+
+    def sample(self, k):
+        # Randomly pick k different items.
+        return random.sample(self._items, k) if k > 1 else [random.choice(self._items)]
+
+    def __contains__(self, item):
+        return item in self._pos
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        return iter(list(self._items))
+
+class ClientIndex:
+    # Keep the indexes of 'client_pool'. They are updated on the state
+    # transitions of clients instead of scanning the whole pool every
+    # tick. The transitions are here.
+    #
+    # connect:  add() => waiting (engine)
+    # dispatch: set_playing() => playing
+    # finish:   leave_game() => waiting if there is no other game
+    # crash:    mark_crash() => crashed
+    # close:    remove()
+    #
+    # The multigame engine plays at most 'slots' games at once. It stays
+    # in 'waiting' until all slots are taken. The 'gids' of the entry are
+    # its running games and the 'gid' is the last one.
+    #
+    # The changed clients and games are marked dirty. The push mode
+    # manager only receives them.
+
+    def __init__(self):
+        self.waiting = IndexedSet() # The waiting engines.
+        self.playing = dict() # gid -> set of fids
+        self.crashed = set() # The fids should be removed.
+        self.names = dict() # name -> set of fids
+        self.counts = dict() # (type, status) -> number of clients
+        self.dirty = set() # The changed fids.
+        self.dirty_games = set() # The changed gids.
+
+    def add(self, fid, entry):
+        c = entry["socket"]
+        self._count(entry, 1)
+        self.dirty.add(fid)
+        self.names.setdefault(c.name, set()).add(fid)
+        if c.type == "engine" and entry["status"] == "waiting":
+            self.waiting.add(fid)
+        if c.crash:
+            self.crashed.add(fid)
+
+    def remove(self, fid, entry):
+        c = entry["socket"]
+        self._count(entry, -1)
+        self.dirty.add(fid)
+        fids = self.names.get(c.name, None)
+        if fids is not None:
+            fids.discard(fid)
+            if len(fids) == 0:
+                self.names.pop(c.name)
+        self.waiting.discard(fid)
+        for gid in list(entry["gids"]):
+            self._leave_game(fid, gid)
+        self.crashed.discard(fid)
+
+    def set_playing(self, fid, entry, gid, pid):
+        c = entry["socket"]
+        if c.slots <= 1:
+            for old_gid in list(entry["gids"]):
+                self._leave_game(fid, old_gid)
+                entry["gids"].discard(old_gid)
+        self._count(entry, -1)
+        self.dirty.add(fid)
+        self.dirty_games.add(gid)
+        entry["status"] = "playing"
+        entry["gid"] = gid
+        entry["pid"] = pid
+        entry["gids"].add(gid)
+        self._count(entry, 1)
+        self.playing.setdefault(gid, set()).add(fid)
+        if len(entry["gids"]) >= c.slots:
+            self.waiting.discard(fid)
+
+    def leave_game(self, fid, entry, gid):
+        # The game is over. The client returns to waiting if there is
+        # no other game.
+        c = entry["socket"]
+        self._leave_game(fid, gid)
+        entry["gids"].discard(gid)
+        self.dirty.add(fid)
+        if len(entry["gids"]) == 0:
+            self._count(entry, -1)
+            entry["status"] = "waiting"
+            entry["gid"] = None
+            entry["pid"] = None
+            self._count(entry, 1)
+        elif entry["gid"] == gid:
+            entry["gid"] = max(entry["gids"])
+        if c.type == "engine" and not c.crash and len(entry["gids"]) < c.slots:
+            self.waiting.add(fid)
+
+    def mark_crash(self, fid, entry):
+        entry["socket"].crash = True
+        self.dirty.add(fid)
+        self.waiting.discard(fid)
+        self.crashed.add(fid)
+
+    def get_playing(self, gid):
+        return self.playing.get(gid, set())
+
+    def get_fids_by_name(self, name):
+        return self.names.get(name, set())
+
+    def pop_dirty(self):
+        # Return and clean the changed fids and gids.
+        dirty, self.dirty = self.dirty, set()
+        dirty_games, self.dirty_games = self.dirty_games, set()
+        return dirty, dirty_games
+
+    def _count(self, entry, n):
+        key = (entry["socket"].type, entry["status"])
+        self.counts[key] = self.counts.get(key, 0) + n
+        if self.counts[key] == 0:
+            self.counts.pop(key)
+
+    def _leave_game(self, fid, gid):
+        if gid is None:
+            return
+        self.dirty_games.add(gid)
+        fids = self.playing.get(gid, None)
+        if fids is not None:
+            fids.discard(fid)
+            if len(fids) == 0:
+                self.playing.pop(gid)
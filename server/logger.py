@@ -0,0 +1,101 @@
+import logging
+import logging.handlers
+import multiprocessing as mp
+import json
+import sys
+
+import config
+
+# The master and the workers do not write the log files by themselves.
+# They push the records onto one shared queue. The listener thread in
+# master pops the records and writes them, so a slow disk never stalls
+# the event loop.
+#
+# The structured fields are passed by the 'extra' argument. For example,
+#     logger.info("msg", extra={ "event" : "connect", "fid" : fid })
+
+STRUCTURED_FIELDS = ["event", "fid", "gid", "pid", "latency"]
+
+class JsonFormatter(logging.Formatter):
+    # One record is one JSON line.
+    def format(self, record):
+        out = {
+            "time"    : self.formatTime(record),
+            "created" : record.created,
+            "level"   : record.levelname,
+            "name"    : record.name,
+            "process" : record.process,
+            "message" : record.getMessage()
+        }
+        for k in STRUCTURED_FIELDS:
+            v = getattr(record, k, None)
+            if v is not None:
+                out[k] = v
+        return json.dumps(out, indent=None, separators=(',', ':'))
+
+def get_file_handler(out_file):
+    # Rotate the log file by size or by time. Keep the old files
+    # with suffix.
+    if config.LOG_ROTATE == "size":
+        handler = logging.handlers.RotatingFileHandler(
+                      out_file,
+                      maxBytes=config.LOG_MAX_BYTES,
+                      backupCount=config.LOG_BACKUP_COUNT
+                  )
+    elif config.LOG_ROTATE == "time":
+        handler = logging.handlers.TimedRotatingFileHandler(
+                      out_file,
+                      when=config.LOG_ROTATE_WHEN,
+                      backupCount=config.LOG_BACKUP_COUNT
+                  )
+    else:
+        handler = logging.FileHandler(out_file)
+
+    if config.LOG_FORMAT == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(levelname)s: %(message)s")
+    handler.setFormatter(formatter)
+    handler.setLevel(logging.DEBUG)
+    return handler
+
+class LogListener:
+    def __init__(self, out_file=None, out_io=sys.stdout):
+        if out_file is None:
+            out_file = config.LOG_FILE
+        self.queue = mp.Queue(-1)
+
+        # Log debug output to file
+        file_handler = get_file_handler(out_file)
+
+        # Log info output to console
+        console_handler = logging.StreamHandler(out_io)
+        console_handler.setLevel(logging.INFO)
+        console_handler.setFormatter(logging.Formatter("%(asctime)s: %(message)s"))
+
+        self.listener = logging.handlers.QueueListener(
+                            self.queue,
+                            file_handler,
+                            console_handler,
+                            respect_handler_level=True
+                        )
+        self.listener.start()
+
+    def stop(self):
+        # Write all remaining records.
+        if self.listener is not None:
+            self.listener.stop()
+            for h in self.listener.handlers:
+                h.close()
+            self.listener = None
+
+def get_logger(name, log_queue):
+    # Get the logger which pushes the records onto queue. It can
+    # be used in both master and workers.
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    for h in list(logger.handlers):
+        logger.removeHandler(h)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    return logger
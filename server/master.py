@@ -1,22 +1,58 @@
 import socket
 import select
 import queue
-import random
 import os
 import sys
-import logging
 import json
+import time
+import collections
 import multiprocessing as mp
 
 import config
-from match import match_loop
+from match import match_loop, get_date, get_base_name
 from client import ClientSocket, ClientSocketError
+from admission import RateLimiter, Handshake, HandshakeError
+from api import handle_api
+from budget import HostBudgets
+from fairshare import PRIORITY_CLASSES, FairShareScheduler
+from feed import dump_event
+from heartbeat import HeartbeatScheduler
+from histogram import LatencyRecorder
+from httpd import LiveServer
+from handoff import create_channel, send_client
+from index import ClientIndex
+from logger import LogListener, get_logger
+from metrics import Metrics, MetricsServer, RateWindow
+from observer import ObserverHub
+from opening import OPENING_ORDERS, load_opening_book
+from pairing import PairingScheduler
+from pool import EnginePools
+from series import MatchSeries
+from sprt import Sprt
+from profiler import create_profiler, get_profile_path
+from rating import RatingBook
+from session import PushSession
+from snapshot import SNAPSHOT_VERSION, dump_snapshot, save_snapshot, load_snapshot
 from utils import check_and_mkdir
 
+# The maximum number of worker messages handled in one tick.
+MAX_FINISHED_PER_TICK = 256
+
+# The maximum number of game events fanned out in one tick.
+MAX_EVENTS_PER_TICK = 4096
+
+# The maximum number of connections accepted in one tick.
+MAX_ACCEPTS_PER_TICK = 64
+
 class MasterSocket:
     def __init__(self):
-        # The processes run the match games.
-        self.process_pool = list() 
+        # The processes run the match games. The 'process_pool'
+        # maps the process id to the process status. The processes
+        # are supervised and scaled in 'handle_processes()'.
+        self.process_pool = dict()
+        self.next_pid = 0
+        self.retired_processes = list()
+        self.supervise_clock_time = time.time()
 
         # Record current the match game and clients status. We may
         # find any game status from 'game_tasks' and find every
@@ -27,27 +63,69 @@ class MasterSocket:
         # There are tree pipe to control the match games
         # schedule. Their relation are here.
         #
-        # Add new clients: (get the socket) => waiting_clients
-        # schedule game:    waiting_clients => ready_queue_pool
+        # Add new clients: (get the socket) => waiting clients
+        # schedule game:    waiting clients => ready_queue_pool
         # playing game:    ready_queue_pool => (thread running...) => finished_queue
-        # finshed game:      finished_queue => waiting_clients
-        # terninate:        waiting_clients => (close the socket)
-        self.waiting_clients = set() # Always empty set. Will fill it before scheduling
-                                     # new game.
-        self.ready_queue_pool = list() # One process uses one independent ready queue.
+        # finshed game:      finished_queue => waiting clients
+        # terninate:        waiting clients => (close the socket)
+        #
+        # The 'client_index' keeps the waiting, playing and crashed
+        # clients. Always change the client status via it.
+        self.client_index = ClientIndex()
+        self.ready_queue_pool = dict() # One process uses one independent ready queue.
         self.finished_queue = mp.Queue() # All processes share one finished queue.
+        self.event_queue = mp.Queue() # The live events of the watched games.
         self.last_game_id = 0
         self.should_remove_fids = set()
 
-        # We can control the master loop by remote manager.
+        # The new connections finish the handshake here without
+        # blocking the master. Limit the connection rate of each
+        # address. The connections over the limits wait in order
+        # until they are allowed.
+        self.handshakes = dict() # fid -> Handshake
+        self.waiting_connections = collections.deque() # (socket, address)
+        self.rate_limiter = RateLimiter(config.CONNECT_RATE, config.CONNECT_BURST)
+        self.rate_limiter_clock_time = 0
+
+        # We can control the master loop by remote managers. There
+        # is at most one lazy manager because the master waits for it
+        # every tick. The push mode managers have the sessions. The
+        # changed clients and games are pushed to them with the
+        # sequence number.
         self.manager_client = None
+        self.manager_sessions = dict() # fid -> PushSession
+        self.status_seq = 0
 
-        # Set the logging file.
-        self.logger = self.get_and_setup_logging(
-                          "master.MasterSocket",
-                          "log.txt",
-                          sys.stdout
-                      )
+        # The observers watch the live games.
+        self.observers = ObserverHub(config.OBSERVER_BUFFER)
+
+        # Check the network connection of waiting engines.
+        self.heartbeat = HeartbeatScheduler(
+                             config.HEARTBEAT_INTERVAL,
+                             config.HEARTBEAT_TIMEOUT,
+                             config.HEARTBEAT_MAX_MISSES
+                         )
+
+        # Set the logging file. The master and workers push the
+        # records onto the queue of listener.
+        self.log_listener = LogListener(config.LOG_FILE, sys.stdout)
+        self.logger = get_logger("master.MasterSocket", self.log_listener.queue)
+
+        # Export the server status. The HTTP server only reads the
+        # registry in its own thread.
+        self.metrics = self.get_and_setup_metrics()
+        self.metrics_clock_time = 0
+        self.games_window = RateWindow(3600)
+        self.moves_window = RateWindow(60)
+        self.latency = LatencyRecorder()
+        self.server_sock = None # The engine port. It is bound below.
+        self.metrics_server = None
+        if config.METRICS_PORT is not None:
+            self.metrics_server = MetricsServer(
+                                      self.metrics,
+                                      config.METRICS_HOST,
+                                      config.METRICS_PORT
+                                  )
 
         # Make the SGF and HTML root directories. We will save
         # all match games under them.
@@ -57,72 +135,816 @@ class MasterSocket:
         check_and_mkdir(self.data_root)
         check_and_mkdir(self.sgf_root)
         check_and_mkdir(self.html_root)
+        self.trace_root = os.path.join(self.data_root, "trace")
+        if config.GAME_TRACE:
+            check_and_mkdir(self.trace_root)
+
+        # The profile results are saved under here.
+        self.profile_root = os.path.join(self.data_root, "profile")
+        check_and_mkdir(self.profile_root)
+        self.profiler = None
+
+        # The viewers follow the live games by the HTTP server. Their
+        # streams are the sessions of observer hub.
+        self.live_server = None
+        if config.HTTP_PORT is not None:
+            self.live_server = LiveServer(
+                                   config.HTTP_HOST,
+                                   config.HTTP_PORT,
+                                   self.data_root,
+                                   config.WGO_PATH,
+                                   config.HTTP_MAX_EVENTS,
+                                   config.HTTP_CACHE_SECONDS
+                               )
+
+        # The matches submitted by API wait in 'pending_matches' until
+        # their engines are waiting. The interrupted games restored
+        # from snapshot wait here too. The 'recent_results' keeps the
+        # last finished games for API.
+        self.pending_matches = collections.deque()
+        self.next_match_id = 0
+
+        # The match series submit their games into the pending queue.
+        self.series_pool = dict() # series id -> MatchSeries
+        self.next_series_id = 0
+
+        # The ratings are updated as the games finish and fitted
+        # again periodically from the cached counts.
+        self.rating = RatingBook(
+                          os.path.join(self.data_root, config.RATING_FILE),
+                          config.RATING_INITIAL,
+                          config.RATING_RD_INITIAL,
+                          config.RATING_RD_MIN,
+                          config.RATING_RD_PER_DAY,
+                          config.RATING_PRIOR_GAMES
+                      )
+        if self.rating.load():
+            self.logger.info("Load the ratings of {} game(s).".format(self.rating.games))
+        self.rating_clock_time = time.time()
+
+        # Pair the free engines automatically if it is on.
+        self.auto_pairing = config.AUTO_PAIRING
+        self.pairing = PairingScheduler(
+                           config.PAIRING_INTERVAL,
+                           config.PAIRING_HISTORY,
+                           config.PAIRING_POLICY,
+                           config.PAIRING_REPEAT_PENALTY,
+                           config.PAIRING_NEIGHBORS
+                       )
+
+        # The engines with the same name are one pool.
+        self.pools = EnginePools()
+
+        # The pending matches are started by priority and fair share.
+        self.scheduler = FairShareScheduler(
+                             config.SUBMITTER_WEIGHTS,
+                             config.POOL_WEIGHTS,
+                             config.FAIR_SHARE_HALF_LIFE,
+                             config.PRIORITY_AGEING
+                         )
+
+        # The playing engines of one host can not cost more than
+        # its budget. The pending matches waiting for the budget are
+        # logged once.
+        self.budgets = HostBudgets(config.HOST_BUDGETS, config.DEFAULT_HOST_BUDGET)
+        self.budget_deferred = set() # match ids
+        self.recent_results = collections.deque(maxlen=config.API_MAX_RESULTS)
+        self.next_result_seq = 0
+
+        # Save the master state periodically.
+        self.snapshot_path = os.path.join(self.data_root, config.SNAPSHOT_FILE)
+        self.snapshot_clock_time = time.time()
+        self.last_snapshot = None
 
         # Allocate the process(s).
         num_workers = config.NUM_WORKERS
         if num_workers is None:
             # TODO: Should I leave one core for master?
             num_workers = os.cpu_count()
-        for i in range(max(num_workers, 1)):
-            pid = i
-            self.ready_queue_pool.append(mp.Queue())
-            p = mp.Process(
-                    target=match_loop,
-                    args=(pid, self.ready_queue_pool[pid], self.finished_queue, ),
-                    daemon=True
-                )
-            p.start()
-            self.process_pool.append(
-                { 
-                    "proc" : p,  # The process.
-                    "load" : 0,  # The number of running games.
-                    "pid"  : pid # The process id.
-                }
-            )
+        self.min_workers = max(config.MIN_WORKERS, 1)
+        self.max_workers = config.MAX_WORKERS
+        if self.max_workers is None:
+            self.max_workers = max(os.cpu_count(), num_workers)
+        self.max_workers = max(self.max_workers, self.min_workers)
+        num_workers = min(max(num_workers, self.min_workers), self.max_workers)
+        for _ in range(num_workers):
+            self.spawn_process()
 
         # Build the master socket.
         self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Allow to bind the port again right after restart.
+        self.server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_sock.bind(("", config.SERVER_PORT))
-        self.server_sock.listen(10)
+        self.server_sock.listen(config.LISTEN_BACKLOG)
+        self.server_sock.setblocking(False)
         self.logger.info("The client is ready.")
 
-    def get_and_setup_logging(self, name, out_file, out_io):
-        logger = logging.getLogger(name)
-        logger.setLevel(logging.DEBUG)
-
-        # Log debug output to file
-        handler = logging.FileHandler(out_file)
-        handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter("%(asctime)s - %(levelname)s: %(message)s")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-
-        # Log info output to console
-        handler = logging.StreamHandler(out_io)
-        handler.setLevel(logging.INFO)
-        formatter = logging.Formatter("%(asctime)s: %(message)s")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-        return logger
-
-    def fill_waiting_clients(self):
-        # Gather the waiting clients for pool and fill
-        # it into 'waiting_clients'.
-        self.waiting_clients.clear()
-        for k, v in self.client_pool.items():
-            if v["socket"].type == "engine" and \
-                v["status"] == "waiting":
-                self.waiting_clients.add(k)
-
-    def parse_queries(self, raw_queries, commands_queue):
+    def get_listening_sockets(self):
+        # The forked worker inherits the listening sockets. It closes
+        # them at once, so the ports are free after the master is gone.
+        socks = list()
+        if self.server_sock is not None:
+            socks.append(self.server_sock)
+        if self.metrics_server is not None:
+            socks.append(self.metrics_server.httpd.socket)
+        if self.live_server is not None:
+            socks.append(self.live_server.httpd.socket)
+        return socks
+
+    def spawn_process(self):
+        # Start a new worker process with its own ready queue
+        # and socket channel. Return the process id.
+        pid = self.next_pid
+        self.next_pid += 1
+
+        self.ready_queue_pool[pid] = mp.Queue()
+        channel, worker_channel = create_channel()
+        p = mp.Process(
+                target=match_loop,
+                args=(pid,
+                      self.ready_queue_pool[pid],
+                      self.finished_queue,
+                      self.event_queue,
+                      worker_channel,
+                      self.log_listener.queue,
+                      self.get_listening_sockets(), ),
+                daemon=True
+            )
+        p.start()
+        worker_channel.close()
+        self.process_pool[pid] = {
+            "proc"    : p,          # The process.
+            "load"    : 0,          # The number of running games.
+            "pid"     : pid,        # The process id.
+            "channel" : channel,    # Hand the client sockets over via it.
+            "idle"    : time.time() # Since when the process has no game.
+        }
+        return pid
+
+    def retire_process(self, pid):
+        # Remove the process from pool. The sockets held by it
+        # are still alive in master, so the clients only lose
+        # their owner.
+        p = self.process_pool.pop(pid)
+        q = self.ready_queue_pool.pop(pid)
+        for v in self.client_pool.values():
+            if v["socket"].owner == pid:
+                v["socket"].owner = None
+        try:
+            p["channel"].close()
+        except:
+            pass
+        if p["proc"].is_alive():
+            # Let the process finish its loop by itself.
+            q.put({ "type" : "quit" })
+            self.retired_processes.append(p["proc"])
+
+    def handle_processes(self):
+        # Supervise the worker processes. Respawn the crashed
+        # processes and scale the pool with the current games.
+        now = time.time()
+        if now - self.supervise_clock_time < config.SUPERVISE_INTERVAL:
+            return
+        self.supervise_clock_time = now
+
+        # Join the retired processes.
+        self.retired_processes = [ proc for proc in self.retired_processes if proc.is_alive() ]
+
+        for pid in list(self.process_pool.keys()):
+            p = self.process_pool[pid]
+            if p["proc"].is_alive():
+                continue
+            outs_info = "The process {} is dead (exit code {}).".format(
+                            pid, p["proc"].exitcode
+                        )
+            self.logger.info(outs_info, extra={ "event" : "process_dead", "pid" : pid })
+            self.retire_process(pid)
+
+            # The games in the dead process are lost. The engines may
+            # still wait for the reply, so we can not trust their
+            # states. Close them.
+            for gid in [ k for k, v in self.game_tasks.items() if v["pid"] == pid ]:
+                self.budgets.release(self.game_tasks.pop(gid).get("costs", list()))
+                for fid in list(self.client_index.get_playing(gid)):
+                    self.mark_crash(fid)
+                self.publish_event(gid, dump_event({ "e" : "lost", "gid" : gid }), True)
+                self.logger.info(
+                    "The match game {} is lost.".format(gid),
+                    extra={ "event" : "game_lost", "gid" : gid, "pid" : pid })
+
+        # Scale down the idle processes.
+        for pid in list(self.process_pool.keys()):
+            if len(self.process_pool) <= self.min_workers:
+                break
+            p = self.process_pool[pid]
+            if p["load"] == 0 and now - p["idle"] > config.WORKER_IDLE_SECONDS:
+                self.logger.info(
+                    "Retire the idle process {}.".format(pid),
+                    extra={ "event" : "process_retire", "pid" : pid })
+                self.retire_process(pid)
+
+        # Keep the minimum number of processes.
+        while len(self.process_pool) < self.min_workers:
+            pid = self.spawn_process()
+            self.logger.info(
+                "Spawn the process {}.".format(pid),
+                extra={ "event" : "process_spawn", "pid" : pid })
+
+    def get_and_setup_metrics(self):
+        metrics = Metrics()
+        metrics.declare("cgos_clients", "gauge", "The connected clients by type and status.")
+        metrics.declare("cgos_clients_crashed", "gauge", "The crashed clients waiting for removal.")
+        metrics.declare("cgos_heartbeat_pending", "gauge", "The unanswered heartbeat probes.")
+        metrics.declare("cgos_workers", "gauge", "The worker processes.")
+        metrics.declare("cgos_worker_games", "gauge", "The games in flight per worker.")
+        metrics.declare("cgos_queue_depth", "gauge", "The messages waiting in the queues.")
+        metrics.declare("cgos_games_running", "gauge", "The games in flight.")
+        metrics.declare("cgos_games_per_hour", "gauge", "The finished games in the last hour.")
+        metrics.declare("cgos_moves_per_second", "gauge", "The moves per second in the last minute.")
+        metrics.declare("cgos_connections_total", "counter", "The accepted connections.")
+        metrics.declare("cgos_handshake_failures_total", "counter", "The failed handshakes.")
+        metrics.declare("cgos_handshake_timeouts_total", "counter", "The handshakes which timed out.")
+        metrics.declare("cgos_handshakes", "gauge", "The unfinished handshakes.")
+        metrics.declare("cgos_connections_waiting", "gauge", "The accepted connections waiting for the handshake.")
+        metrics.declare("cgos_admission_rejected_total", "counter", "The rejected connections by reason.")
+        metrics.declare("cgos_heartbeat_failures_total", "counter", "The clients closed by heartbeat.")
+        metrics.declare("cgos_games_started_total", "counter", "The started games.")
+        metrics.declare("cgos_games_finished_total", "counter", "The finished games by result type.")
+        metrics.declare("cgos_moves_total", "counter", "The played moves.")
+        metrics.declare("cgos_pending_matches", "gauge", "The pending matches by priority class.")
+        metrics.declare("cgos_budget_deferred_total", "counter", "The games deferred by the host budgets.")
+        metrics.declare("cgos_host_cost", "gauge", "The reserved cost of the playing engines per host.")
+        for name in ["cgos_connections_total",
+                     "cgos_handshake_failures_total",
+                     "cgos_handshake_timeouts_total",
+                     "cgos_heartbeat_failures_total",
+                     "cgos_games_started_total",
+                     "cgos_budget_deferred_total",
+                     "cgos_moves_total"]:
+            # Export the counters without label from zero.
+            metrics.inc(name, 0)
+        return metrics
+
+    def handle_master_profile(self, action, mode):
+        if action == "start":
+            if self.profiler is not None:
+                self.logger.info("The master profiler is running.")
+                return
+            if mode is None:
+                mode = "cprofile"
+            self.profiler = create_profiler(mode, config.PROFILE_SAMPLE_INTERVAL)
+            if self.profiler is None:
+                self.logger.info("Unknown profiler {}.".format(mode))
+                return
+            self.profiler.start()
+            self.logger.info("Start the master {} profiler.".format(mode))
+        else:
+            if self.profiler is None:
+                self.logger.info("The master profiler is not running.")
+                return
+            path = get_profile_path(self.profile_root, "master", self.profiler)
+            self.profiler.stop(path)
+            self.profiler = None
+            self.logger.info("Save the master profile to {}.".format(path))
+
+    def mark_crash(self, fid):
+        # The client should be removed later.
+        c = self.client_pool.get(fid, None)
+        if c is not None:
+            self.client_index.mark_crash(fid, c)
+
+    def submit_match(self, black, white, setting, expire=None, resume=None, series=None,
+                           priority=None, submitter=None):
+        # Push the match into pending queue. The players are the dicts
+        # with 'fid' and 'name'. Either one is given. The 'series' is
+        # [series id, game index] for the game of series. Return the
+        # match id. The 'opening' of setting may be the path of the
+        # opening book. Raise ValueError if there is no opening or the
+        # priority class is unknown.
+        if priority is None:
+            priority = config.DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError("Unknown priority {}.".format(priority))
+        if isinstance(setting.get("opening", None), str):
+            setting["opening"] = load_opening_book(setting["opening"]).choose(config.OPENING_ORDER)
+        for p in [black, white]:
+            if p["fid"] is not None and p["name"] is None:
+                c = self.client_pool.get(p["fid"], None)
+                if c is not None:
+                    p["name"] = c["socket"].name
+        match = {
+            "match_id"  : self.next_match_id,
+            "black"     : black,
+            "white"     : white,
+            "setting"   : setting,
+            "expire"    : expire,
+            "resume"    : resume,
+            "series"    : series,
+            "priority"  : priority,
+            "submitter" : submitter or "console",
+            "submitted" : time.time()
+        }
+        self.next_match_id += 1
+        self.pending_matches.append(match)
+        return match["match_id"]
+
+    def cancel_match(self, match_id):
+        for m in self.pending_matches:
+            if m["match_id"] == match_id:
+                self.pending_matches.remove(m)
+                self.budget_deferred.discard(match_id)
+                return True
+        return False
+
+    def get_match_record(self, match):
+        return {
+            "match_id"  : match["match_id"],
+            "black"     : dict(match["black"]),
+            "white"     : dict(match["white"]),
+            "setting"   : dict(match["setting"]),
+            "expire"    : match["expire"],
+            "resume"    : match["resume"],
+            "series"    : match.get("series", None),
+            "priority"  : match["priority"],
+            "submitter" : match["submitter"],
+            "submitted" : match["submitted"]
+        }
+
+    def get_waiting_fid(self, player, exclude):
+        # Find the waiting engine for the player. The fid is fixed
+        # if it is given. Otherwise select any engine with the name.
+        waiting = self.client_index.waiting
+        if player["fid"] is not None:
+            fid = player["fid"]
+            if fid in waiting and fid not in exclude:
+                return fid
+            return None
+        return self.pools.pick(self.client_index.get_fids_by_name(player["name"]), waiting, exclude)
+
+    def dispatch_match(self, match):
+        # Return True if the match game is started.
+        fids = list()
+        for player in [match["black"], match["white"]]:
+            fid = self.get_waiting_fid(player, fids)
+            if fid is None:
+                return False
+            fids.append(fid)
+
+        task = {
+            "type"      : "match",
+            "black"     : fids[0],
+            "white"     : fids[1],
+            "gid"       : self.last_game_id,
+            "match_id"  : match["match_id"],
+            "priority"  : match["priority"],
+            "submitter" : match["submitter"],
+            "submitted" : match["submitted"]
+        }
+        task.update(match["setting"])
+        if match.get("series", None) is not None:
+            task["series"] = match["series"]
+        if not self.try_push_task(task):
+            return False
+        if match["resume"] is not None:
+            self.logger.info(
+                "Resume the match game {} as game {}.".format(match["resume"], task["gid"]),
+                extra={ "event" : "resume", "gid" : task["gid"] })
+        return True
+
+    def handle_pending_matches(self):
+        # Start the pending matches by priority and fair share. See
+        # 'fairshare.py'. The match whose engines are busy does not
+        # block the others.
+        if len(self.pending_matches) == 0:
+            return
+        now = time.time()
+        removed = set()
+        for m in self.pending_matches:
+            if m["expire"] is not None and now > m["expire"]:
+                self.logger.info(
+                    "Drop the pending match {}, {}(B) vs {}(W).".format(
+                        m["match_id"], m["black"]["name"], m["white"]["name"]))
+                removed.add(m["match_id"])
+            elif any([ p["fid"] is not None and p["fid"] not in self.client_pool
+                           for p in [m["black"], m["white"]] ]):
+                # The given client is closed. It never comes back.
+                self.logger.info("Cancel the pending match {}, the client is closed.".format(m["match_id"]))
+                removed.add(m["match_id"])
+
+        if len(self.client_index.waiting) >= 2:
+            candidates = [ m for m in self.pending_matches if m["match_id"] not in removed ]
+            for m in self.scheduler.order(candidates, now):
+                if len(self.client_index.waiting) < 2:
+                    break
+                if self.dispatch_match(m):
+                    self.scheduler.charge(m, now)
+                    removed.add(m["match_id"])
+        if len(removed) > 0:
+            self.budget_deferred -= removed
+            self.pending_matches = collections.deque(
+                                       [ m for m in self.pending_matches if m["match_id"] not in removed ])
+
+    def create_series(self, a, b, games, setting, concurrency=1, openings=None, sprt=None, opening_order=None,
+                            priority=None, submitter=None):
+        # Return the series id. The 'sprt' is the dict of SPRT
+        # parameters or None. Raise ValueError if the setting is
+        # invalid.
+        if games <= 0 or concurrency <= 0:
+            raise ValueError("The games and concurrency should be positive.")
+        if priority is None:
+            priority = config.DEFAULT_PRIORITY
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError("Unknown priority {}.".format(priority))
+        if isinstance(setting.get("opening", None), str):
+            openings = setting.pop("opening") if openings is None else openings
+        if opening_order is None:
+            opening_order = config.OPENING_ORDER
+        if opening_order not in OPENING_ORDERS:
+            raise ValueError("Unknown opening order {}.".format(opening_order))
+        for p in [a, b]:
+            if p["fid"] is not None:
+                c = self.client_pool.get(p["fid"], None)
+                if c is None or c["socket"].type != "engine":
+                    raise ValueError("There is no engine {}.".format(p["fid"]))
+                p["name"] = c["socket"].name
+        store = setting.get("store", None)
+        if store is not None and \
+               any([ v == "." or v == ".." for v in store.split(os.sep) ]):
+            raise ValueError("Invalid store path {}.".format(store))
+        if sprt is not None:
+            sprt = Sprt(
+                       float(sprt["elo0"]),
+                       float(sprt["elo1"]),
+                       float(sprt.get("alpha", config.SPRT_ALPHA)),
+                       float(sprt.get("beta", config.SPRT_BETA)),
+                       sprt.get("model", config.SPRT_MODEL)
+                   )
+        series = MatchSeries(
+                     self.next_series_id, a, b, games,
+                     setting, concurrency, openings, sprt, opening_order,
+                     priority, submitter or "console"
+                 )
+        self.series_pool[series.series_id] = series
+        self.next_series_id += 1
+        self.logger.info("Start the series {}, {}.".format(series.series_id, series.get_summary()))
+        if series.book is not None:
+            self.logger.info("The opening book {} has {} opening(s), {} rejected.".format(
+                                 openings, len(series.book), series.book.rejected))
+        return series.series_id
+
+    def stop_series(self, series_id, reason):
+        # Stop submitting the games. The running games go on.
+        series = self.series_pool.get(series_id, None)
+        if series is None:
+            return False
+        series.stop(reason)
+        for index, match_id in list(series.inflight.items()):
+            if self.cancel_match(match_id):
+                series.inflight.pop(index)
+        self.logger.info("Stop the series {}, {}.".format(series_id, series.get_summary()))
+        return True
+
+    def handle_series(self):
+        # Submit the next games of series. The game which is gone
+        # without result is played again.
+        if len(self.series_pool) == 0:
+            return
+        pending_ids = set([ m["match_id"] for m in self.pending_matches ])
+        running_ids = set([ t.get("match_id", None) for t in self.game_tasks.values() ])
+        for series_id, series in self.series_pool.items():
+            if series.done():
+                continue
+            for p in series.players:
+                # Stop it once. The games in flight may go on.
+                if series.stopped is None and \
+                       p["fid"] is not None and p["fid"] not in self.client_pool:
+                    self.stop_series(series_id, "the client is closed")
+            for index, match_id in list(series.inflight.items()):
+                if match_id not in pending_ids and match_id not in running_ids:
+                    series.lose(index)
+            for index, black, white, setting in series.next_games():
+                match_id = self.submit_match(
+                               black, white, setting, series=[series_id, index],
+                               priority=series.priority, submitter=series.submitter)
+                series.set_match_id(index, match_id)
+
+    def add_series_result(self, task, result):
+        series_id, index = task["series"]
+        series = self.series_pool.get(series_id, None)
+        if series is None:
+            return
+        series.add_result(index, result.get("info", None), result.get("type", None), result.get("moves", None))
+        if series.sprt is not None and series.stopped is None:
+            accepted = series.sprt.get_result()
+            if accepted is not None:
+                # Stop submitting once the test is over.
+                self.stop_series(series_id, "{} accepted".format(accepted))
+        self.logger.info(
+            "The series {} {}, {}.".format(
+                series_id, "is over" if series.done() else "goes on", series.get_summary()),
+            extra={ "event" : "series", "gid" : task["gid"] })
+
+    def parse_series_command(self, args):
+        # The 'args' is like ['eng_a', 'eng_b', '400', 'bsize', '9'].
+        try:
+            a, b = [
+                { "fid" : int(v), "name" : None } if v.isdigit() else { "fid" : None, "name" : v }
+                for v in args[0:2]
+            ]
+            games = int(args[2])
+            setting = dict()
+            concurrency = 1
+            openings = None
+            opening_order = None
+            priority = None
+            submitter = None
+            sprt = dict()
+            for field, value in zip(args[3::2], args[4::2]):
+                if field == "mtime":
+                    setting["main_time"] = int(value)
+                elif field == "bsize":
+                    setting["board_size"] = int(value)
+                elif field == "komi":
+                    setting["komi"] = float(value)
+                elif field == "rule":
+                    setting["rule"] = value
+                elif field == "store":
+                    setting["store"] = value
+                elif field == "openings":
+                    openings = value
+                elif field == "order":
+                    opening_order = value
+                elif field == "priority":
+                    priority = value
+                elif field == "submitter":
+                    submitter = value
+                elif field == "concurrency":
+                    concurrency = int(value)
+                elif field in ["elo0", "elo1", "alpha", "beta", "model"]:
+                    sprt[field] = value
+                else:
+                    raise ValueError("Unknown field {}.".format(field))
+            if len(sprt) == 0:
+                sprt = None
+            elif "elo0" not in sprt or "elo1" not in sprt:
+                raise ValueError("The SPRT needs both elo0 and elo1.")
+            self.create_series(
+                a, b, games, setting, concurrency, openings, sprt, opening_order, priority, submitter)
+        except (IndexError, ValueError) as e:
+            self.logger.info("Invalid series command. {}".format(e))
+
+    def handle_pairing(self):
+        # Pair all free engines every round. The engines kept by
+        # the pending matches are not free.
+        now = time.time()
+        if not self.auto_pairing or not self.pairing.due(now):
+            return
+        if len(self.client_index.waiting) < 2:
+            return
+        for black_fid, white_fid in self.pairing.make_pairs(self.get_free_engines(), now, self.rating):
+            task = {
+                "type"  : "match",
+                "black" : black_fid,
+                "white" : white_fid,
+                "gid"   : self.last_game_id
+            }
+            task.update(config.PAIRING_SETTING)
+            self.try_push_task(task)
+
+    def get_free_engines(self):
+        # Return the list of (fid, name) of the waiting engines which
+        # are not kept by the pending matches.
+        reserved_fids = set()
+        reserved_names = set()
+        for m in self.pending_matches:
+            for p in [m["black"], m["white"]]:
+                if p["fid"] is not None:
+                    reserved_fids.add(p["fid"])
+                else:
+                    reserved_names.add(p["name"])
+
+        engines = list()
+        for fid in self.client_index.waiting:
+            c = self.client_pool[fid]["socket"]
+            if c.type != "engine" or c.crash or \
+                   fid in reserved_fids or c.name in reserved_names:
+                continue
+            free = self.budgets.get_free(c.host)
+            if free is not None and c.cost > free:
+                continue
+            engines.append((fid, c.name))
+        return engines
+
+    def get_interrupted_record(self, task):
+        # The running game is interrupted if the server restarts.
+        # Continue it from the SGF file saved by the worker.
+        setting = dict()
+        for k in ["main_time", "board_size", "komi", "sgf", "opening", "store", "rule"]:
+            if k in task:
+                setting[k] = task[k]
+        store = task.get("store", None)
+        if store is None:
+            store = config.DEFAULT_STORE_DIR
+        record = {
+            "match_id"   : task.get("match_id", None),
+            "black"      : { "fid" : None, "name" : task["black_name"] },
+            "white"      : { "fid" : None, "name" : task["white_name"] },
+            "setting"    : setting,
+            "expire"     : None,
+            "resume"     : task["gid"],
+            "priority"   : task.get("priority", config.DEFAULT_PRIORITY),
+            "submitter"  : task.get("submitter", "console"),
+            "submitted"  : task.get("submitted", None),
+            "series"     : task.get("series", None),
+            "resume_sgf" : os.path.join(
+                               self.sgf_root, store,
+                               "{}.sgf".format(get_base_name(
+                                   task["date"], task["black_name"], task["white_name"], task["gid"])))
+        }
+        return record
+
+    def get_snapshot_command(self, cmd):
+        # The fids are reassigned after restart. Give the engines of
+        # the pending commands by name, so they are matched with the
+        # same engines again. Return None if the command can not be
+        # kept.
+        args = cmd.split()
+        if len(args) == 0:
+            return None
+        if args[0] == "close":
+            return None
+        if args[0] == "match" and args[1:2] == ["fid"]:
+            names = self.get_snapshot_names(args[2:4])
+            if names is None:
+                return None
+            return " ".join(["match", "pool"] + names + args[4:])
+        if args[0] == "series" and args[1:2] != ["stop"]:
+            names = self.get_snapshot_names(args[1:3])
+            if names is None:
+                return None
+            return " ".join(["series"] + names + args[3:])
+        return cmd
+
+    def get_snapshot_names(self, players):
+        # Return the names of the players given by fid or name.
+        names = list()
+        for v in players:
+            if not v.isdigit():
+                names.append(v)
+                continue
+            c = self.client_pool.get(int(v), None)
+            if c is None or c["socket"].name is None or c["socket"].name.isdigit():
+                return None
+            names.append(c["socket"].name)
+        if len(names) != 2:
+            return None
+        return names
+
+    def save_snapshot(self, commands_queue):
+        # Only write the file when the state is changed.
+        if config.SNAPSHOT_INTERVAL is None:
+            return
+        matches = [ self.get_interrupted_record(task) for task in self.game_tasks.values() ]
+        matches.extend([ self.get_match_record(m) for m in self.pending_matches ])
+        state = {
+            "version"       : SNAPSHOT_VERSION,
+            "last_game_id"  : self.last_game_id,
+            "next_match_id" : self.next_match_id,
+            "commands"      : [ c for c in map(self.get_snapshot_command, commands_queue)
+                                    if c is not None ],
+            "matches"       : matches,
+            "next_series_id" : self.next_series_id,
+            "series"        : [ s.get_state() for s in self.series_pool.values() ]
+        }
+        data = dump_snapshot(state)
+        if data == self.last_snapshot:
+            return
+        try:
+            save_snapshot(self.snapshot_path, data)
+            self.last_snapshot = data
+        except OSError:
+            self.logger.info("Can not save the snapshot {}.".format(self.snapshot_path))
+
+    def restore_snapshot(self, commands_queue):
+        # Warm restart from the last snapshot. Restore the ids, the
+        # pending commands and the pending matches. The fids are
+        # invalid after restart, so the matches wait for the engines
+        # with the same names.
+        if config.SNAPSHOT_INTERVAL is None:
+            return
+        state = load_snapshot(self.snapshot_path)
+        if state is None:
+            return
+        now = time.time()
+        self.last_game_id = max(self.last_game_id, state["last_game_id"])
+        self.next_match_id = max(self.next_match_id, state["next_match_id"])
+        # No engine is connected yet. The commands with fids from the
+        # old snapshots are dropped.
+        commands = [ c for c in map(self.get_snapshot_command, state["commands"]) if c is not None ]
+        commands_queue[:0] = commands
+
+        self.next_series_id = max(self.next_series_id, state.get("next_series_id", 0))
+        for s in state.get("series", list()):
+            series = self.restore_series(s)
+            if series is not None:
+                self.series_pool[series.series_id] = series
+
+        for m in state["matches"]:
+            series_id, index = m.get("series", None) or [None, None]
+            series = self.series_pool.get(series_id, None)
+            if series is None or index not in series.inflight:
+                m["series"] = None
+            m.setdefault("priority", config.DEFAULT_PRIORITY)
+            m.setdefault("submitter", "console")
+            if m.get("submitted", None) is None:
+                m["submitted"] = now
+            for p in [m["black"], m["white"]]:
+                p["fid"] = None
+            if m["black"]["name"] is None or m["white"]["name"] is None:
+                continue
+            resume_sgf = m.pop("resume_sgf", None)
+            if m["resume"] is not None:
+                if resume_sgf is not None and os.path.isfile(resume_sgf):
+                    m["setting"]["sgf"] = resume_sgf
+                m["expire"] = now + config.RESTORE_TIMEOUT
+            if m["series"] is not None:
+                # The other games in flight are played again.
+                series.set_match_id(index, m["match_id"])
+            self.pending_matches.append(m)
+        self.logger.info(
+            "Restore the snapshot, last game id {}, {} command(s), {} match(es) and {} series.".format(
+                self.last_game_id, len(commands), len(self.pending_matches), len(self.series_pool)),
+            extra={ "event" : "restore" })
+
+    def restore_series(self, state):
+        # Return the series from the snapshot state or None. The
+        # players are matched by name like the restored matches.
+        sprt = None
+        if state["sprt"] is not None:
+            r = state["sprt"]
+            sprt = Sprt(r["elo0"], r["elo1"], r["alpha"], r["beta"], r["model"])
+        a, b = [ { "fid" : None, "name" : state[k]["name"] } for k in ["a", "b"] ]
+        try:
+            series = MatchSeries(
+                         state["series_id"], a, b, state["games"],
+                         state["setting"], state["concurrency"], state["openings"], sprt,
+                         state["opening_order"], state["priority"], state["submitter"]
+                     )
+            series.set_state(state)
+        except ValueError as e:
+            self.logger.info("Can not restore the series {}. {}".format(state["series_id"], e))
+            return None
+        return series
+
+    def handle_snapshot(self, commands_queue):
+        # Save the snapshot periodically.
+        now = time.time()
+        if config.SNAPSHOT_INTERVAL is not None and \
+               now - self.snapshot_clock_time >= config.SNAPSHOT_INTERVAL:
+            self.snapshot_clock_time = now
+            self.save_snapshot(commands_queue)
+
+    def handle_rating(self, force=False):
+        # Fit the batch ratings again and save them periodically.
+        now = time.time()
+        if not force and now - self.rating_clock_time < config.RATING_BATCH_INTERVAL:
+            return
+        self.rating_clock_time = now
+        if self.rating.dirty:
+            self.rating.recompute()
+            self.logger.info(
+                "Recompute the ratings of {} engine(s) in {:.1f} ms.".format(
+                    len(self.rating.players), 1000 * (time.time() - now)),
+                extra={ "event" : "rating", "latency" : time.time() - now })
+        try:
+            self.rating.save()
+        except OSError as e:
+            self.logger.info("Can not save the ratings, {}.".format(e))
+
+    def reply_manager(self, manager, kind, outputs):
+        # The lazy manager reads the reply right now. The push
+        # mode manager reads it from the buffer.
+        line = "{} {}".format(kind, outputs)
+        session = self.manager_sessions.get(manager.fid, None)
+        if session is not None:
+            session.write(line)
+        else:
+            manager.send(line)
+
+    def parse_queries(self, raw_queries, commands_queue, manager):
         # Parse the queries from manager. The master (server)
         # will do the queries.
-        if self.manager_client is None:
-            return
         if len(raw_queries) == 0:
             return
 
-        queries = json.loads(raw_queries)
+        try:
+            queries = json.loads(raw_queries)
+        except ValueError:
+            self.logger.info("Invalid queries from manager {}.".format(manager.fid))
+            return
+        if not isinstance(queries, dict):
+            self.logger.info("Invalid queries from manager {}.".format(manager.fid))
+            return
         for k, v in queries.items():
             if k == "client_status":
                 # Return the status of clients to manager.
@@ -136,31 +958,384 @@ class MasterSocket:
                         "gid"    : "{}".format(vv["gid"])
                     }
                 outputs = json.dumps(outputs, indent=None, separators=(',', ':'))
-                self.manager_client.request_client_status(outputs)
+                self.reply_manager(manager, "client_status", outputs)
             elif k == "command":
                 # 'v' is command. See the 'handle_command()' section.
+                if manager.role != "admin":
+                    self.logger.info("The monitor {} can not send the command.".format(manager.fid))
+                    continue
                 command = v
                 commands_queue.append(command)
+            elif k == "api":
+                # 'v' is the batch of API requests. See the 'api.py'.
+                responses = handle_api(self, v, manager.role, manager.name or None)
+                outputs = json.dumps(responses, indent=None, separators=(',', ':'))
+                self.reply_manager(manager, "api_response", outputs)
+            elif k == "resync":
+                # The push mode manager misses some deltas. Send
+                # the full status again.
+                session = self.manager_sessions.get(manager.fid, None)
+                if session is not None:
+                    session.synced = False
             else:
                 # Unknown query.
                 pass
 
     def handle_manager(self, commands_queue):
-        if self.manager_client is None:
+        if self.manager_client is not None:
+            try:
+                # Because the manager is lazy client, we need
+                # to request the manager for queries.
+                self.manager_client.create_sockfile()
+                self.parse_queries(
+                    self.manager_client.request_queries(),
+                    commands_queue,
+                    self.manager_client
+                )
+                self.manager_client.close_sockfile()
+            except ClientSocketError as e:
+                # Manager is closed
+                self.mark_crash(self.manager_client.fid)
+
+        for fid, session in self.manager_sessions.items():
+            # The push mode managers send the queries at any
+            # time. Do not wait for them.
+            try:
+                for line in session.read_lines():
+                    self.parse_queries(line, commands_queue, session.client)
+            except ClientSocketError as e:
+                self.mark_crash(fid)
+        self.push_status()
+
+    def send_watch(self, gid, on):
+        # Ask the worker to publish the game events or not.
+        task = self.game_tasks.get(gid, None)
+        if task is None or task["pid"] not in self.ready_queue_pool:
             return
+        self.ready_queue_pool[task["pid"]].put(
+            {
+                "type" : "watch",
+                "gid"  : gid,
+                "on"   : on
+            }
+        )
 
+    def parse_observer_command(self, fid, line):
+        args = line.split()
+        if len(args) == 0:
+            return
         try:
-            # Because the manager is lazy client, we need
-            # to request the manager for queries. 
-            self.manager_client.create_sockfile()
-            self.parse_queries(
-                self.manager_client.request_queries(),
-                commands_queue
-            )
-            self.manager_client.close_sockfile()
-        except ClientSocketError as e:
-            # Manager is closed
+            if args[0] == "watch":
+                gid = int(args[1])
+                if gid not in self.game_tasks:
+                    self.observers.send(fid, dump_event({ "e" : "error", "msg" : "There is no game {}.".format(gid) }))
+                elif self.observers.watch(fid, gid):
+                    # The worker sends the sync event to the
+                    # new watcher.
+                    self.send_watch(gid, True)
+            elif args[0] == "unwatch":
+                gid = int(args[1])
+                if self.observers.unwatch(fid, gid):
+                    self.send_watch(gid, False)
+            elif args[0] == "list":
+                games = [
+                    { "gid" : gid, "black" : task["black_name"], "white" : task["white_name"] }
+                    for gid, task in self.game_tasks.items()
+                ]
+                self.observers.send(fid, dump_event({ "e" : "games", "games" : games }))
+            else:
+                self.observers.send(fid, dump_event({ "e" : "error", "msg" : "Unknown command {}.".format(args[0]) }))
+        except (IndexError, ValueError):
+            self.observers.send(fid, dump_event({ "e" : "error", "msg" : "Invalid command." }))
+
+    def drop_observer(self, fid):
+        # The observer clients are removed later. The live streams
+        # are removed now.
+        if fid in self.client_pool:
+            self.mark_crash(fid)
+            return
+        stream = self.observers.sessions.get(fid, None)
+        for gid in self.observers.remove(fid):
+            self.send_watch(gid, False)
+        if stream is not None:
+            stream.close()
+
+    def publish_event(self, gid, line, end):
+        # The live stream watches only one game, so it is closed
+        # after the last event.
+        watchers = list(self.observers.watchers.get(gid, set()))
+        for fid in self.observers.publish(gid, line, end):
+            self.drop_observer(fid)
+        if end:
+            for fid in watchers:
+                if fid not in self.client_pool:
+                    self.drop_observer(fid)
+
+    def handle_live_requests(self):
+        # Answer the requests of HTTP server threads.
+        if self.live_server is None:
+            return
+        for kind, arg in self.live_server.poll():
+            if kind == "games":
+                arg.put([
+                    { "gid" : gid, "black" : task["black_name"], "white" : task["white_name"] }
+                    for gid, task in self.game_tasks.items()
+                ])
+            elif kind == "watch":
+                stream = arg
+                self.observers.add_session(stream.key, stream)
+                if stream.gid not in self.game_tasks:
+                    stream.write(dump_event({ "e" : "error", "msg" : "There is no game {}.".format(stream.gid) }))
+                    self.drop_observer(stream.key)
+                elif self.observers.watch(stream.key, stream.gid):
+                    self.send_watch(stream.gid, True)
+            elif kind == "close":
+                if arg.key in self.observers.sessions:
+                    self.drop_observer(arg.key)
+
+    def handle_observers(self):
+        # Read the observer commands, fan the game events out and
+        # send the buffered lines. Never wait for the observers.
+        for fid, session in self.observers.sessions.items():
+            try:
+                for line in session.read_lines():
+                    self.parse_observer_command(fid, line)
+            except ClientSocketError:
+                self.mark_crash(fid)
+        self.handle_live_requests()
+
+        for _ in range(MAX_EVENTS_PER_TICK):
+            try:
+                gid, line, end = self.event_queue.get(block=True, timeout=0)
+            except queue.Empty:
+                break
+            self.publish_event(gid, line, end)
+
+        for fid in self.observers.flush():
+            self.drop_observer(fid)
+
+    def get_client_record(self, fid):
+        c = self.client_pool.get(fid, None)
+        if c is None:
+            return None
+        return {
+            "name"   : c["socket"].name,
+            "type"   : c["socket"].type,
+            "status" : c["status"],
+            "gid"    : c["gid"],
+            "pid"    : c["pid"]
+        }
+
+    def get_game_status(self, gid):
+        task = self.game_tasks.get(gid, None)
+        if task is None:
+            return None
+        return {
+            "pid"      : task["pid"],
+            "match_id" : task.get("match_id", None),
+            "black"    : { "fid" : task["black"], "name" : task["black_name"] },
+            "white"    : { "fid" : task["white"], "name" : task["white_name"] },
+            "date"     : task["date"]
+        }
+
+    def push_status(self):
+        # Push the changed clients and games to the push mode managers.
+        # The 'None' record means the client or game is removed. The
+        # full status carries the current sequence number, so the next
+        # delta is always 'seq + 1'. Both lines are serialized once
+        # and shared by all sessions.
+        dirty, dirty_games = self.client_index.pop_dirty()
+        delta_line = None
+        if len(dirty) > 0 or len(dirty_games) > 0:
+            self.status_seq += 1
+            delta = {
+                "seq"     : self.status_seq,
+                "clients" : { fid : self.get_client_record(fid) for fid in dirty },
+                "games"   : { gid : self.get_game_status(gid) for gid in dirty_games }
+            }
+            delta_line = "status_delta {}".format(
+                             json.dumps(delta, indent=None, separators=(',', ':'))).encode("utf-8")
+
+        full_line = None
+        for fid, session in self.manager_sessions.items():
+            try:
+                if not session.synced:
+                    if full_line is None:
+                        full = {
+                            "seq"     : self.status_seq,
+                            "clients" : { k : self.get_client_record(k) for k in self.client_pool.keys() },
+                            "games"   : { k : self.get_game_status(k) for k in self.game_tasks.keys() }
+                        }
+                        full_line = "status_full {}".format(
+                                        json.dumps(full, indent=None, separators=(',', ':'))).encode("utf-8")
+                    session.write(full_line)
+                    session.synced = True
+                elif delta_line is not None:
+                    session.write(delta_line)
+                session.flush()
+            except ClientSocketError:
+                self.mark_crash(fid)
+
+    def check_admission(self, host, now):
+        # Return the reason why the address can not start the handshake
+        # now or None. The rate is checked last because it takes the
+        # token.
+        if len(self.handshakes) >= config.MAX_HANDSHAKES:
+            return "handshakes"
+        if config.MAX_HANDSHAKES_PER_ADDR is not None and \
+               len([ h for h in self.handshakes.values() if h.addr == host ]) >= \
+                   config.MAX_HANDSHAKES_PER_ADDR:
+            return "address_handshakes"
+        if not self.rate_limiter.allow(host, now):
+            return "rate"
+        return None
+
+    def admit_waiting_connections(self, now):
+        # Start the handshakes of waiting connections in order. The
+        # later connections of a blocked address keep waiting, so each
+        # address is served in order.
+        blocked = set()
+        waiting = collections.deque()
+        while len(self.waiting_connections) > 0:
+            client_sock, host = self.waiting_connections.popleft()
+            if host in blocked:
+                waiting.append((client_sock, host))
+                continue
+            reason = self.check_admission(host, now)
+            if reason == "handshakes":
+                # No address can start now.
+                waiting.append((client_sock, host))
+                waiting.extend(self.waiting_connections)
+                self.waiting_connections.clear()
+                break
+            if reason is not None:
+                blocked.add(host)
+                waiting.append((client_sock, host))
+                continue
+            self.start_handshake(client_sock, host, now)
+        self.waiting_connections = waiting
+        self.metrics.set("cgos_connections_waiting", len(self.waiting_connections))
+
+    def start_handshake(self, client_sock, host, now):
+        try:
+            h = Handshake(
+                    client_sock,
+                    host,
+                    now + config.HANDSHAKE_TIMEOUT
+                )
+            self.handshakes[h.fid] = h
+        except HandshakeError:
+            self.metrics.inc("cgos_handshake_failures_total")
+            client_sock.close()
+
+    def accept_clients(self, now):
+        # Accept the new connections without waiting for them. The
+        # connection waits if its address connects too often or has
+        # too many unfinished handshakes. It is closed only if there
+        # are too many waiting connections.
+        for _ in range(MAX_ACCEPTS_PER_TICK):
+            try:
+                client_sock, addr = self.server_sock.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                self.logger.info("Can not accept the connection, {}.".format(e))
+                break
+            self.metrics.inc("cgos_connections_total")
+            fid = client_sock.fileno()
+            host = addr[0]
+
+            reason = None
+            if len([ h for _, h in self.waiting_connections if h == host ]) > 0:
+                # Keep the order of the address.
+                reason = "waiting"
+            else:
+                reason = self.check_admission(host, now)
+            if reason is None:
+                self.start_handshake(client_sock, host, now)
+            elif len(self.waiting_connections) < config.MAX_WAITING_CONNECTIONS:
+                self.waiting_connections.append((client_sock, host))
+            else:
+                self.metrics.inc("cgos_admission_rejected_total", reason=reason)
+                self.logger.info(
+                    "Reject the connection from {} ({}), too many waiting connections.".format(host, reason),
+                    extra={ "event" : "reject", "fid" : fid })
+                client_sock.close()
+        self.metrics.set("cgos_connections_waiting", len(self.waiting_connections))
+
+    def fail_handshake(self, fid, outs_info):
+        h = self.handshakes.pop(fid)
+        h.close()
+        self.metrics.inc("cgos_handshake_failures_total")
+        self.logger.info(outs_info, extra={ "event" : "handshake_failed", "fid" : fid })
+
+    def count_clients(self, client_type):
+        return sum([ v for (t, _), v in self.client_index.counts.items() if t == client_type ])
+
+    def add_client(self, h, now):
+        # The handshake is done. Get the client type here.
+        fid = h.fid
+        c = ClientSocket()
+        try:
+            protocol, username, password = h.lines
+            c.setup_handshake(h.sock, protocol, username, password)
+        except ClientSocketError:
             pass
+        c.unread = h.take_unread()
+        c.host = h.addr
+        if c.crash:
+            self.metrics.inc("cgos_handshake_failures_total")
+
+        if c.type == "engine" and not c.crash:
+            if config.MAX_ENGINES is not None and \
+                   self.count_clients("engine") >= config.MAX_ENGINES:
+                self.metrics.inc("cgos_admission_rejected_total", reason="engines")
+                c.crash = True
+
+        if c.type == "manager" and not c.crash:
+            if c.push and len(self.manager_sessions) < config.MAX_MANAGER_SESSIONS:
+                self.manager_sessions[fid] = PushSession(c, config.MANAGER_PUSH_BUFFER)
+            elif not c.push and self.manager_client is None:
+                self.manager_client = c
+            else:
+                # There are too many managers. Do not allow
+                # add the new manager.
+                self.metrics.inc("cgos_admission_rejected_total", reason="managers")
+                c.crash = True
+
+        if c.type == "observer" and not c.crash:
+            if len(self.observers.sessions) < config.MAX_OBSERVERS:
+                # The first line is the running games. The
+                # observer should wait for it before sending
+                # the commands.
+                self.observers.add(c)
+                self.parse_observer_command(fid, "list")
+            else:
+                self.metrics.inc("cgos_admission_rejected_total", reason="observers")
+                c.crash = True
+
+        # Allocate new client status.
+        self.client_pool[fid] = {
+            "socket" : c,
+            "status" : "waiting",
+            "gid"    : None, # game id
+            "gids"   : set(), # running game ids
+            "pid"    : None  # process id
+        }
+        self.client_index.add(fid, self.client_pool[fid])
+        if c.type == "engine":
+            self.pools.add_instance(c.name, fid)
+            budget = self.budgets.get_budget(c.host)
+            if budget is not None and c.cost > budget:
+                self.logger.info(
+                    "The socket {} costs {} but the budget of host {} is {}. It never plays.".format(
+                        fid, c.cost, c.host, budget))
+        if c.type == "engine" and not c.crash:
+            self.heartbeat.add(fid, now)
+        outs_info = "The socket {} (\"{}\") connects to the server.".format(
+                        fid, c.name
+                    )
+        self.logger.info(outs_info, extra={ "event" : "connect", "fid" : fid })
 
     def handle_clients(self):
         # Can only change the client connection status
@@ -168,89 +1343,129 @@ class MasterSocket:
         # the fids which we want to remove. We should close
         # these fids and clear the buffer here.
 
-        read_list = [self.server_sock]
+        # Check the network connection. Only probe the clients
+        # whose heartbeats are due. The probe does not wait for
+        # the reply. We collect it below or in the next ticks.
+        now = time.time()
+        probes, dead = self.heartbeat.poll(now)
+        for fid in dead:
+            c = self.client_pool.get(fid, None)
+            if c is not None:
+                outs_info = "The socket {} (\"{}\") missed {} heartbeats.".format(
+                                fid, c["socket"].name, self.heartbeat.max_misses
+                            )
+                self.logger.info(outs_info, extra={ "event" : "heartbeat_dead", "fid" : fid })
+                self.metrics.inc("cgos_heartbeat_failures_total")
+                self.mark_crash(fid)
+        for fid in probes:
+            c = self.client_pool.get(fid, None)
+            if c is None:
+                self.heartbeat.remove(fid)
+                continue
+            try:
+                c["socket"].send_probe()
+                self.heartbeat.sent(fid, now)
+            except ClientSocketError:
+                self.metrics.inc("cgos_heartbeat_failures_total")
+                self.mark_crash(fid)
+
+        # Also wait for the replies of heartbeat probes.
+        probe_socks = dict()
+        for fid in self.heartbeat.pending_fids():
+            c = self.client_pool.get(fid, None)
+            if c is not None:
+                probe_socks[c["socket"].sock] = fid
+
+        read_list = [self.server_sock] + list(probe_socks.keys())
+        read_list += [ h.sock for h in self.handshakes.values() ]
         readable, _, err = select.select(read_list, [], read_list, 0.1)
+        now = time.time()
 
         for s in err:
             # Some mistake in the client. Close it. 
             fid = s.fileno()
+            if fid in self.handshakes:
+                self.fail_handshake(fid, "The socket {} is broken.".format(fid))
+                continue
             c = self.client_pool.get(fid, None)
             if c is not None:
                 self.should_remove_fids.add(fid)
                 outs_info = "The socket {} (\"{}\") is closed.".format(
                                 fid, c["socket"].name
                             )
-                self.logger.info(outs_info)
+                self.logger.info(outs_info, extra={ "event" : "close", "fid" : fid })
 
         for s in readable:
-            if s is self.server_sock:
-                # New client connects to the server.
-                client_sock, _ = self.server_sock.accept()
-                fid = client_sock.fileno()
-                c = ClientSocket()
-
-                # Get the client type here.
-                c.setup_socket(client_sock)
-
-                if c.type == "manager":
-                    if self.manager_client is None:
-                        self.manager_client = c
-                    else:
-                        # There is a manager. Do not allow add the
-                        # new manager.
-                        c.crash = True
-
-                # Allocate new client status.
-                self.client_pool[fid] = {
-                    "socket" : c,
-                    "status" : "waiting",
-                    "gid"    : None, # game id
-                    "pid"    : None  # process id
-                }
-                outs_info = "The socket {} (\"{}\") connects to the server.".format(
-                                fid, c.name
-                            )
-                self.logger.info(outs_info)
-
-        self.fill_waiting_clients()
-        keys = list(self.waiting_clients)
-        if len(keys) >= 1:
-            # TODO: Need a better algorithm to select
-            #       sockets.
-
-            # Check the network connection.
-            random.shuffle(keys)
-            check_fid = keys[0]
-            c = self.client_pool.get(check_fid, None)
-            if c is not None:
-                c["socket"].create_sockfile()
-                c["socket"].request_poll()
-                c["socket"].close_sockfile()
+            if s in probe_socks:
+                # The reply of heartbeat probe.
+                fid = probe_socks[s]
+                c = self.client_pool[fid]["socket"]
+                try:
+                    if c.receive_probe() is not None:
+                        c.rtt = self.heartbeat.received(fid, now)
+                        if c.min_rtt is None or c.rtt < c.min_rtt:
+                            c.min_rtt = c.rtt
+                        self.latency.record("engine", c.name, "network", c.rtt)
+                        self.logger.debug(
+                            "The socket {} heartbeat rtt is {:.1f} ms.".format(fid, 1000 * c.rtt),
+                            extra={ "event" : "heartbeat", "fid" : fid, "latency" : c.rtt })
+                except ClientSocketError:
+                    self.mark_crash(fid)
+            elif s is self.server_sock:
+                # New clients connect to the server.
+                self.accept_clients(now)
+            elif s.fileno() in self.handshakes:
+                # The reply of handshake.
+                fid = s.fileno()
+                h = self.handshakes[fid]
+                try:
+                    if h.on_readable():
+                        self.handshakes.pop(fid)
+                        self.add_client(h, now)
+                except HandshakeError as e:
+                    self.fail_handshake(fid, "The socket {} handshake failed, {}.".format(fid, e.msg))
+
+        for fid in [ k for k, h in self.handshakes.items() if h.deadline < now ]:
+            self.metrics.inc("cgos_handshake_timeouts_total")
+            self.fail_handshake(fid, "The socket {} handshake timed out.".format(fid))
+        self.admit_waiting_connections(now)
+        self.metrics.set("cgos_handshakes", len(self.handshakes))
 
-        for fid, v in self.client_pool.items():
+        if now - self.rate_limiter_clock_time > 60:
+            self.rate_limiter.prune(now)
+            self.rate_limiter_clock_time = now
+
+        for fid in self.client_index.crashed:
             # Check the crashed socket.
-            c = v["socket"]
-            if c.crash:
-                outs_info = "The socket {} (\"{}\") was crashing.".format(
-                                c.fid, c.name
-                            )
-                self.logger.info(outs_info)
-                self.should_remove_fids.add(fid)
+            c = self.client_pool[fid]["socket"]
+            outs_info = "The socket {} (\"{}\") was crashing.".format(
+                            fid, c.name
+                        )
+            self.logger.info(outs_info, extra={ "event" : "crash", "fid" : fid })
+            self.should_remove_fids.add(fid)
 
         for fid in self.should_remove_fids:
             # Now close the correspond socket fids.
             c = self.client_pool.pop(fid, None)
+            self.heartbeat.remove(fid)
             if c is None:
                 continue
+            self.client_index.remove(fid, c)
+            if c["socket"].type == "engine":
+                self.pools.remove_instance(c["socket"].name, fid, c["status"] == "playing")
 
             # The fid is manager. Set the manager as NULL.
             if self.manager_client is not None:
                 if fid == self.manager_client.fid:
                     self.manager_client = None
+            self.manager_sessions.pop(fid, None)
+            for gid in self.observers.remove(fid):
+                self.send_watch(gid, False)
 
             try:
                 # Maybe the socket be closed. Should
                 # catch the exception error.
+                self.release_client(c["socket"])
                 c["socket"].close()
             except:
                 pass
@@ -286,9 +1501,13 @@ class MasterSocket:
                 self.logger.info("Close the socket {}.".format(k))
                 v["socket"].close()
             self.logger.info("Terminate the process pool.")
+            self.save_snapshot(commands_queue)
+            self.handle_rating(force=True)
 
-            for p in self.process_pool:
+            for p in self.process_pool.values():
                 p["proc"].terminate()
+            for proc in self.retired_processes:
+                proc.terminate()
             # Be careful that the "quit" will finish the
             # program. We should close all sockets, terminate
             # all processes and do other important things
@@ -326,29 +1545,144 @@ class MasterSocket:
                     while len(line) != 0:
                         commands_queue.append(line.strip())
                         line = f.readline()
+        elif cmd_list["main"] == "profile":
+            # Profile the master or one worker without restarting
+            # the server. For example,
+            #     profile start
+            #     profile start 0 sample
+            #     profile stop 0
+            # The second field is the worker process id. Profile the
+            # master if we do not give it. The third field is the
+            # profiler type, 'cprofile' or 'sample'.
+            action = cmd_list.get(1, None)
+            who = cmd_list.get(2, "master")
+            mode = cmd_list.get(3, None)
+            if action not in ["start", "stop"]:
+                self.logger.info("Unknown parameter.")
+            elif who == "master":
+                self.handle_master_profile(action, mode)
+            else:
+                try:
+                    pid = int(who)
+                except ValueError:
+                    pid = None
+                if pid not in self.process_pool:
+                    self.logger.info("There is no process {}.".format(who))
+                else:
+                    # Only the sampling profiler can see the game threads
+                    # in the worker.
+                    self.ready_queue_pool[pid].put(
+                        {
+                            "type"   : "profile",
+                            "action" : action,
+                            "mode"   : "sample",
+                            "root"   : self.profile_root
+                        }
+                    )
+                    self.logger.info("Send the profile {} to process {}.".format(action, pid))
         elif cmd_list["main"] == "show":
             # Show some server status.
             if cmd_list.get(1, None) == "client":
-                out_info = "{:>15} {:>12} {:>8} {:>8} {:>8}".format(
-                               "name", "status", "fid", "gid", "pid"
+                out_info = "{:>15} {:>12} {:>8} {:>8} {:>8} {:>8}".format(
+                               "name", "status", "fid", "gid", "pid", "rtt(ms)"
                            )
                 self.logger.info(out_info)
                 for k, v in self.client_pool.items():
                     # The 'fid' is socket (file) id.
                     # The 'gid' is game id. If it is None, it is waiting status.
                     # The 'pid' is process id. If it is None, it is waiting status.
+                    # The multigame engine shows all its game ids.
                     gid = "None"
-                    if v["gid"] is not None:
+                    if len(v["gids"]) > 0:
+                        gid = ",".join([ str(g) for g in sorted(v["gids"]) ])
+                    elif v["gid"] is not None:
                         gid = v["gid"]
                     pid = "None"
                     if v["pid"] is not None:
                         pid = v["pid"]
-                    out_info = "{:>15} {:>12} {:>8} {:>8} {:>8}".format(
-                                   v["socket"].name, v["status"], k, gid, pid
+                    # The 'rtt' is the last heartbeat round trip time.
+                    rtt = "None"
+                    if v["socket"].rtt is not None:
+                        rtt = "{:.1f}".format(1000 * v["socket"].rtt)
+                    out_info = "{:>15} {:>12} {:>8} {:>8} {:>8} {:>8}".format(
+                                   v["socket"].name, v["status"], k, gid, pid, rtt
                                )
                     self.logger.info(out_info)
+            elif cmd_list.get(1, None) == "latency":
+                # The percentiles are in millisecond.
+                scope = cmd_list.get(2, None)
+                out_info = "{:>8} {:>15} {:>8} {:>8} {:>8} {:>8} {:>8} {:>8}".format(
+                               "scope", "key", "metric", "count", "p50", "p90", "p99", "max"
+                           )
+                self.logger.info(out_info)
+                for (s, k, metric), h in self.latency.items():
+                    if scope is not None and s != scope:
+                        continue
+                    out_info = "{:>8} {:>15} {:>8} {:>8} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f}".format(
+                                   s, k, metric, h.total,
+                                   1000 * h.percentile(50),
+                                   1000 * h.percentile(90),
+                                   1000 * h.percentile(99),
+                                   h.max / 1000
+                               )
+                    self.logger.info(out_info)
+            elif cmd_list.get(1, None) == "rating":
+                # The online Glicko rating, its RD and the batch rating.
+                # Fit the batch ratings first if there are new games.
+                if self.rating.dirty:
+                    self.handle_rating(force=True)
+                out_info = "{:>15} {:>8} {:>8} {:>8} {:>8}".format(
+                               "name", "rating", "rd", "batch", "games"
+                           )
+                self.logger.info(out_info)
+                for r in self.rating.get_records():
+                    out_info = "{:>15} {:>8.1f} {:>8.1f} {:>8} {:>8}".format(
+                                   r["name"], r["rating"], r["rd"],
+                                   "None" if r["batch"] is None else "{:.1f}".format(r["batch"]),
+                                   r["games"]
+                               )
+                    self.logger.info(out_info)
+            elif cmd_list.get(1, None) == "queue":
+                # The pending matches in the order of start.
+                now = time.time()
+                for m in self.scheduler.order(list(self.pending_matches), now):
+                    _, share, _, _ = self.scheduler.get_key(m, now)
+                    out_info = "    {}: {}(B) vs {}(W), {} ({}), {}, share {:.2f}, wait {:.0f}s{}".format(
+                                   m["match_id"], m["black"]["name"] or m["black"]["fid"],
+                                   m["white"]["name"] or m["white"]["fid"], m["priority"],
+                                   PRIORITY_CLASSES[self.scheduler.get_class(m, now)],
+                                   m["submitter"], share, now - m["submitted"],
+                                   ", deferred by host budget" if m["match_id"] in self.budget_deferred else "")
+                    self.logger.info(out_info)
+            elif cmd_list.get(1, None) == "budget":
+                # The reserved cost and the budget of each host.
+                for host, used, budget in self.budgets.get_status():
+                    self.logger.info("    {} -> {:g} / {}".format(
+                                         host, used, "unlimited" if budget is None else "{:g}".format(budget)))
+            elif cmd_list.get(1, None) == "pool":
+                # The instances and the results of each engine pool.
+                out_info = "{:>15} {:>9} {:>8} {:>8} {:>8} {:>16} {:>8}".format(
+                               "name", "instances", "waiting", "playing", "games", "+W -L =D", "score"
+                           )
+                self.logger.info(out_info)
+                for r in self.pools.get_records(self.client_index, self.client_pool):
+                    out_info = "{:>15} {:>9} {:>8} {:>8} {:>8} {:>16} {:>8}".format(
+                                   r["name"], r["instances"], r["waiting"], r["playing"], r["games"],
+                                   "+{} -{} ={}".format(r["wins"], r["losses"], r["draws"]),
+                                   "None" if r["score"] is None else "{:.3f}".format(r["score"])
+                               )
+                    self.logger.info(out_info)
+            elif cmd_list.get(1, None) == "series":
+                for series_id, series in self.series_pool.items():
+                    self.logger.info("    {}: {}".format(series_id, series.get_summary()))
+            elif cmd_list.get(1, None) == "pairing":
+                # The recent pairs and their games.
+                self.logger.info("The automatic pairing is {} ({} policy).".format(
+                                     "on" if self.auto_pairing else "off", self.pairing.policy))
+                for a, b, n in self.pairing.get_status():
+                    self.logger.info("    {} vs {} -> {}".format(a, b, n))
             elif cmd_list.get(1, None) == "process":
-                for p in self.process_pool:
+                for p in self.process_pool.values():
                     self.logger.info("    pid: {} -> {}".format(p["pid"], p["load"]))
             elif cmd_list.get(1, None) == "game":
                 for k, v in self.game_tasks.items():
@@ -359,13 +1693,89 @@ class MasterSocket:
             else:
                 self.logger.info("Unknown parameter.")
 
+        elif cmd_list["main"] == "series":
+            # Play the match series between two engines given by fid
+            # or name. The colors alternate every game. For example,
+            #     series eng_a eng_b 400
+            #     series 1 2 100 bsize 9 mtime 60 komi 7
+            #     series eng_a eng_b 400 openings openings/9x9
+            #     series eng_a eng_b 400 concurrency 4
+            #     series stop 0
+            # The 'openings' is one SGF file or the directory of SGF
+            # files. Two games of one pair start from the same opening.
+            # The 'order' of openings is 'sequential' or 'random'.
+            #     series eng_a eng_b 400 openings openings/9x9 order random
+            # The 'concurrency' is the maximum number of running games.
+            #
+            # Stop the series early by SPRT if 'elo0' and 'elo1' are
+            # given. The optional 'alpha', 'beta' and 'model' are the
+            # error rates and 'trinomial' or 'pentanomial'.
+            #     series eng_a eng_b 20000 elo0 0 elo1 5
+            #     series eng_a eng_b 20000 elo0 0 elo1 5 alpha 0.05 beta 0.05 model trinomial
+            if cmd_list.get(1, None) == "stop":
+                try:
+                    series_id = int(cmd_list.get(2, None))
+                except (TypeError, ValueError):
+                    series_id = None
+                if not self.stop_series(series_id, "stopped by command"):
+                    self.logger.info("There is no series {}.".format(cmd_list.get(2, None)))
+            else:
+                self.parse_series_command(cmd_list_raw[1:])
+        elif cmd_list["main"] == "pairing":
+            # Turn the automatic pairing on or off. For example,
+            #     pairing on
+            #     pairing off
+            action = cmd_list.get(1, None)
+            if action == "on":
+                self.auto_pairing = True
+            elif action == "off":
+                self.auto_pairing = False
+            elif action is not None:
+                self.logger.info("Unknown parameter.")
+            self.logger.info("The automatic pairing is {}.".format("on" if self.auto_pairing else "off"))
+        elif cmd_list["main"] == "match" and cmd_list.get(1, None) == "pool":
+            # Play one game between two engine pools. Any waiting
+            # instance of the pool plays. The match waits in the
+            # pending queue until both pools have waiting instances.
+            # The fields are the same as 'match fid'. For example,
+            #     match pool eng_a eng_b
+            #     match pool eng_a eng_b mtime 60 bsize 9 opening openings/9x9
+            try:
+                if len(cmd_list_raw) < 4:
+                    raise ValueError("The black and white pools are needed.")
+                black, white = [ { "fid" : None, "name" : v } for v in cmd_list_raw[2:4] ]
+                setting = dict()
+                priority = None
+                submitter = None
+                fields = cmd_list_raw[4:]
+                for field, value in zip(fields[0::2], fields[1::2]):
+                    if field == "mtime":
+                        setting["main_time"] = int(value)
+                    elif field == "bsize":
+                        setting["board_size"] = int(value)
+                    elif field == "komi":
+                        setting["komi"] = float(value)
+                    elif field in ["sgf", "opening", "store", "rule"]:
+                        setting[field] = value
+                    elif field == "priority":
+                        priority = value
+                    elif field == "submitter":
+                        submitter = value
+                    else:
+                        raise ValueError("Unknown field {}.".format(field))
+                match_id = self.submit_match(black, white, setting, priority=priority, submitter=submitter)
+                self.logger.info("Submit the match {}, {}(B) vs {}(W).".format(
+                                     match_id, black["name"], white["name"]))
+            except ValueError as e:
+                self.logger.info("Invalid match command. {}".format(e))
         elif cmd_list["main"] == "match":
             # The "match" command will select two waiting clients
             # for the match game. Here are the valid commands
             #     "random" : randomly select two clients
+            #     "rating" : select two engines with the most rating
+            #                information
             #     "fid"    : select two clients with socket id
-            self.fill_waiting_clients()
-            keys = list(self.waiting_clients)
+            waiting = self.client_index.waiting
             task = {
                 "type"  : "match",
                 "black" : None,
@@ -373,16 +1783,20 @@ class MasterSocket:
                 "gid"   : self.last_game_id
             }
 
-            if len(keys) <= 1:
+            if len(waiting) <= 1:
                 self.logger.info("There are not enough ready clients.")
             elif cmd_list.get(1, None) == "random":
-                random.shuffle(keys)
-                black_fid = keys.pop(0)
-                white_fid = keys.pop(0)
+                black_fid, white_fid = waiting.sample(2)
 
                 for name, fid in zip(["black", "white"], [black_fid, white_fid]):
-                    self.waiting_clients.remove(fid)
-                    task[name] = self.client_pool[fid]["socket"]
+                    task[name] = fid
+            elif cmd_list.get(1, None) == "rating":
+                engines = self.get_free_engines()
+                matched = self.pairing.match_by_rating(engines, time.time(), self.rating)
+                if len(matched) > 0:
+                    (task["black"], _), (task["white"], _) = matched[0]
+                else:
+                    self.logger.info("There are not enough engines with different names.")
             elif cmd_list.get(1, None) == "fid":
                 # Keep to get the field paramters. Must provide black
                 # fid and white fid. Two fids must be different. Other
@@ -394,6 +1808,8 @@ class MasterSocket:
                 #     mtime: the game main time in second
                 #       sgf: the source of sgf name, starting the match
                 #            from it
+                #   opening: the opening book, starting the match from
+                #            the next opening of it
                 #     store: the directory path. Will store the the game
                 #            game
                 #      rule: support 'null', 'chinese-like' keys
@@ -412,9 +1828,9 @@ class MasterSocket:
                         names = ["black", "white"]
                         try:
                             fid = int(c) # may fail here
-                            if fid in self.waiting_clients:
-                                self.waiting_clients.remove(fid)
-                                task[names[i-2]] = self.client_pool[fid]["socket"]
+                            if fid in waiting and \
+                                   fid not in [task["black"], task["white"]]:
+                                task[names[i-2]] = fid
                         except:
                             pass
                     elif i >= 4:
@@ -431,6 +1847,11 @@ class MasterSocket:
                                 task["komi"] = float(c) # get komi
                             elif field == "sgf":
                                 task["sgf"] = c
+                            elif field == "opening":
+                                try:
+                                    task["opening"] = load_opening_book(c).choose(config.OPENING_ORDER)
+                                except ValueError as e:
+                                    self.logger.info("Invalid opening. {}".format(e))
                             elif field == "store":
                                 task["store"] = c
                             elif field == "rule":
@@ -446,33 +1867,135 @@ class MasterSocket:
             self.logger.info("Invalid command [{}]...".format(cmd))
 
     def handle_finished_clients(self):
-        try:
-            # Collect the finished clients from queue. Reset the
-            # clients status to waiting.
-            task = self.finished_queue.get(block=True, timeout=0)
-            black, white, pid, gid = task["black"], task["white"], task["pid"], task["gid"]
+        # Collect the messages from workers. There are finished
+        # games and metrics reports.
+        for _ in range(MAX_FINISHED_PER_TICK):
+            try:
+                task = self.finished_queue.get(block=True, timeout=0)
+            except queue.Empty:
+                break
+
+            if task["type"] == "finished":
+                self.finish_match(task)
+            elif task["type"] == "metrics":
+                self.merge_worker_metrics(task)
+
+    def finish_match(self, task):
+        # Reset the clients status to waiting.
+        black, white, pid, gid = task["black"], task["white"], task["pid"], task["gid"]
+
+        # Remove the task. The task may be removed already if
+        # the process was dead.
+        game_task = self.game_tasks.pop(gid, None)
+        if game_task is not None:
+            self.budgets.release(game_task.get("costs", list()))
+            # Keep the result for API.
+            result = task.get("result", dict())
+            self.recent_results.append(
+                {
+                    "seq"      : self.next_result_seq,
+                    "gid"      : gid,
+                    "match_id" : game_task.get("match_id", None),
+                    "black"    : game_task["black_name"],
+                    "white"    : game_task["white_name"],
+                    "result"   : result.get("info", None),
+                    "type"     : result.get("type", None),
+                    "moves"    : result.get("moves", None)
+                }
+            )
+            self.next_result_seq += 1
+            self.rating.add_game(
+                game_task["black_name"], game_task["white_name"],
+                result.get("info", None), result.get("type", None), time.time())
+            self.pools.add_result(
+                game_task["black_name"], game_task["white_name"],
+                result.get("info", None), result.get("type", None), result.get("moves", None))
+            if game_task.get("series", None) is not None:
+                self.add_series_result(game_task, result)
 
             # The task is finished. Reduce the load.
-            self.process_pool[pid]["load"] -= 1
-
-            # Copy the clients status to pool.
-            self.client_pool[black.fid]["socket"] = black
-            self.client_pool[white.fid]["socket"] = white
-
-            # Remove the task.
-            self.game_tasks.pop(gid, None)
-
-            for fid in [black.fid, white.fid]:
-                # The match game is over. The client returns to
-                # waiting status. We also clean all the other status.
-                self.client_pool[fid]["status"] = "waiting"
-                self.client_pool[fid]["pid"] = None
-                self.client_pool[fid]["gid"] = None
-            self.logger.info("The match game {} is over.".format(task["gid"]))
-        except queue.Empty:
-            pass
+            p = self.process_pool.get(pid, None)
+            if p is not None:
+                p["load"] -= 1
+                if p["load"] == 0:
+                    p["idle"] = time.time()
+
+        for player in [black, white]:
+            # The match game is over. The client returns to
+            # waiting status. We also clean all the other status.
+            # The client may be closed during the game, so we
+            # check the game id.
+            fid = player["fid"]
+            c = self.client_pool.get(fid, None)
+            if c is None or gid not in c["gids"]:
+                continue
+            self.client_index.leave_game(fid, c, gid)
+            if player["crash"]:
+                self.mark_crash(fid)
+            elif len(c["gids"]) == 0:
+                # The multigame engine is probed after all its games.
+                self.heartbeat.add(fid, time.time())
+        self.logger.info(
+            "The match game {} is over.".format(gid),
+            extra={ "event" : "game_over", "gid" : gid, "pid" : pid })
+
+    def merge_worker_metrics(self, task):
+        # The worker sends the counter deltas and the latency
+        # histograms.
+        now = time.time()
+        self.metrics.merge(task["deltas"])
+        self.latency.merge(task.get("latency", list()))
+        for name, _, value in task["deltas"]:
+            if name == "cgos_games_finished_total":
+                self.games_window.add(value, now)
+            elif name == "cgos_moves_total":
+                self.moves_window.add(value, now)
+
+    def handle_metrics(self, commands_queue):
+        # Update the gauges periodically. The counters are
+        # updated when the events happen.
+        now = time.time()
+        if now - self.metrics_clock_time < config.METRICS_INTERVAL:
+            return
+        self.metrics_clock_time = now
+
+        def get_qsize(q):
+            try:
+                return q.qsize()
+            except NotImplementedError:
+                return -1
+
+        m = self.metrics
+        m.reset("cgos_clients")
+        for (t, status), n in self.client_index.counts.items():
+            m.set("cgos_clients", n, type=t, status=status)
+        m.set("cgos_clients_crashed", len(self.client_index.crashed))
+        m.set("cgos_heartbeat_pending", len(self.heartbeat.pending_fids()))
+
+        m.reset("cgos_worker_games")
+        m.reset("cgos_queue_depth")
+        for pid, p in self.process_pool.items():
+            m.set("cgos_worker_games", p["load"], pid=pid)
+            m.set("cgos_queue_depth", get_qsize(self.ready_queue_pool[pid]), queue="ready", pid=pid)
+        m.set("cgos_queue_depth", get_qsize(self.finished_queue), queue="finished")
+        m.set("cgos_queue_depth", get_qsize(self.log_listener.queue), queue="log")
+        m.set("cgos_queue_depth", len(commands_queue), queue="commands")
+        m.set("cgos_queue_depth", len(self.pending_matches), queue="pending")
+        priorities = dict([ (v, 0) for v in PRIORITY_CLASSES ])
+        for match in self.pending_matches:
+            priorities[match["priority"]] += 1
+        for priority, n in priorities.items():
+            m.set("cgos_pending_matches", n, priority=priority)
+        m.set("cgos_queue_depth", get_qsize(self.event_queue), queue="event")
+        m.set("cgos_workers", len(self.process_pool))
+        m.set("cgos_games_running", len(self.game_tasks))
+        for host, used, _ in self.budgets.get_status():
+            m.set("cgos_host_cost", used, host=host)
+        m.set("cgos_games_per_hour", self.games_window.get(now))
+        m.set("cgos_moves_per_second", self.moves_window.get(now) / self.moves_window.window)
 
     def try_push_task(self, task):
+        # Return True if the task is pushed.
         if task["type"] == "match":
             if task.get("black", None) is not None and \
                    task.get("white", None) is not None:
@@ -481,16 +2004,47 @@ class MasterSocket:
                     for v in store.split(os.sep):
                         if v == "." or v == "..":
                             self.logger.info("Invalid store path {}. Cancel the match.".format(store))
-                            return
-
-                # Select the lowest load process in order to
-                # be load balancing.
-                min_load = self.process_pool[0]["load"]
-                select_pid = self.process_pool[0]["pid"]
-                for p in self.process_pool:
-                    if min_load < p["load"]:
-                        min_load = p["load"]
-                        select_pid = p["pid"]
+                            return False
+
+                for name in ["black", "white"]:
+                    fid = task[name]
+                    if self.client_pool[fid]["socket"].type != "engine":
+                        return False
+
+                # The multigame engine in the running games is held by
+                # its worker. The new game must be played there.
+                busy_pids = set([ self.client_pool[task[name]]["pid"] for name in ["black", "white"]
+                                      if len(self.client_pool[task[name]]["gids"]) > 0 ])
+                if len(busy_pids) > 1:
+                    self.logger.debug("Defer the match, the engines are playing in different workers.")
+                    return False
+
+                # Do not oversubscribe the hosts. The match waits for
+                # the other games on the host.
+                costs = [ (c.host, c.cost) for c in
+                              [self.client_pool[task[name]]["socket"] for name in ["black", "white"]] ]
+                match_id = task.get("match_id", None)
+                if not self.budgets.fits(costs):
+                    self.metrics.inc("cgos_budget_deferred_total")
+                    if match_id is not None and match_id not in self.budget_deferred:
+                        self.budget_deferred.add(match_id)
+                        self.logger.info("Defer the match {}, the host budget is not enough.".format(match_id))
+                    else:
+                        self.logger.debug("Defer the match, the host budget is not enough.")
+                    return False
+                self.budget_deferred.discard(match_id)
+                self.budgets.reserve(costs)
+                task["costs"] = costs
+
+                # Select the process in order to be load balancing. We
+                # prefer the process which already holds the clients
+                # because it does not need to hand the sockets over.
+                if len(busy_pids) == 1:
+                    select_pid = busy_pids.pop()
+                else:
+                    select_pid = self.select_process(
+                                     [self.client_pool[task[name]]["socket"] for name in ["black", "white"]]
+                                 )
                 task["pid"] = select_pid
                 self.process_pool[select_pid]["load"] += 1
 
@@ -507,32 +2061,96 @@ class MasterSocket:
                     html_check_path = os.path.join(self.html_root, store)
                 check_and_mkdir(sgf_check_path)
                 check_and_mkdir(html_check_path)
+                if config.GAME_TRACE:
+                    check_and_mkdir(os.path.join(
+                        self.trace_root, config.DEFAULT_STORE_DIR if store is None else store))
+
+                # The worker owns the sockets now. Stop the heartbeat
+                # and let the worker drop the late reply of probe.
+                task["stale_lines"] = dict()
+                task["handoff"] = list()
+                task["rtt"] = dict()
+                task["date"] = get_date()
+                task["black_name"] = self.client_pool[task["black"]]["socket"].name
+                task["white_name"] = self.client_pool[task["white"]]["socket"].name
+                for name in ["black", "white"]:
+                    fid = task[name]
+                    c = self.client_pool[fid]["socket"]
+                    task["stale_lines"][fid] = 1 if self.heartbeat.remove(fid) else 0
+                    task["rtt"][fid] = c.min_rtt
+
+                    if c.owner != select_pid:
+                        # Hand the socket over to the selected process.
+                        self.release_client(c)
+                        send_client(self.process_pool[select_pid]["channel"], c)
+                        c.owner = select_pid
+                        task["handoff"].append(fid)
 
                 # The current setting is valid. Push the task
                 # to ready queue.
                 self.ready_queue_pool[select_pid].put(task)
 
                 for name in ["black", "white"]:
-                    fid = task[name].fid
-                    if self.client_pool[fid]["socket"].type != "engine":
-                        return
-                    self.client_pool[fid]["status"] = "playing"
-                    self.client_pool[fid]["gid"] = task["gid"]
-                    self.client_pool[fid]["pid"] = task["pid"]
+                    fid = task[name]
+                    self.client_index.set_playing(
+                        fid, self.client_pool[fid], task["gid"], task["pid"])
 
                 # Save the task.
                 self.game_tasks[task["gid"]] = task
+                self.pairing.record(task["black_name"], task["white_name"])
+                for name in ["black", "white"]:
+                    self.pools.record_start(task[name])
 
                 outs_info = "The new match game {} in the process {}, {}(B) vs {}(W).".format(
                                 task["gid"],
                                 task["pid"],
-                                task["black"].name,
-                                task["white"].name
+                                self.client_pool[task["black"]]["socket"].name,
+                                self.client_pool[task["white"]]["socket"].name
                             )
-                self.logger.info(outs_info)
+                self.logger.info(
+                    outs_info,
+                    extra={ "event" : "game_start", "gid" : task["gid"], "pid" : task["pid"] })
+                self.metrics.inc("cgos_games_started_total")
                 self.last_game_id += 1
-            else:
-                pass
+                return True
+        return False
+
+    def select_process(self, clients):
+        # Select the process with the lowest load. Each client held by
+        # the process counts as one game less.
+        min_load = min([ p["load"] for p in self.process_pool.values() ])
+        if min_load >= config.WORKER_MAX_LOAD and \
+               len(self.process_pool) < self.max_workers:
+            # All processes are busy. Scale up the pool.
+            pid = self.spawn_process()
+            self.logger.info(
+                "Spawn the process {}.".format(pid),
+                extra={ "event" : "process_spawn", "pid" : pid })
+            return pid
+
+        select_pid = None
+        min_score = None
+        for p in self.process_pool.values():
+            score = p["load"]
+            for c in clients:
+                if c.owner == p["pid"]:
+                    score -= 1
+            if min_score is None or score < min_score:
+                min_score = score
+                select_pid = p["pid"]
+        return select_pid
+
+    def release_client(self, c):
+        # Ask the worker to close its file descriptor of the
+        # client. The worker releases it after the current game.
+        if c.owner is not None:
+            self.ready_queue_pool[c.owner].put(
+                {
+                    "type" : "release",
+                    "fids" : [c.fid]
+                }
+            )
+        c.owner = None
 
     def close(self):
         try:
@@ -541,6 +2159,16 @@ class MasterSocket:
                 self.server_sock = None
         except:
             raise Exception("Can not close the master socket.")
+        finally:
+            if getattr(self, "metrics_server", None) is not None:
+                self.metrics_server.close()
+                self.metrics_server = None
+            if getattr(self, "live_server", None) is not None:
+                self.live_server.close()
+                self.live_server = None
+            # Write the remaining log records.
+            if getattr(self, "log_listener", None) is not None:
+                self.log_listener.stop()
 
     def __del__(self):
         self.close();
@@ -5,10 +5,18 @@ import datetime
 import queue
 import json
 import os
+import socket
 
 import board as brd
 from sgf import make_sgf, parse_sgf
 from client import ClientSocketError
+from feed import GameFeed
+from histogram import LatencyRecorder
+from handoff import recv_client
+from logger import get_logger
+from metrics import WorkerStats
+from multigame import GameMux, GameChannel
+from profiler import create_profiler, get_profile_path
 from utils import check_and_mkdir, get_html_code
 
 def color_to_char(c):
@@ -49,6 +57,12 @@ def move_to_vertex(board, move, support_analysis):
         vertex = board.get_vertex(x,y)
     return move, vertex, analysis
 
+def get_date():
+    return datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+
+def get_base_name(date, black_name, white_name, game_id):
+    return "{}-{}(B)-{}(W)-g{}".format(date, black_name, white_name, game_id)
+
 def write_sgf_and_html(
     setting,
     names,
@@ -107,11 +121,33 @@ def write_sgf_and_html(
         return True
     return False
 
-def play_match_game(game_id, black, white, setting):
+def write_trace(setting, base_name, events):
+    # Write the game events, one JSON line for each event.
+    trace_store_path = os.path.join(
+        *config.DATA_DIR_ROOT, "trace", setting["store"])
+    if not os.path.isdir(trace_store_path):
+        return False
+    trace_full_name = os.path.join(trace_store_path, "{}.trace".format(base_name))
+    with open(trace_full_name, 'w') as f:
+        for e in events:
+            f.write(json.dumps(e, indent=None, separators=(",", ":")))
+            f.write("\n")
+    return True
+
+def play_match_game(game_id, black, white, setting, logger, stats, latency, feed, outcome):
     # Play a match game and save the SGF file. The client may
     # crash here. We detect it and guarantee that the client can
     # return back safely. The socket is not closed here when
-    # crashing. The master will close it later.
+    # crashing. The master will close it later. The result is
+    # written into 'outcome'. The live events are published via
+    # the 'feed'.
+    #
+    # The timing of each move is recorded into the 'latency'
+    # histograms. The metrics are here.
+    #     genmove: the server sends genmove and receives the reply
+    #       think: the genmove time minus the minimum heartbeat round trip
+    #       board: the board validates the move
+    #         sgf: the server writes the SGF file
 
     # Initialize some basic data.
     time_lefts = {
@@ -128,17 +164,42 @@ def play_match_game(game_id, black, white, setting):
     should_superko = rule == "chinese-like"
 
     # We only record the starting time in order to fix
-    # the output file name.
-    date = datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S")
+    # the output file name. The master gives it so that it
+    # can find the SGF file after restart.
+    date = setting["date"]
+    if date is None:
+        date = get_date()
 
     # 
     sgf_clock_time = time.time()
+    start_clock_time = sgf_clock_time
 
     # The store path and SGF name.
-    base_name = "{}-{}(B)-{}(W)-g{}".format(date, black.name, white.name, game_id)
+    base_name = get_base_name(date, black.name, white.name, game_id)
 
     move_history = list() # It contains (move, time_left and analysis).
 
+    # The minimum heartbeat round trip time measured by master. It
+    # is the estimated network lag.
+    network_rtts = {
+        brd.BLACK : setting["rtt"].get(black.fid, None) or 0,
+        brd.WHITE : setting["rtt"].get(white.fid, None) or 0
+    }
+
+    # The event trace of this game. It is None if the trace
+    # is disabled.
+    trace = list() if config.GAME_TRACE else None
+
+    def record(player, metric, seconds):
+        latency.record("engine", player.name, metric, seconds)
+        latency.record("worker", setting["pid"], metric, seconds)
+
+    def add_event(event, **kwargs):
+        if trace is not None:
+            e = { "t" : round(1000 * (time.time() - start_clock_time), 3), "e" : event }
+            e.update(kwargs)
+            trace.append(e)
+
     # Try to read the SGF file. Should start the game from
     # it if the source is not None.
     sgf_source = setting.get("sgf", None)
@@ -149,28 +210,56 @@ def play_match_game(game_id, black, white, setting):
             # Rewrite the game setting.
             setting["board_size"] = board_size
             setting["komi"] = komi
+    elif setting.get("opening", None) is not None:
+        # The opening is parsed and validated by master already.
+        opening = setting["opening"]
+        move_history = [ (move, None, None) for move in opening["moves"] ]
+        setting["board_size"] = opening["board_size"]
+        if opening["komi"] is not None:
+            setting["komi"] = opening["komi"]
 
     board = brd.Board(setting["board_size"], setting["komi"])
     result_status = dict()
+    feed.start(
+        game_id,
+        {
+            "black"      : black.name,
+            "white"      : white.name,
+            "board_size" : setting["board_size"],
+            "komi"       : setting["komi"],
+            "main_time"  : setting["main_time"],
+            "rule"       : rule
+        }
+    )
 
     try:
         for player in players.values():
             # Request each clients to initialize the game also
             # create new socket file.
+            clock_time = time.time()
             player.create_sockfile()
+            player.drop_stale_lines()
             player.request_setup(
                 setting["board_size"],
                 setting["komi"],
                 setting["main_time"] * 1000,
                 players[brd.WHITE].name,
-                players[brd.BLACK].name
+                players[brd.BLACK].name,
+                game_id
             )
+            add_event("setup", p=player.name, ms=round(1000 * (time.time() - clock_time), 3))
 
         while len(move_history) > board.move_num:
             # Play the moves from SGF file.
             side_to_move = board.to_move
             to_move_player = players[side_to_move]
-            move, time_left, _ = move_history[board.move_num] 
+            move, time_left, analysis = move_history[board.move_num] 
+            if time_left is None:
+                # The opening SGF may not record the time.
+                time_left = setting["main_time"]
+                move_history[board.move_num] = (move, time_left, analysis)
+            # The resumed game goes on with the clock in the SGF file.
+            time_lefts[side_to_move] = time_left
 
             move, vertex, _ = move_to_vertex(
                                   board, move, False
@@ -178,6 +267,15 @@ def play_match_game(game_id, black, white, setting):
 
             # Always assuem the move is legel.
             board.play(vertex)
+            feed.move(
+                game_id,
+                {
+                    "n" : board.move_num,
+                    "c" : color_to_char(side_to_move),
+                    "m" : move,
+                    "t" : time_left
+                }
+            )
 
             # Both clients should play the move.
             for player in players.values(): 
@@ -199,7 +297,11 @@ def play_match_game(game_id, black, white, setting):
                       color_to_char(side_to_move),
                       int(time_left * 1000)
                   )
-            time_left -= (time.time() - clock_time)
+            elapsed = time.time() - clock_time
+            time_left -= elapsed
+            think = max(elapsed - network_rtts[side_to_move], 0)
+            record(to_move_player, "genmove", elapsed)
+            record(to_move_player, "think", think)
 
             if time_left < 0:
                 # Game ended by time out.
@@ -229,11 +331,20 @@ def play_match_game(game_id, black, white, setting):
                                         )
                 break  
 
-            is_legal = board.play(vertex)
-
-            if not is_legal or \
-                (vertex != brd.PASS and \
-                     not should_superko and board.superko()):
+            clock_time = time.time()
+            is_legal = board.play(vertex) and \
+                           (vertex == brd.PASS or should_superko or not board.superko())
+            board_time = time.time() - clock_time
+            record(to_move_player, "board", board_time)
+            add_event(
+                "move",
+                c=color_to_char(side_to_move),
+                m=move,
+                rt=round(1000 * elapsed, 3),
+                th=round(1000 * think, 3),
+                bv=round(1000 * board_time, 3))
+
+            if not is_legal:
                 # Game ended by illegal move.
                 winner = opp_to_move
                 result_status["winner"] = winner
@@ -244,11 +355,24 @@ def play_match_game(game_id, black, white, setting):
                 break    
 
             move_history.append((move, int(time_left), analysis))
+            stats.inc("cgos_moves_total")
+            live_move = {
+                "n" : board.move_num,
+                "c" : color_to_char(side_to_move),
+                "m" : move,
+                "t" : round(time_left, 3)
+            }
+            if analysis is not None:
+                live_move["a"] = analysis
+            feed.move(game_id, live_move)
 
             # Try to save game result into SGF file after updating
             # the move_history. Failed to save it if the client play
-            # the move too quick. 
-            if time.time() - sgf_clock_time > 5:
+            # the move too quick. The viewers follow the live feed, so
+            # it can be disabled.
+            if config.SGF_FLUSH_INTERVAL is not None and \
+                   time.time() - sgf_clock_time > config.SGF_FLUSH_INTERVAL:
+                clock_time = time.time()
                 if write_sgf_and_html(
                        setting,
                        (black.name, white.name), 
@@ -257,6 +381,8 @@ def play_match_game(game_id, black, white, setting):
                        None,
                        base_name):
                     sgf_clock_time = time.time()
+                    record(to_move_player, "sgf", sgf_clock_time - clock_time)
+                    add_event("sgf", ms=round(1000 * (sgf_clock_time - clock_time), 3))
 
             # Request the opponent to play the move.
             time_left = time_lefts[opp_to_move]
@@ -300,6 +426,10 @@ def play_match_game(game_id, black, white, setting):
                 break
     except:
         # TODO: Catch the error and write it into the SGF file.
+        logger.debug(
+            "The match game {} is broken.".format(game_id),
+            exc_info=True,
+            extra={ "event" : "game_error", "gid" : game_id })
         result_status["winner"] = brd.EMPTY
         result_status["type"] = "socket error"
         result_status["info"] = "0"
@@ -315,8 +445,8 @@ def play_match_game(game_id, black, white, setting):
         except ClientSocketError as e:
             pass
 
-    # Close the socket file because the we can not push socket file
-    # onto process queue.
+    # Close the socket file because the master reads the socket
+    # directly between games.
     for player in players.values():
         try:
            player.close_sockfile()
@@ -324,22 +454,85 @@ def play_match_game(game_id, black, white, setting):
             pass
 
     # Always save the SGF file before leaving.
-    write_sgf_and_html(
-        setting,
-        (black.name, white.name), 
-        date,
-        move_history,
-        result,
-        base_name)
-
-def match_loop(process_id, ready_queue, finished_queue):
-    match_threads = dict()
+    clock_time = time.time()
+    if write_sgf_and_html(
+           setting,
+           (black.name, white.name), 
+           date,
+           move_history,
+           result,
+           base_name):
+        latency.record("worker", setting["pid"], "sgf", time.time() - clock_time)
+    add_event("result", r=result, type=result_status["type"], moves=len(move_history))
+    if trace is not None:
+        write_trace(setting, base_name, trace)
+
+    feed.finish(
+        game_id,
+        {
+            "r"     : result,
+            "type"  : result_status["type"],
+            "moves" : len(move_history)
+        }
+    )
+    outcome["info"] = result
+    outcome["type"] = result_status["type"]
+    outcome["moves"] = len(move_history)
+    stats.inc("cgos_games_finished_total", type=result_status["type"])
+    outs_info = "The match game {} is over, {}(B) vs {}(W), {} ({}) after {} moves.".format(
+                    game_id, black.name, white.name, result, result_status["type"], len(move_history)
+                )
+    logger.debug(
+        outs_info,
+        extra={ "event" : "game_result", "gid" : game_id, "latency" : time.time() - start_clock_time })
+
+def match_loop(process_id, ready_queue, finished_queue, event_queue, channel, log_queue, listeners):
+    # The worker holds the client sockets handed over by master. The
+    # sockets stay here between games until the master asks to release
+    # them, so the engines playing consecutive games in this worker are
+    # not transferred again.
+    for s in listeners:
+        # Only the master listens. A copy of the port here would keep
+        # it bound after the master is killed.
+        s.close()
+    logger = get_logger("match.Worker", log_queue)
+    master_pid = os.getppid()
+    stats = WorkerStats()
+    latency = LatencyRecorder()
+    feed = GameFeed(event_queue)
+    stats_clock_time = time.time()
+    profiler = None
+    match_threads = dict() # gid -> (thread, gid, black, white, outcome)
+    clients = dict() # fid -> ClientSocket
+    muxes = dict() # fid -> GameMux of the multigame engine
+    playing = dict() # ClientSocket -> number of running games
+    released = set() # The clients should be released after the game.
 
     while True:
+        if os.getppid() != master_pid:
+            # The master is dead and nobody will read our results.
+            for c in list(clients.values()) + list(released):
+                # Shut the connections down. The master's copies are
+                # closed, so the engines see the EOF and can connect
+                # to the restarted server. The game threads reading
+                # the sockets wake up at once.
+                try:
+                    c.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+            for q in [finished_queue, event_queue, log_queue]:
+                # This process holds the read end of the queues too,
+                # so a full pipe would block the exit forever.
+                q.cancel_join_thread()
+            logger.info(
+                "The master is gone. The process {} quits.".format(process_id),
+                extra={ "event" : "process_orphaned", "pid" : process_id })
+            break
+
         finished_ids = list()
         for k, v in match_threads.items():
             # Collect all finished match games.
-            t, _, _, _ = v
+            t, _, _, _, _ = v
             if not t.is_alive():
                 finished_ids.append(k)
 
@@ -347,46 +540,148 @@ def match_loop(process_id, ready_queue, finished_queue):
             # The match game is game over. Push the play
             # back to main pooling.
             v = match_threads.pop(i)
-            t, i, b, w = v
+            t, i, b, w, outcome = v
             t.join()
 
+            for c in [b, w]:
+                playing[c] -= 1
+                if playing[c] > 0:
+                    continue
+                playing.pop(c)
+                if c in released:
+                    released.discard(c)
+                    c.release()
+
             task = {
-                "black" : b,
-                "white" : w,
-                "gid"   : i,
-                "pid"   : process_id
+                "type"   : "finished",
+                "black"  : { "fid" : b.fid, "crash" : b.crash },
+                "white"  : { "fid" : w.fid, "crash" : w.crash },
+                "gid"    : i,
+                "pid"    : process_id,
+                "result" : outcome
             }
             finished_queue.put(task)
 
+        if time.time() - stats_clock_time > config.METRICS_REPORT_INTERVAL:
+            # Report the aggregated counters to master.
+            stats_clock_time = time.time()
+            deltas = stats.flush()
+            histograms = latency.flush()
+            if len(deltas) > 0 or len(histograms) > 0:
+                finished_queue.put(
+                    {
+                        "type"    : "metrics",
+                        "pid"     : process_id,
+                        "deltas"  : deltas,
+                        "latency" : histograms
+                    }
+                )
+
         try:
             task = ready_queue.get(block=True, timeout=0.1)
-            if task["pid"] != process_id:
-                # Not correct process id. Reture it to finished
-                # queue.
-                finished_queue.put(task)
-            black = task["black"] # black player
-            white = task["white"] # white player
-            game_id = task["gid"] # game id
         except queue.Empty:
             continue
 
+        if task["type"] == "quit":
+            # The master retires this process. Finish the running
+            # games first.
+            for t, _, _, _, _ in match_threads.values():
+                t.join()
+            for c in clients.values():
+                c.release()
+            logger.debug(
+                "The process {} quits.".format(process_id),
+                extra={ "event" : "process_quit", "pid" : process_id })
+            break
+        elif task["type"] == "profile":
+            if task["action"] == "start" and profiler is None:
+                profiler = create_profiler(task["mode"], config.PROFILE_SAMPLE_INTERVAL)
+                profiler.start()
+                logger.info("Start the {} profiler in process {}.".format(task["mode"], process_id))
+            elif task["action"] == "stop" and profiler is not None:
+                path = get_profile_path(task["root"], "worker{}".format(process_id), profiler)
+                profiler.stop(path)
+                profiler = None
+                logger.info("Save the profile of process {} to {}.".format(process_id, path))
+            continue
+        elif task["type"] == "watch":
+            # The observers start or stop watching the game.
+            feed.watch(task["gid"], task["on"])
+            continue
+        elif task["type"] == "release":
+            # The master closes the clients or hands them over to
+            # other worker. Release our file descriptors.
+            for fid in task["fids"]:
+                c = clients.pop(fid, None)
+                muxes.pop(fid, None)
+                if c is None:
+                    continue
+                if c in playing:
+                    released.add(c)
+                else:
+                    c.release()
+            continue
+
         # TODO: Add support for more task type.
 
+        for fid in task.get("handoff", list()):
+            # Receive the new clients. They were sent before
+            # the task was pushed.
+            c = recv_client(channel)
+            if c.fid != fid:
+                raise Exception("The client handoff is out of order.")
+            clients[c.fid] = c
+            logger.debug(
+                "The process {} holds the socket {}.".format(process_id, fid),
+                extra={ "event" : "handoff", "fid" : fid, "pid" : process_id })
+
+        black = clients[task["black"]] # black player
+        white = clients[task["white"]] # white player
+        game_id = task["gid"] # game id
+
+        for c in [black, white]:
+            if c not in playing:
+                # The multigame engine may be in other games. Only
+                # reset it before the first game.
+                c.crash = False
+                c.stale_lines = task["stale_lines"].get(c.fid, 0)
+            playing[c] = playing.get(c, 0) + 1
+
+        # The multigame engines play over their channels.
+        players = list()
+        for c in [black, white]:
+            if c.slots > 1:
+                mux = muxes.get(c.fid, None)
+                if mux is None:
+                    mux = GameMux(c)
+                    muxes[c.fid] = mux
+                players.append(GameChannel(mux, game_id))
+            else:
+                players.append(c)
+
         setting = {
             "main_time"  : task.get("main_time", config.DEFAULT_MAIN_SECOND),
             "board_size" : task.get("board_size", config.DEFAULT_BOARD_SIZE),
             "komi"       : task.get("komi", config.DEFAULT_KOMI),
             "sgf"        : task.get("sgf", None),
+            "opening"    : task.get("opening", None),
             "store"      : task.get("store", config.DEFAULT_STORE_DIR),
-            "rule"       : task.get("rule", "chinese-like")
+            "rule"       : task.get("rule", "chinese-like"),
+            "rtt"        : task.get("rtt", dict()),
+            "date"       : task.get("date", None),
+            "pid"        : process_id
         }
 
         # New game is starting. Each threads hold one game. The threads
         # will be released after the gameover.
+        outcome = dict()
+        feed.open(game_id)
         t = threading.Thread(
                 target=play_match_game,
-                args=(game_id, black, white, setting, ),
+                args=(game_id, players[0], players[1], setting, logger, stats, latency, feed, outcome, ),
                 daemon=True
             )
         t.start()
-        match_threads[t.ident] = (t, game_id, black, white)
+        # Key by the game id. The thread id may be reused by the next
+        # game before the finished thread is collected.
+        match_threads[game_id] = (t, game_id, black, white, outcome)
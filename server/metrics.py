@@ -0,0 +1,132 @@
+import threading
+import time
+import collections
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# The master keeps all metrics in one registry and exports them in
+# the Prometheus text format. The workers do not touch the registry.
+# They aggregate their counters locally and send the deltas to the
+# master from time to time.
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = dict() # name -> (type, help)
+        self._values = dict() # name -> { labels -> value }
+
+    def declare(self, name, kind, help_text):
+        # The 'kind' is 'counter' or 'gauge'.
+        with self._lock:
+            self._meta[name] = (kind, help_text)
+            self._values.setdefault(name, dict())
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values.setdefault(name, dict())
+            values[key] = values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values.setdefault(name, dict())[key] = value
+
+    def reset(self, name):
+        # Clean all the label values of gauge.
+        with self._lock:
+            self._values[name] = dict()
+
+    def merge(self, deltas):
+        # Merge the counter deltas from worker. The deltas is the
+        # list of (name, labels, value).
+        for name, labels, value in deltas:
+            self.inc(name, value, **labels)
+
+    def render(self):
+        def escape(v):
+            return str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        out = list()
+        with self._lock:
+            for name in sorted(self._values.keys()):
+                kind, help_text = self._meta.get(name, ("untyped", name))
+                out.append("# HELP {} {}".format(name, help_text))
+                out.append("# TYPE {} {}".format(name, kind))
+                for key, value in self._values[name].items():
+                    if len(key) == 0:
+                        out.append("{} {}".format(name, value))
+                    else:
+                        labels = ",".join([ "{}=\"{}\"".format(k, escape(v)) for k, v in key ])
+                        out.append("{}{{{}}} {}".format(name, labels, value))
+        return "\n".join(out) + "\n"
+
+class WorkerStats:
+    # Aggregate the counters in the worker. The game threads add the
+    # values and the worker loop sends them to master periodically.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = dict()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def flush(self):
+        # Return and clean the deltas.
+        with self._lock:
+            values, self._values = self._values, dict()
+        return [ (name, dict(labels), value) for (name, labels), value in values.items() ]
+
+class RateWindow:
+    # Count the events in the last 'window' seconds.
+    def __init__(self, window):
+        self.window = window
+        self._events = collections.deque() # (time, value)
+        self._total = 0
+
+    def add(self, value=1, now=None):
+        if now is None:
+            now = time.time()
+        self._events.append((now, value))
+        self._total += value
+
+    def get(self, now=None):
+        if now is None:
+            now = time.time()
+        while len(self._events) > 0 and self._events[0][0] < now - self.window:
+            _, v = self._events.popleft()
+            self._total -= v
+        return self._total
+
+class MetricsServer:
+    # The HTTP server runs in a daemon thread. It only reads
+    # the registry.
+    def __init__(self, metrics, host, port):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Do not write the access log to stderr.
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(
+                          target=self.httpd.serve_forever,
+                          daemon=True
+                      )
+        self.thread.start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,170 @@
+import collections
+import threading
+
+from client import ClientSocketError
+
+# The multigame engine plays many games at once over one connection.
+# It declares the number of games in the protocol handshake, like
+# 'e1 genmove_analyze multigame 4'. The game commands carry the game
+# id as the first parameter and the replies start with it.
+#
+#     server: setup 12 19 7.5 900000 white_name black_name
+#     server: play 12 b D4 899000
+#     server: genmove 12 w 899000
+#     engine: 12 Q16
+#
+# The other commands, like the heartbeat 'username', are not tagged.
+# The master only sends them when the engine plays no game.
+#
+# Every running game in the worker has one GameChannel. The channel
+# works like the ClientSocket, so 'play_match_game' does not know the
+# difference. The channels of one connection share one GameMux. There
+# is no reader thread. The game thread which waits for a reply reads
+# the socket and passes the replies of other games to their queues,
+# so nothing reads the socket after the last game.
+
+class GameMux:
+    def __init__(self, client):
+        self.client = client
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.games = dict() # gid -> queue of replies
+        self.reading = False
+        self.error = None
+        self.reader = None
+
+    def open(self, gid):
+        with self.cond:
+            if len(self.games) == 0:
+                # Read the bytes only. The text file would drop the
+                # buffered replies when the other thread writes.
+                self.error = None
+                try:
+                    self.reader = self.client.sock.makefile("rb")
+                except:
+                    raise ClientSocketError(self.client, "Can not create the socket file.")
+            self.games[gid] = collections.deque()
+
+    def close(self, gid):
+        with self.cond:
+            self.games.pop(gid, None)
+            if len(self.games) == 0 and self.reader is not None:
+                try:
+                    self.reader.close()
+                except:
+                    pass
+                self.reader = None
+
+    def send(self, msg):
+        with self.send_lock:
+            try:
+                self.client.sock.sendall("{}\n".format(msg).encode("utf-8"))
+            except:
+                raise ClientSocketError(self.client, "Can not send massage to client.")
+
+    def read_line(self):
+        try:
+            line = self.reader.readline()
+        except:
+            raise ClientSocketError(self.client, "Can not read massage from client.")
+        if len(line) == 0:
+            raise ClientSocketError(self.client, "The client is closed.")
+        return line.decode("utf-8", errors="replace").strip()
+
+    def receive(self, gid):
+        while True:
+            with self.cond:
+                while True:
+                    replies = self.games[gid]
+                    if len(replies) > 0:
+                        return replies.popleft()
+                    if self.error is not None:
+                        raise ClientSocketError(self.client, self.error)
+                    if not self.reading:
+                        break
+                    self.cond.wait()
+                self.reading = True
+
+            # Read one reply for any game. The late reply of heartbeat
+            # comes before the replies of games.
+            line = None
+            try:
+                while self.client.stale_lines > 0:
+                    self.client.stale_lines -= 1
+                    self.read_line()
+                line = self.read_line()
+            except ClientSocketError as e:
+                error = e.msg
+            with self.cond:
+                self.reading = False
+                if line is not None:
+                    tokens = line.split(None, 1)
+                    if len(tokens) == 0 or not tokens[0].isdigit():
+                        error = "Invalid multigame reply."
+                        line = None
+                    elif int(tokens[0]) in self.games:
+                        self.games[int(tokens[0])].append(tokens[1] if len(tokens) > 1 else str())
+                if line is None:
+                    # All games on this connection are broken.
+                    self.error = error
+                    self.client.crash = True
+                self.cond.notify_all()
+
+class GameChannel:
+    def __init__(self, mux, gid):
+        self.mux = mux
+        self.gid = gid
+        self.name = mux.client.name
+        self.fid = mux.client.fid
+        self.support_analysis = mux.client.support_analysis
+
+    @property
+    def crash(self):
+        return self.mux.client.crash
+
+    @crash.setter
+    def crash(self, v):
+        self.mux.client.crash = v
+
+    def create_sockfile(self):
+        self.mux.open(self.gid)
+
+    def close_sockfile(self):
+        self.mux.close(self.gid)
+
+    def drop_stale_lines(self):
+        # The GameMux drops them before reading the replies.
+        pass
+
+    def request_poll(self):
+        # The broken connection is found by the other games.
+        pass
+
+    def request_setup(self, board_size,
+                            komi,
+                            main_time_msec,
+                            player_a_name,
+                            player_b_name,
+                            game_id=None):
+        param = "{} {} {} {} {} {}".format(
+                    self.gid,
+                    board_size,
+                    komi,
+                    main_time_msec,
+                    player_a_name,
+                    player_b_name
+                )
+        self.mux.send("setup {}".format(param))
+
+    def request_play(self, color, move, time_left_msec):
+        param = "{} {} {} {}".format(
+                    self.gid, color, move, time_left_msec
+                )
+        self.mux.send("play {}".format(param))
+
+    def request_genmove(self, color, time_left_msec):
+        param = "{} {} {}".format(
+                    self.gid, color, time_left_msec
+                )
+        self.mux.send("genmove {}".format(param))
+        return self.mux.receive(self.gid)
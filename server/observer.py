@@ -0,0 +1,99 @@
+from client import ClientSocketError
+from session import PushSession
+
+# The observer clients ('o1' protocol) watch the live games. The
+# observer sends the commands at any time, one per line.
+#
+#     watch <gid>: start receiving the events of the game
+#   unwatch <gid>: stop receiving the events of the game
+#            list: list the running games
+#
+# The server sends one JSON event per line. See the 'feed.py' for the
+# game events. The replies of commands are the 'games' and 'error'
+# events. The first line is always the 'games' event. The observer
+# should not send commands before it. The move events which arrive
+# before the first 'setup' or 'sync' event of the game can be ignored.
+#
+# The live streams of HTTP server are the sessions too. They are keyed
+# by the tuple instead of fid.
+
+class ObserverHub:
+    def __init__(self, max_buffer):
+        self.max_buffer = max_buffer
+        self.sessions = dict() # fid -> PushSession
+        self.watching = dict() # fid -> set of gids
+        self.watchers = dict() # gid -> set of fids
+
+    def add(self, client):
+        self.add_session(client.fid, PushSession(client, self.max_buffer))
+
+    def add_session(self, fid, session):
+        # The session has 'write', 'flush' and 'read_lines'.
+        self.sessions[fid] = session
+        self.watching[fid] = set()
+
+    def remove(self, fid):
+        # Return the gids which are not watched any more.
+        unwatched = list()
+        self.sessions.pop(fid, None)
+        for gid in self.watching.pop(fid, set()):
+            if self._leave(fid, gid):
+                unwatched.append(gid)
+        return unwatched
+
+    def watch(self, fid, gid):
+        # Return False if the observer already watches the game.
+        if gid in self.watching[fid]:
+            return False
+        self.watching[fid].add(gid)
+        self.watchers.setdefault(gid, set()).add(fid)
+        return True
+
+    def unwatch(self, fid, gid):
+        # Return True if it is the last watcher of the game.
+        if gid not in self.watching[fid]:
+            return False
+        self.watching[fid].discard(gid)
+        return self._leave(fid, gid)
+
+    def publish(self, gid, line, end=False):
+        # Write the serialized event to all watchers. The game is
+        # not watched any more after the last event. Return the
+        # fids whose buffer is full.
+        crashed = list()
+        fids = self.watchers.get(gid, set())
+        if end:
+            self.watchers.pop(gid, None)
+            for fid in fids:
+                self.watching[fid].discard(gid)
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        for fid in fids:
+            try:
+                self.sessions[fid].write(line)
+            except ClientSocketError:
+                crashed.append(fid)
+        return crashed
+
+    def send(self, fid, line):
+        self.sessions[fid].write(line)
+
+    def flush(self):
+        # Return the fids which can not be sent.
+        crashed = list()
+        for fid, session in self.sessions.items():
+            try:
+                session.flush()
+            except ClientSocketError:
+                crashed.append(fid)
+        return crashed
+
+    def _leave(self, fid, gid):
+        fids = self.watchers.get(gid, None)
+        if fids is None:
+            return False
+        fids.discard(fid)
+        if len(fids) == 0:
+            self.watchers.pop(gid)
+            return True
+        return False
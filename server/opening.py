@@ -0,0 +1,182 @@
+import os
+import random
+
+import board as brd
+from match import move_to_vertex
+from sgf import parse_sgf
+
+# The opening book is the list of validated openings. The path is one
+# SGF file or the directory of SGF files. Each file may contain many
+# games, like '(;SZ[9]KM[7];B[ee])(;SZ[9]KM[7];B[cc])'. Only the main
+# line of each game is used. The opening is the dict here.
+#
+#     {
+#         "name"       : "openings/9x9.sgf#1",
+#         "board_size" : 9,
+#         "komi"       : 7.0,
+#         "moves"      : ["e5", "c3", "pass"]
+#     }
+#
+# The book is parsed once and cached by the path. It is parsed again
+# only after the files are changed. The worker receives the moves in
+# the task, so it never reads the opening files.
+
+OPENING_ORDERS = ["sequential", "random"]
+
+_books = dict() # path -> OpeningBook
+
+def split_sgf_games(text):
+    # Return the main line of each game in the text.
+    games = list()
+    curr = list()
+    depth = 0
+    skip = 0 # The depth of the skipped variation.
+    done = list() # Whether the first variation of each depth is done.
+    in_value = False
+    escaped = False
+    for c in text:
+        if in_value:
+            if skip == 0:
+                curr.append(c)
+            if escaped:
+                escaped = False
+            elif c == '\\':
+                escaped = True
+            elif c == ']':
+                in_value = False
+            continue
+        if c == '[':
+            in_value = True
+        elif c == '(':
+            depth += 1
+            if skip > 0:
+                skip += 1
+                continue
+            if depth > 1 and done[-1]:
+                # Only play the first variation.
+                skip = 1
+                continue
+            done.append(False)
+            continue
+        elif c == ')':
+            if depth == 0:
+                continue
+            depth -= 1
+            if skip > 0:
+                skip -= 1
+                continue
+            done.pop()
+            if depth == 0:
+                games.append("({})".format("".join(curr)))
+                curr = list()
+            else:
+                done[-1] = True
+            continue
+        if skip == 0 and depth > 0:
+            curr.append(c)
+    return games
+
+def validate_opening(board_size, komi, history):
+    # Return the list of moves or None if the opening is invalid.
+    if board_size is None or not (2 <= board_size <= brd.BOARD_SIZE):
+        return None
+    board = brd.Board(board_size, brd.KOMI if komi is None else komi)
+    moves = list()
+    for move, _, _ in history:
+        if move is None:
+            continue
+        try:
+            move, vertex, _ = move_to_vertex(board, move, False)
+        except (IndexError, ValueError):
+            return None
+        if vertex == brd.RESIGN:
+            return None
+        if vertex != brd.PASS:
+            # The coordinate out of the board is wrapped to the
+            # other vertex.
+            x, y = board.get_x(vertex), board.get_y(vertex)
+            if not (0 <= x < board_size and 0 <= y < board_size) or \
+                   board.vertex_to_text(vertex).lower() != move:
+                return None
+        if not board.play(vertex) or board.num_passes >= 2:
+            # The opening should not end the game.
+            return None
+        moves.append(move)
+    return moves
+
+def get_signature(path):
+    # The names and modification times of the files.
+    if os.path.isdir(path):
+        files = [ os.path.join(path, v) for v in sorted(os.listdir(path)) if v.endswith(".sgf") ]
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        raise ValueError("There is no opening {}.".format(path))
+    return files, [ (f, os.path.getmtime(f)) for f in files ]
+
+class OpeningBook:
+    def __init__(self, path):
+        self.path = path
+        self.openings = list()
+        self.rejected = 0 # The number of invalid games.
+        self.next_index = 0
+        self.signature = None
+        self.load()
+
+    def load(self):
+        files, self.signature = get_signature(self.path)
+        self.openings = list()
+        self.rejected = 0
+        for f in files:
+            try:
+                with open(f, 'r', errors="replace") as fp:
+                    text = fp.read()
+            except OSError:
+                raise ValueError("Can not read the opening {}.".format(f))
+            for i, game in enumerate(split_sgf_games(text)):
+                if "AB[" in game or "AW[" in game:
+                    # The setup stones are not supported.
+                    self.rejected += 1
+                    continue
+                try:
+                    board_size, komi, history = parse_sgf(game)
+                except (TypeError, ValueError, IndexError):
+                    self.rejected += 1
+                    continue
+                moves = validate_opening(board_size, komi, history)
+                if moves is None:
+                    self.rejected += 1
+                    continue
+                self.openings.append({
+                    "name"       : "{}#{}".format(f, i),
+                    "board_size" : board_size,
+                    "komi"       : komi,
+                    "moves"      : moves
+                })
+        if len(self.openings) == 0:
+            raise ValueError("There is no valid opening in {}.".format(self.path))
+
+    def __len__(self):
+        return len(self.openings)
+
+    def get(self, index):
+        return self.openings[index % len(self.openings)]
+
+    def choose(self, order):
+        # Take the next opening in the order.
+        if order == "random":
+            return random.choice(self.openings)
+        opening = self.get(self.next_index)
+        self.next_index += 1
+        return opening
+
+def load_opening_book(path):
+    # Return the cached book. Raise ValueError if there is no valid
+    # opening.
+    book = _books.get(path, None)
+    if book is not None and get_signature(path)[1] != book.signature:
+        book = None
+    if book is None:
+        book = OpeningBook(path)
+        _books[path] = book
+    return book
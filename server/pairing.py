@@ -0,0 +1,144 @@
+import collections
+import random
+
+from rating import GLICKO_Q, glicko_g, glicko_expect
+
+# The automatic pairing of waiting engines. It runs the rounds like
+# CGOS. Each round pairs all free engines. The pair which played
+# recently is avoided and the engines sharing the name never play
+# each other. The engine which played black more often plays white.
+# The next round may start 'interval' seconds after the last round
+# which made pairs, so the engines freed later are paired at once.
+#
+# There are two policies.
+#     random: pair the engines in random order. Each engine takes the
+#             opponent with the fewest recent games.
+#     rating: pair the engines with the most information. The game
+#             of close strength or of uncertain ratings reduces the
+#             rating variance more. The recent pair is penalized.
+#             Only the 'neighbors' nearest names in rating are scored,
+#             so one round is fast with many engines.
+
+PAIRING_POLICIES = ["random", "rating"]
+
+def get_information(a, b):
+    # The 'a' and 'b' are (rating, rd). Return the expected reduction
+    # of the rating variance of both engines by one game.
+    info = 0
+    for (r, rd), (opp_r, opp_rd) in [(a, b), (b, a)]:
+        p = glicko_expect(r, opp_r, opp_rd)
+        x = GLICKO_Q ** 2 * glicko_g(opp_rd) ** 2 * p * (1 - p)
+        var = rd ** 2
+        info += var * var * x / (1 + var * x)
+    return info
+
+class PairingScheduler:
+    def __init__(self, interval, history, policy="random", repeat_penalty=1, neighbors=8):
+        if policy not in PAIRING_POLICIES:
+            raise ValueError("Unknown pairing policy {}.".format(policy))
+        self.interval = interval
+        self.clock_time = 0
+        self.policy = policy
+        self.repeat_penalty = repeat_penalty
+        self.neighbors = neighbors
+
+        # The names of recent games. Count the repeated pairs in them.
+        self.recent = collections.deque()
+        self.history = history
+        self.pair_counts = dict() # (name, name) -> number of games
+
+        # The number of black games minus white games.
+        self.colors = dict() # name -> balance
+
+    def due(self, now):
+        return now - self.clock_time >= self.interval
+
+    def record(self, black_name, white_name):
+        # Every started game is recorded, including the manual ones.
+        pair = self._get_pair(black_name, white_name)
+        self.recent.append(pair)
+        self.pair_counts[pair] = self.pair_counts.get(pair, 0) + 1
+        while len(self.recent) > self.history:
+            old = self.recent.popleft()
+            self.pair_counts[old] -= 1
+            if self.pair_counts[old] == 0:
+                self.pair_counts.pop(old)
+        self.colors[black_name] = self.colors.get(black_name, 0) + 1
+        self.colors[white_name] = self.colors.get(white_name, 0) - 1
+
+    def make_pairs(self, engines, now, rating=None):
+        # The 'engines' is the list of (fid, name). The 'rating' is
+        # the RatingBook for the 'rating' policy. Return the list of
+        # (black fid, white fid).
+        if self.policy == "rating" and rating is not None:
+            matched = self.match_by_rating(engines, now, rating)
+        else:
+            matched = self.match_by_random(engines)
+        pairs = list()
+        for (fid, name), (other_fid, other_name) in matched:
+            if self.colors.get(name, 0) <= self.colors.get(other_name, 0):
+                pairs.append((fid, other_fid))
+            else:
+                pairs.append((other_fid, fid))
+        if len(pairs) > 0:
+            self.clock_time = now
+        return pairs
+
+    def match_by_random(self, engines):
+        engines = list(engines)
+        random.shuffle(engines)
+        matched = list()
+        while len(engines) >= 2:
+            fid, name = engines.pop()
+            best = None
+            best_count = None
+            for i, (_, other) in enumerate(engines):
+                if other == name:
+                    continue
+                count = self.pair_counts.get(self._get_pair(name, other), 0)
+                if best is None or count < best_count:
+                    best, best_count = i, count
+            if best is None:
+                # All others share the name.
+                continue
+            matched.append(((fid, name), engines.pop(best)))
+        return matched
+
+    def match_by_rating(self, engines, now, rating):
+        # The instances of one name share the rating, so score the
+        # pairs of names. Sort the names by rating and only score each
+        # name with its nearest names. Take the best pairs greedily.
+        # Then pair the rest again until no pair is found.
+        groups = dict() # name -> instances
+        for fid, name in engines:
+            groups.setdefault(name, list()).append((fid, name))
+        for instances in groups.values():
+            random.shuffle(instances) # Break the ties randomly.
+        estimates = dict([ (name, rating.get_estimate(name, now)) for name in groups.keys() ])
+        names = list(groups.keys())
+        random.shuffle(names)
+        names.sort(key=lambda name: estimates[name][0])
+
+        matched = list()
+        while True:
+            names = [ name for name in names if len(groups[name]) > 0 ]
+            scores = list()
+            for i in range(len(names)):
+                for j in range(i + 1, min(len(names), i + 1 + self.neighbors)):
+                    a, b = names[i], names[j]
+                    count = self.pair_counts.get(self._get_pair(a, b), 0)
+                    score = get_information(estimates[a], estimates[b]) / (1 + self.repeat_penalty * count)
+                    scores.append((score, a, b))
+            if len(scores) == 0:
+                break
+            scores.sort(key=lambda v: -v[0])
+            for _, a, b in scores:
+                while len(groups[a]) > 0 and len(groups[b]) > 0:
+                    matched.append((groups[a].pop(), groups[b].pop()))
+        return matched
+
+    def get_status(self):
+        return [ (a, b, n) for (a, b), n in sorted(self.pair_counts.items()) ]
+
+    def _get_pair(self, a, b):
+        return (a, b) if a <= b else (b, a)
@@ -0,0 +1,97 @@
+from rating import RATED_TYPES
+
+# The engine pools. The engines with the same name, like 'leela-0.17',
+# are the instances of one pool. The match and series given by name
+# take any waiting instance of the pool, so we scale one engine by
+# connecting more instances. The instance which started the fewest
+# games is taken first, so the games are spread over the instances.
+#
+# The stats of each pool are the sums over all its instances, including
+# the closed ones.
+
+class EnginePools:
+    def __init__(self):
+        self.pools = dict() # name -> stats
+        self.started = dict() # fid -> number of started games
+
+    def get_pool(self, name):
+        p = self.pools.get(name, None)
+        if p is None:
+            p = {
+                "joined"       : 0, # The connected instances.
+                "left"         : 0, # The closed instances.
+                "crashes"      : 0, # The instances closed during the game.
+                "games"        : 0,
+                "wins"         : 0,
+                "losses"       : 0,
+                "draws"        : 0,
+                "result_types" : dict(), # type -> number of games
+                "moves"        : 0
+            }
+            self.pools[name] = p
+        return p
+
+    def add_instance(self, name, fid):
+        self.get_pool(name)["joined"] += 1
+        self.started[fid] = 0
+
+    def remove_instance(self, name, fid, playing):
+        p = self.get_pool(name)
+        p["left"] += 1
+        if playing:
+            p["crashes"] += 1
+        self.started.pop(fid, None)
+
+    def pick(self, fids, waiting, exclude):
+        # Return the waiting instance which started the fewest games
+        # or None.
+        best = None
+        for fid in fids:
+            if fid not in waiting or fid in exclude:
+                continue
+            if best is None or self.started.get(fid, 0) < self.started.get(best, 0):
+                best = fid
+        return best
+
+    def record_start(self, fid):
+        self.started[fid] = self.started.get(fid, 0) + 1
+
+    def add_result(self, black, white, result, result_type, moves):
+        # The 'result' is like 'B+Resign', 'W+3.5' or '0'. The broken
+        # games are not counted.
+        if result is None or result_type not in RATED_TYPES:
+            return
+        for name, is_black in [(black, True), (white, False)]:
+            p = self.get_pool(name)
+            p["games"] += 1
+            if result == "0":
+                p["draws"] += 1
+            elif result.startswith("B+") == is_black:
+                p["wins"] += 1
+            else:
+                p["losses"] += 1
+            p["result_types"][result_type] = p["result_types"].get(result_type, 0) + 1
+            if moves is not None:
+                p["moves"] += moves
+
+    def get_records(self, index, client_pool):
+        # The stats of all pools with the current instances.
+        records = list()
+        for name, p in sorted(self.pools.items()):
+            fids = [ fid for fid in index.get_fids_by_name(name)
+                         if client_pool[fid]["socket"].type == "engine" ]
+            waiting = len([ fid for fid in fids if fid in index.waiting ])
+            playing = len([ fid for fid in fids if client_pool[fid]["status"] == "playing" ])
+            games = p["games"]
+            record = {
+                "name"       : name,
+                "instances"  : len(fids),
+                "waiting"    : waiting,
+                "playing"    : playing,
+                "score"      : (p["wins"] + 0.5 * p["draws"]) / games if games > 0 else None,
+                "moves_mean" : p["moves"] / games if games > 0 else None
+            }
+            record.update(p)
+            record["result_types"] = dict(p["result_types"])
+            records.append(record)
+        return records
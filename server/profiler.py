@@ -0,0 +1,83 @@
+import cProfile
+import collections
+import threading
+import time
+import sys
+import os
+
+# Two kinds of profilers are supported.
+#
+#  cprofile: The deterministic profiler. It only profiles the thread
+#            which starts it. Dump the pstats file.
+#    sample: The sampling profiler. It samples the stacks of all
+#            threads in a background thread with low overhead. Dump
+#            the collapsed stacks file which can be read by the flame
+#            graph tools.
+
+class CProfiler:
+    suffix = "pstats"
+
+    def __init__(self):
+        self._prof = None
+
+    def start(self):
+        self._prof = cProfile.Profile()
+        self._prof.enable()
+
+    def stop(self, path):
+        self._prof.disable()
+        self._prof.dump_stats(path)
+        self._prof = None
+
+class SamplingProfiler:
+    suffix = "collapsed"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._counts = collections.Counter()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(
+                           target=self._sample_loop,
+                           daemon=True
+                       )
+        self._thread.start()
+
+    def stop(self, path):
+        self._running = False
+        self._thread.join()
+        with open(path, 'w') as f:
+            for stack, count in self._counts.most_common():
+                f.write("{} {}\n".format(stack, count))
+        self._counts.clear()
+
+    def _sample_loop(self):
+        own_ident = threading.get_ident()
+        while self._running:
+            names = { t.ident : t.name for t in threading.enumerate() }
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                stack = list()
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("{} ({}:{})".format(
+                        code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-{}".format(ident)))
+                self._counts[";".join(reversed(stack))] += 1
+            time.sleep(self.interval)
+
+def create_profiler(mode, interval):
+    if mode == "cprofile":
+        return CProfiler()
+    elif mode == "sample":
+        return SamplingProfiler(interval)
+    return None
+
+def get_profile_path(root, who, profiler):
+    date = time.strftime("%Y-%m-%d-%H-%M-%S")
+    return os.path.join(root, "{}-{}.{}".format(who, date, profiler.suffix))
@@ -0,0 +1,199 @@
+import json
+import math
+import os
+
+from snapshot import dump_snapshot, save_snapshot
+
+# The ratings of engines by name. There are two kinds of ratings.
+#
+# The online rating is Glicko. It is updated as each game finishes, so
+# it is always current. The RD grows with the idle days.
+#
+# The batch rating is like BayesElo. It fits the Bradley-Terry model to
+# all games by the MM algorithm. We cache the pairwise W/D/L counts of
+# every two engines, so the batch never reads the SGF files. A draw is
+# counted as half win and half loss. Each engine also draws virtual
+# games against the engine of average strength as the prior.
+#
+# The state is saved as one JSON file and loaded after restart.
+
+RATING_VERSION = 1
+
+# Only these games are rated. The others are broken games.
+RATED_TYPES = ["time out", "resign", "illegal move", "double pass"]
+
+GLICKO_Q = math.log(10) / 400
+
+def glicko_g(rd):
+    return 1 / math.sqrt(1 + 3 * (GLICKO_Q * rd) ** 2 / math.pi ** 2)
+
+def glicko_expect(rating, opp_rating, opp_rd):
+    e = 1 / (1 + 10 ** (-glicko_g(opp_rd) * (rating - opp_rating) / 400))
+    # Avoid the infinite variance of the very different ratings.
+    return min(max(e, 1e-6), 1 - 1e-6)
+
+class RatingBook:
+    def __init__(self, path, initial, initial_rd, min_rd, rd_per_day, prior_games):
+        self.path = path
+        self.initial = initial
+        self.initial_rd = initial_rd
+        self.min_rd = min_rd
+        self.rd_per_day = rd_per_day
+        self.prior_games = prior_games
+
+        self.players = dict() # name -> { "rating", "rd", "games", "last" }
+        self.pairs = dict() # (name, name) -> [wins, draws, losses] of the first one
+        self.batch = dict() # name -> batch rating
+        self.games = 0
+        self.dirty = False # The games after the last batch.
+        self.saved = True
+
+    def get_player(self, name, now):
+        # Return the Glicko state of the player. The RD grows with
+        # the idle time.
+        p = self.players.get(name, None)
+        if p is None:
+            p = { "rating" : self.initial, "rd" : self.initial_rd, "games" : 0, "last" : now }
+            self.players[name] = p
+        days = max(0, now - p["last"]) / 86400
+        p["rd"] = min(self.initial_rd, math.sqrt(p["rd"] ** 2 + days * self.rd_per_day ** 2))
+        p["last"] = now
+        return p
+
+    def get_estimate(self, name, now):
+        # Return the rating and RD without changing the state.
+        p = self.players.get(name, None)
+        if p is None:
+            return self.initial, self.initial_rd
+        days = max(0, now - p["last"]) / 86400
+        return p["rating"], min(self.initial_rd, math.sqrt(p["rd"] ** 2 + days * self.rd_per_day ** 2))
+
+    def add_game(self, black, white, result, result_type, now):
+        # Return False if the game is not rated.
+        if result_type not in RATED_TYPES or black == white:
+            return False
+        if result is None or result == "0":
+            score = 0.5
+        elif result.startswith("B+"):
+            score = 1
+        elif result.startswith("W+"):
+            score = 0
+        else:
+            return False
+
+        # Update both players with the ratings before the game.
+        pb = self.get_player(black, now)
+        pw = self.get_player(white, now)
+        b_state = (pb["rating"], pb["rd"])
+        w_state = (pw["rating"], pw["rd"])
+        self.update_glicko(pb, w_state, score)
+        self.update_glicko(pw, b_state, 1 - score)
+
+        if black <= white:
+            key, k = (black, white), score
+        else:
+            key, k = (white, black), 1 - score
+        counts = self.pairs.setdefault(key, [0, 0, 0])
+        counts[{ 1 : 0, 0.5 : 1, 0 : 2 }[k]] += 1
+        self.games += 1
+        self.dirty = True
+        self.saved = False
+        return True
+
+    def update_glicko(self, p, opp_state, score):
+        opp_rating, opp_rd = opp_state
+        g = glicko_g(opp_rd)
+        e = glicko_expect(p["rating"], opp_rating, opp_rd)
+        d2 = 1 / (GLICKO_Q ** 2 * g ** 2 * e * (1 - e))
+        inv = 1 / p["rd"] ** 2 + 1 / d2
+        p["rating"] += GLICKO_Q / inv * g * (score - e)
+        p["rd"] = max(self.min_rd, math.sqrt(1 / inv))
+        p["games"] += 1
+
+    def recompute(self, max_iterations=1000, tolerance=1e-7):
+        # The MM algorithm of Bradley-Terry model over the cached
+        # counts. The gamma of the virtual engine is 1.
+        names = sorted(self.players.keys())
+        if len(names) == 0:
+            return
+        wins = dict([ (v, 0.5 * self.prior_games) for v in names ])
+        opponents = dict([ (v, list()) for v in names ]) # name -> [(name, games)]
+        for (a, b), (w, d, l) in self.pairs.items():
+            n = w + d + l
+            wins[a] += w + 0.5 * d
+            wins[b] += l + 0.5 * d
+            opponents[a].append((b, n))
+            opponents[b].append((a, n))
+
+        gamma = dict([ (v, 1.0) for v in names ])
+        for _ in range(max_iterations):
+            change = 0
+            for v in names:
+                denom = self.prior_games / (gamma[v] + 1)
+                for opp, n in opponents[v]:
+                    denom += n / (gamma[v] + gamma[opp])
+                new_gamma = wins[v] / denom if denom > 0 else 1.0
+                change = max(change, abs(math.log(max(new_gamma, 1e-300) / gamma[v])))
+                gamma[v] = max(new_gamma, 1e-300)
+            if change < tolerance:
+                break
+
+        # The average batch rating is the initial rating.
+        elos = dict([ (v, 400 * math.log10(gamma[v])) for v in names ])
+        offset = self.initial - sum(elos.values()) / len(elos)
+        self.batch = dict([ (v, elo + offset) for v, elo in elos.items() ])
+        self.dirty = False
+        self.saved = False
+
+    def get_records(self):
+        # Sorted by the online rating.
+        records = list()
+        for name, p in self.players.items():
+            records.append({
+                "name"   : name,
+                "rating" : p["rating"],
+                "rd"     : p["rd"],
+                "games"  : p["games"],
+                "batch"  : self.batch.get(name, None)
+            })
+        records.sort(key=lambda r: -r["rating"])
+        return records
+
+    def get_pair(self, a, b):
+        # Return the wins, draws and losses of 'a' against 'b'.
+        if a <= b:
+            return list(self.pairs.get((a, b), [0, 0, 0]))
+        w, d, l = self.pairs.get((b, a), [0, 0, 0])
+        return [l, d, w]
+
+    def save(self):
+        if self.saved:
+            return
+        state = {
+            "version" : RATING_VERSION,
+            "games"   : self.games,
+            "players" : self.players,
+            "pairs"   : [ [a, b] + counts for (a, b), counts in self.pairs.items() ],
+            "batch"   : self.batch
+        }
+        save_snapshot(self.path, dump_snapshot(state))
+        self.saved = True
+
+    def load(self):
+        # Return False if there is no valid file.
+        if not os.path.isfile(self.path):
+            return False
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if state.get("version", None) != RATING_VERSION:
+            return False
+        self.games = state["games"]
+        self.players = state["players"]
+        self.pairs = dict([ ((v[0], v[1]), v[2:]) for v in state["pairs"] ])
+        self.batch = state["batch"]
+        self.dirty = False
+        self.saved = True
+        return True
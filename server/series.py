@@ -0,0 +1,219 @@
+import math
+import random
+
+from opening import load_opening_book
+from rating import RATED_TYPES
+
+# The match series plays N games between two engines. The games of
+# one pair share the opening and swap the colors. The master submits
+# the next games into the pending queue as the games finish and keeps
+# at most 'concurrency' games in flight.
+#
+#     game 0: A(B) vs B(W), opening 0
+#     game 1: B(B) vs A(W), opening 0
+#     game 2: A(B) vs B(W), opening 1
+#     ...
+#
+# The openings are taken from the book in the 'sequential' or 'random'
+# order. The random order is one shuffled cycle of all openings, so no
+# opening repeats before all are played. See 'opening.py'.
+#
+# The series with SPRT stops submitting the games once the test
+# accepts one hypothesis. See 'sprt.py'.
+
+class MatchSeries:
+    def __init__(self, series_id, a, b, games, setting, concurrency=1, openings=None, sprt=None, opening_order="sequential",
+                       priority="normal", submitter="console"):
+        # The players are the dicts with 'fid' and 'name'.
+        self.series_id = series_id
+        self.players = [a, b]
+        self.games = games
+        self.setting = setting
+        self.concurrency = concurrency
+        self.openings = openings
+        self.opening_order = opening_order
+        self.book = None if openings is None else load_opening_book(openings)
+        self.opening_indices = list() if self.book is None else list(range(len(self.book)))
+        if opening_order == "random":
+            random.shuffle(self.opening_indices)
+        self.sprt = sprt
+
+        # The games are submitted with the priority class.
+        self.priority = priority
+        self.submitter = submitter
+
+        self.next_index = 0
+        self.requeued = list() # The lost games to play again.
+        self.inflight = dict() # game index -> match id
+        self.stopped = None # The reason of stop.
+
+        # The results from the view of A.
+        self.wins = 0
+        self.losses = 0
+        self.draws = 0
+        self.black_wins = 0 # A wins with black
+        self.white_wins = 0 # A wins with white
+        self.result_types = dict() # type -> number of games
+        self.moves_total = 0
+        self.moves_min = None
+        self.moves_max = None
+
+    def finished(self):
+        return self.wins + self.losses + self.draws
+
+    def done(self):
+        if self.stopped is not None:
+            return len(self.inflight) == 0
+        return self.finished() >= self.games and len(self.inflight) == 0
+
+    def next_games(self):
+        # Return the list of (index, black, white, setting) to submit.
+        out = list()
+        while self.stopped is None and len(self.inflight) < self.concurrency:
+            if len(self.requeued) > 0:
+                index = self.requeued.pop(0)
+            elif self.next_index < self.games:
+                index = self.next_index
+                self.next_index += 1
+            else:
+                break
+            a, b = self.players
+            black, white = (a, b) if index % 2 == 0 else (b, a)
+            setting = dict(self.setting)
+            if self.book is not None:
+                k = (index // 2) % len(self.opening_indices)
+                setting["opening"] = self.book.get(self.opening_indices[k])
+            self.inflight[index] = None
+            out.append((index, dict(black), dict(white), setting))
+        return out
+
+    def set_match_id(self, index, match_id):
+        self.inflight[index] = match_id
+
+    def lose(self, index):
+        # The game is lost without result. Play it again.
+        self.inflight.pop(index, None)
+        if self.stopped is None:
+            self.requeued.append(index)
+
+    def add_result(self, index, result, result_type, moves):
+        # The 'result' is like 'B+Resign', 'W+3.5' or '0'.
+        if index not in self.inflight:
+            return
+        if result_type not in RATED_TYPES:
+            # The broken game, like the socket error, is not a draw.
+            self.lose(index)
+            return
+        self.inflight.pop(index)
+        a_is_black = index % 2 == 0
+        if result is None or result == "0":
+            self.draws += 1
+            score = 0.5
+        elif result.startswith("B+") == a_is_black:
+            self.wins += 1
+            score = 1
+            if a_is_black:
+                self.black_wins += 1
+            else:
+                self.white_wins += 1
+        else:
+            self.losses += 1
+            score = 0
+        if self.sprt is not None:
+            self.sprt.add(index, score)
+        self.result_types[result_type] = self.result_types.get(result_type, 0) + 1
+        if moves is not None:
+            self.moves_total += moves
+            self.moves_min = moves if self.moves_min is None else min(self.moves_min, moves)
+            self.moves_max = moves if self.moves_max is None else max(self.moves_max, moves)
+
+    def stop(self, reason):
+        if self.stopped is None:
+            self.stopped = reason
+
+    def get_score(self):
+        n = self.finished()
+        if n == 0:
+            return None
+        return (self.wins + 0.5 * self.draws) / n
+
+    def get_elo(self):
+        # The Elo difference of A over B by the score.
+        score = self.get_score()
+        if score is None or score <= 0 or score >= 1:
+            return None
+        return 400 * math.log10(score / (1 - score))
+
+    def get_record(self):
+        n = self.finished()
+        return {
+            "series_id"    : self.series_id,
+            "a"            : dict(self.players[0]),
+            "b"            : dict(self.players[1]),
+            "games"        : self.games,
+            "setting"      : dict(self.setting),
+            "openings"     : self.openings,
+            "opening_order" : self.opening_order,
+            "priority"     : self.priority,
+            "submitter"    : self.submitter,
+            "concurrency"  : self.concurrency,
+            "finished"     : n,
+            "running"      : len(self.inflight),
+            "wins"         : self.wins,
+            "losses"       : self.losses,
+            "draws"        : self.draws,
+            "black_wins"   : self.black_wins,
+            "white_wins"   : self.white_wins,
+            "result_types" : dict(self.result_types),
+            "moves_mean"   : self.moves_total / n if n > 0 else None,
+            "moves_min"    : self.moves_min,
+            "moves_max"    : self.moves_max,
+            "score"        : self.get_score(),
+            "elo"          : self.get_elo(),
+            "sprt"         : None if self.sprt is None else self.sprt.get_record(),
+            "stopped"      : self.stopped
+        }
+
+    def get_state(self):
+        # The record and the cursors of the games and openings. The
+        # series is restored from it after restart.
+        state = self.get_record()
+        state.update({
+            "next_index"      : self.next_index,
+            "opening_indices" : list(self.opening_indices),
+            "requeued"        : list(self.requeued),
+            "inflight"        : list(self.inflight.keys()),
+            "moves_total"     : self.moves_total,
+            "sprt_state"      : None if self.sprt is None else self.sprt.get_state()
+        })
+        return state
+
+    def set_state(self, state):
+        # Raise ValueError if the opening book is changed.
+        if self.book is not None and \
+               sorted(state["opening_indices"]) != list(range(len(self.book))):
+            raise ValueError("The opening book {} is changed.".format(self.openings))
+        self.opening_indices = list(state["opening_indices"])
+        self.next_index = state["next_index"]
+        self.requeued = list(state["requeued"])
+        # The master links the restored matches again. The others
+        # are played again.
+        self.inflight = { index : None for index in state["inflight"] }
+        self.stopped = state["stopped"]
+        for k in ["wins", "losses", "draws", "black_wins", "white_wins",
+                      "moves_total", "moves_min", "moves_max"]:
+            setattr(self, k, state[k])
+        self.result_types = dict(state["result_types"])
+        if self.sprt is not None:
+            self.sprt.set_state(state["sprt_state"])
+
+    def get_summary(self):
+        elo = self.get_elo()
+        return "{}(A) vs {}(B), {}/{} games, +{} -{} ={}{}{}{}".format(
+                   self.players[0]["name"] or self.players[0]["fid"],
+                   self.players[1]["name"] or self.players[1]["fid"],
+                   self.finished(), self.games,
+                   self.wins, self.losses, self.draws,
+                   "" if elo is None else ", elo {:+.1f}".format(elo),
+                   "" if self.sprt is None else ", {}".format(self.sprt.get_summary()),
+                   "" if self.stopped is None else ", stopped ({})".format(self.stopped))
@@ -0,0 +1,56 @@
+import socket
+
+from client import ClientSocketError
+
+class PushSession:
+    # The persistent connection of push mode manager. The master never
+    # waits for the manager. The outbound lines are buffered and sent
+    # without blocking. The inbound lines are collected without blocking
+    # too. The manager which can not keep up is closed when the buffer
+    # exceeds 'max_buffer' bytes.
+
+    def __init__(self, client, max_buffer):
+        self.client = client
+        self.max_buffer = max_buffer
+        self._out_buf = bytearray()
+        self._in_buf = client.unread
+        client.unread = bytes()
+
+        # Send the full status first. The manager asks for it again
+        # if it misses a delta.
+        self.synced = False
+
+    def write(self, line):
+        # The 'line' is str or the encoded bytes without newline.
+        if isinstance(line, str):
+            line = line.encode("utf-8")
+        self._out_buf += line
+        self._out_buf += b"\n"
+        if len(self._out_buf) > self.max_buffer:
+            raise ClientSocketError(self.client, "The push buffer is full.")
+
+    def flush(self):
+        while len(self._out_buf) > 0:
+            try:
+                n = self.client.sock.send(self._out_buf, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+            except:
+                raise ClientSocketError(self.client, "Can not send massage to client.")
+            del self._out_buf[:n]
+
+    def read_lines(self):
+        # Return all complete lines.
+        while True:
+            try:
+                data = self.client.sock.recv(65536, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
+            except:
+                raise ClientSocketError(self.client, "Can not read massage from client.")
+            if len(data) == 0:
+                raise ClientSocketError(self.client, "The client is closed.")
+            self._in_buf += data
+        lines = self._in_buf.split(b"\n")
+        self._in_buf = lines.pop()
+        return [ v.decode("utf-8", errors="replace").strip() for v in lines ]
@@ -73,7 +73,8 @@ def parse_sgf(sgf):
         elif key == "KM":
             komi = float(value)
         elif key in ["B", "W"]:
-            if len(value) == 0:
+            if len(value) == 0 or (value == "tt" and board_size <= 19):
+                # The 'tt' is the pass of FF[3].
                 task["move"] = "pass"
             else:
                 x = value[0]
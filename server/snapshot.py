@@ -0,0 +1,33 @@
+import json
+import os
+
+# The master state is saved as one compact JSON file. Write it into
+# a temporary file first and then rename it, so a crash during the
+# writing never leaves a broken snapshot.
+
+SNAPSHOT_VERSION = 1
+
+def dump_snapshot(state):
+    return json.dumps(state, indent=None, separators=(",", ":"), sort_keys=True)
+
+def save_snapshot(path, data):
+    # The 'data' is the dumped string.
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, 'w') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_snapshot(path):
+    # Return None if there is no valid snapshot.
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get("version", None) != SNAPSHOT_VERSION:
+        return None
+    return state
@@ -0,0 +1,115 @@
+import math
+
+# The sequential probability ratio test of the match series. It tests
+# H0: elo = elo0 against H1: elo = elo1 for the engine A. We use the
+# generalized SPRT approximation of the log-likelihood ratio,
+#
+#     LLR = N * (s1 - s0) * (2 * mu - s0 - s1) / (2 * var)
+#
+# where s0 and s1 are the expected scores of elo0 and elo1, mu and var
+# are the mean and variance of the samples and N is the number of
+# samples. The test accepts H1 if LLR >= ln((1 - beta) / alpha) and
+# accepts H0 if LLR <= ln(beta / (1 - alpha)).
+#
+# The 'trinomial' model uses each game as one sample, the loss, draw
+# or win. The 'pentanomial' model uses each color-swapped pair of games
+# as one sample with five outcomes. It is more accurate because the
+# two games of one pair share the opening.
+
+TRINOMIAL_SCORES = [0, 0.5, 1]
+PENTANOMIAL_SCORES = [0, 0.25, 0.5, 0.75, 1]
+
+SPRT_MODELS = ["trinomial", "pentanomial"]
+
+def elo_to_score(elo):
+    return 1 / (1 + 10 ** (-elo / 400))
+
+def get_bounds(alpha, beta):
+    # Return the lower and upper bounds of LLR.
+    return math.log(beta / (1 - alpha)), math.log((1 - beta) / alpha)
+
+def get_llr(scores, counts, elo0, elo1):
+    n = sum(counts)
+    if n == 0:
+        return 0.0
+    mean = sum([ s * c for s, c in zip(scores, counts) ]) / n
+    var = sum([ c * (s - mean) ** 2 for s, c in zip(scores, counts) ]) / n
+    if var <= 0:
+        # Not enough information yet, like all games are draws.
+        return 0.0
+    s0, s1 = elo_to_score(elo0), elo_to_score(elo1)
+    return n * (s1 - s0) * (2 * mean - s0 - s1) / (2 * var)
+
+class Sprt:
+    def __init__(self, elo0, elo1, alpha, beta, model):
+        if model not in SPRT_MODELS:
+            raise ValueError("Unknown SPRT model {}.".format(model))
+        if not (0 < alpha < 1 and 0 < beta < 1) or elo0 >= elo1:
+            raise ValueError("Invalid SPRT parameters.")
+        self.elo0 = elo0
+        self.elo1 = elo1
+        self.alpha = alpha
+        self.beta = beta
+        self.model = model
+        self.lower, self.upper = get_bounds(alpha, beta)
+        self.trinomial = [0] * 3 # loss, draw, win
+        self.pentanomial = [0] * 5 # pair score 0, 0.25, 0.5, 0.75, 1
+        self.pairs = dict() # pair index -> score of the first game
+
+    def add(self, index, score):
+        # The 'score' of A is 0, 0.5 or 1. The games '2k' and '2k+1'
+        # are one pair.
+        self.trinomial[int(2 * score)] += 1
+        k = index // 2
+        first = self.pairs.pop(k, None)
+        if first is None:
+            self.pairs[k] = score
+        else:
+            self.pentanomial[int(round(2 * (first + score)))] += 1
+
+    def get_llr(self):
+        if self.model == "pentanomial":
+            return get_llr(PENTANOMIAL_SCORES, self.pentanomial, self.elo0, self.elo1)
+        return get_llr(TRINOMIAL_SCORES, self.trinomial, self.elo0, self.elo1)
+
+    def get_result(self):
+        # Return 'H1', 'H0' or None if the test goes on.
+        llr = self.get_llr()
+        if llr >= self.upper:
+            return "H1"
+        if llr <= self.lower:
+            return "H0"
+        return None
+
+    def get_record(self):
+        return {
+            "elo0"        : self.elo0,
+            "elo1"        : self.elo1,
+            "alpha"       : self.alpha,
+            "beta"        : self.beta,
+            "model"       : self.model,
+            "llr"         : self.get_llr(),
+            "lower"       : self.lower,
+            "upper"       : self.upper,
+            "trinomial"   : list(self.trinomial),
+            "pentanomial" : list(self.pentanomial),
+            "result"      : self.get_result()
+        }
+
+    def get_state(self):
+        # The counts saved in the snapshot. The JSON keys must be
+        # strings, so the pairs are a list.
+        return {
+            "trinomial"   : list(self.trinomial),
+            "pentanomial" : list(self.pentanomial),
+            "pairs"       : [ [k, v] for k, v in self.pairs.items() ]
+        }
+
+    def set_state(self, state):
+        self.trinomial = list(state["trinomial"])
+        self.pentanomial = list(state["pentanomial"])
+        self.pairs = { k : v for k, v in state["pairs"] }
+
+    def get_summary(self):
+        return "llr {:.2f} [{:.2f}, {:.2f}] ({}, {})".format(
+                   self.get_llr(), self.lower, self.upper, self.elo0, self.elo1)
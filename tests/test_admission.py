@@ -0,0 +1,100 @@
+import collections
+import logging
+import socket
+
+import pytest
+
+import config
+from admission import RateLimiter
+from master import MasterSocket
+from metrics import Metrics
+
+class Master:
+    # Borrow the admission methods. The real master starts the
+    # workers too.
+    accept_clients = MasterSocket.accept_clients
+    check_admission = MasterSocket.check_admission
+    admit_waiting_connections = MasterSocket.admit_waiting_connections
+    start_handshake = MasterSocket.start_handshake
+
+    def __init__(self, rate, burst):
+        self.logger = logging.getLogger("test.Master")
+        self.metrics = Metrics()
+        self.handshakes = dict()
+        self.waiting_connections = collections.deque()
+        self.rate_limiter = RateLimiter(rate, burst)
+        self.server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_sock.bind(("127.0.0.1", 0))
+        self.server_sock.listen(16)
+        self.server_sock.setblocking(False)
+
+    def connect(self, n):
+        socks = [ socket.create_connection(self.server_sock.getsockname()) for _ in range(n) ]
+        for s in socks:
+            s.settimeout(1)
+        return socks
+
+    def close(self):
+        for h in self.handshakes.values():
+            h.close()
+        for s, _ in self.waiting_connections:
+            s.close()
+        self.server_sock.close()
+
+@pytest.fixture
+def limits(monkeypatch):
+    monkeypatch.setattr(config, "MAX_HANDSHAKES", 2)
+    monkeypatch.setattr(config, "MAX_HANDSHAKES_PER_ADDR", None)
+    monkeypatch.setattr(config, "MAX_WAITING_CONNECTIONS", 2)
+
+def got_request(s):
+    # The handshake starts with the protocol request.
+    s.settimeout(0.2)
+    try:
+        return s.recv(64).startswith(b"protocol")
+    except socket.timeout:
+        return False
+
+def test_waiting_connection_starts_later(limits):
+    m = Master(None, None)
+    socks = m.connect(3)
+    m.accept_clients(0)
+    assert len(m.handshakes) == 2
+    assert [ h for _, h in m.waiting_connections ] == ["127.0.0.1"]
+    assert not got_request(socks[2])
+
+    # One handshake is over. The waiting connection goes on.
+    m.handshakes.popitem()[1].close()
+    m.admit_waiting_connections(0)
+    assert len(m.handshakes) == 2
+    assert len(m.waiting_connections) == 0
+    assert got_request(socks[2])
+    m.close()
+
+def test_too_many_waiting_connections(limits):
+    m = Master(None, None)
+    socks = m.connect(5)
+    m.accept_clients(0)
+    assert len(m.handshakes) == 2
+    assert len(m.waiting_connections) == 2
+    # The last one is closed.
+    assert socks[4].recv(64) == b""
+    assert "cgos_admission_rejected_total" in m.metrics.render()
+    m.close()
+
+def test_rate_limited_connection_waits(limits):
+    m = Master(1, 1)
+    socks = m.connect(2)
+    m.accept_clients(0)
+    assert len(m.handshakes) == 1
+    assert len(m.waiting_connections) == 1
+
+    # No new token yet.
+    m.admit_waiting_connections(0.5)
+    assert len(m.waiting_connections) == 1
+    assert not got_request(socks[1])
+
+    m.admit_waiting_connections(1.0)
+    assert len(m.waiting_connections) == 0
+    assert got_request(socks[1])
+    m.close()
@@ -0,0 +1,58 @@
+import socket
+
+from client import ClientSocket
+from handoff import create_channel, send_client, recv_client
+
+def make_client(fid):
+    # The master's side of an engine connection.
+    engine_sock, server_sock = socket.socketpair()
+    c = ClientSocket()
+    c.sock = server_sock
+    c.fid = fid
+    c.name = "engine{}".format(fid)
+    c.type = "engine"
+    c.slots = 2
+    return c, engine_sock
+
+def test_handoff_duplicates_the_client():
+    channel, worker_channel = create_channel()
+    c, engine_sock = make_client(7)
+    send_client(channel, c)
+    w = recv_client(worker_channel)
+
+    assert w.fid == 7
+    assert w.name == "engine7"
+    assert w.type == "engine"
+    assert w.slots == 2
+    assert w.sock.fileno() != c.sock.fileno()
+
+    # Both copies talk to the same engine.
+    w.sock.sendall(b"genmove b\n")
+    assert engine_sock.recv(64) == b"genmove b\n"
+    engine_sock.sendall(b"= D4\n")
+    assert w.sock.recv(64) == b"= D4\n"
+
+def test_release_keeps_the_other_copy():
+    channel, worker_channel = create_channel()
+    c, engine_sock = make_client(3)
+    send_client(channel, c)
+    w = recv_client(worker_channel)
+
+    # The worker releases its copy. The master still holds the
+    # connection.
+    w.release()
+    assert w.sock is None
+    c.sock.sendall(b"username\n")
+    assert engine_sock.recv(64) == b"username\n"
+
+    # The engine sees the EOF after the last copy is released.
+    c.release()
+    engine_sock.settimeout(1)
+    assert engine_sock.recv(64) == b""
+
+def test_handoff_order():
+    channel, worker_channel = create_channel()
+    clients = [ make_client(fid)[0] for fid in [1, 2, 3] ]
+    for c in clients:
+        send_client(channel, c)
+    assert [ recv_client(worker_channel).fid for _ in clients ] == [1, 2, 3]
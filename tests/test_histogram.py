@@ -0,0 +1,46 @@
+import pytest
+
+from histogram import Histogram, SUB_BUCKET_BITS
+
+def test_histogram_index_round_trip():
+    h = Histogram()
+    # The small values are exact.
+    for v in range(1 << SUB_BUCKET_BITS):
+        assert h._get_value(h._get_index(v)) == v
+    # The lowest value of each bucket maps back to the bucket, and the
+    # buckets are in order.
+    last = -1
+    for i in range(h._get_index(10 ** 9)):
+        v = h._get_value(i)
+        assert v > last
+        assert h._get_index(v) == i
+        last = v
+
+def test_histogram_relative_error():
+    h = Histogram()
+    v = 1
+    while v < 10 ** 9:
+        low = h._get_value(h._get_index(v))
+        assert low <= v
+        assert (v - low) / v < 2 / (1 << SUB_BUCKET_BITS)
+        v = v * 3 // 2 + 1
+
+def test_histogram_percentile():
+    h = Histogram()
+    for ms in range(1, 101):
+        h.record(ms / 1000)
+    assert h.total == 100
+    assert h.mean() == pytest.approx(0.0505)
+    assert h.percentile(50) == pytest.approx(0.050, rel=0.02)
+    assert h.percentile(99) == pytest.approx(0.099, rel=0.02)
+    assert h.percentile(100) == pytest.approx(0.100, rel=0.02)
+
+def test_histogram_merge():
+    a, b = Histogram(), Histogram()
+    a.record(0.001)
+    b.record(0.002)
+    b.record(0.5)
+    a.merge(b.to_dict())
+    assert a.total == 3
+    assert a.max == 500000
+    assert a.percentile(100) == pytest.approx(0.5, rel=0.02)
@@ -0,0 +1,88 @@
+import socket
+import threading
+
+import pytest
+
+from client import ClientSocket, ClientSocketError
+from multigame import GameMux, GameChannel
+
+def make_mux():
+    engine_sock, server_sock = socket.socketpair()
+    engine_sock.settimeout(2)
+    c = ClientSocket()
+    c.sock = server_sock
+    c.fid = 1
+    c.name = "multi"
+    c.slots = 2
+    c.crash = False
+    return GameMux(c), engine_sock, engine_sock.makefile("rw", encoding="utf-8")
+
+def genmove_in_thread(channel, color, replies):
+    # Wait for the reply of one game in the thread like the worker.
+    def run():
+        try:
+            replies[channel.gid] = channel.request_genmove(color, 1000)
+        except ClientSocketError as e:
+            replies[channel.gid] = e
+    t = threading.Thread(target=run, daemon=True)
+    t.start()
+    return t
+
+def read_commands(engine, n):
+    return sorted([ engine.readline().strip() for _ in range(n) ])
+
+def test_replies_are_routed_by_gid():
+    mux, engine_sock, engine = make_mux()
+    channels = [ GameChannel(mux, gid) for gid in [3, 12] ]
+    for ch in channels:
+        ch.create_sockfile()
+
+    replies = dict()
+    threads = [ genmove_in_thread(ch, c, replies) for ch, c in zip(channels, ["b", "w"]) ]
+    assert read_commands(engine, 2) == ["genmove 12 w 1000", "genmove 3 b 1000"]
+
+    # The replies come back in any order.
+    engine.write("12 Q16\n3 D4\n")
+    engine.flush()
+    for t in threads:
+        t.join(2)
+    assert replies == { 3 : "D4", 12 : "Q16" }
+    assert not mux.client.crash
+
+def test_stale_lines_are_dropped():
+    mux, engine_sock, engine = make_mux()
+    ch = GameChannel(mux, 5)
+    ch.create_sockfile()
+    mux.client.stale_lines = 1
+
+    replies = dict()
+    t = genmove_in_thread(ch, "b", replies)
+    assert engine.readline().strip() == "genmove 5 b 1000"
+    # The late heartbeat reply comes first.
+    engine.write("multi\n5 pass\n")
+    engine.flush()
+    t.join(2)
+    assert replies == { 5 : "pass" }
+    assert mux.client.stale_lines == 0
+
+@pytest.mark.parametrize("reply", ["D4\n", None])
+def test_broken_connection_fails_all_games(reply):
+    mux, engine_sock, engine = make_mux()
+    channels = [ GameChannel(mux, gid) for gid in [1, 2] ]
+    for ch in channels:
+        ch.create_sockfile()
+
+    replies = dict()
+    threads = [ genmove_in_thread(ch, "b", replies) for ch in channels ]
+    read_commands(engine, 2)
+    if reply is None:
+        engine.close()
+        engine_sock.close()
+    else:
+        # The reply without the game id.
+        engine.write(reply)
+        engine.flush()
+    for t in threads:
+        t.join(2)
+    assert all([ isinstance(replies[gid], ClientSocketError) for gid in [1, 2] ])
+    assert mux.client.crash
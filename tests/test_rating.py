@@ -0,0 +1,66 @@
+import math
+
+import pytest
+
+from rating import RatingBook, glicko_g, glicko_expect
+
+# The known values are computed by hand from the Glicko paper and the
+# formulas in 'rating.py'.
+
+def make_book(prior_games=0):
+    return RatingBook("rating.json", 1500, 350, 30, 10, prior_games)
+
+def test_glicko_functions():
+    # The values in the example of the Glicko paper.
+    assert glicko_g(30) == pytest.approx(0.9955, abs=1e-4)
+    assert glicko_g(100) == pytest.approx(0.9531, abs=1e-4)
+    assert glicko_g(300) == pytest.approx(0.7242, abs=1e-4)
+    assert glicko_expect(1500, 1400, 30) == pytest.approx(0.639, abs=1e-3)
+    assert glicko_expect(1500, 1550, 100) == pytest.approx(0.432, abs=1e-3)
+    assert glicko_expect(1500, 1700, 300) == pytest.approx(0.303, abs=1e-3)
+
+def test_glicko_update():
+    # The player of 1500 and RD 200 beats the player of 1400 and RD 30.
+    book = make_book()
+    book.players["a"] = { "rating" : 1500, "rd" : 200, "games" : 0, "last" : 0 }
+    book.players["b"] = { "rating" : 1400, "rd" : 30, "games" : 0, "last" : 0 }
+    assert book.add_game("a", "b", "B+Resign", "resign", 0)
+    assert book.players["a"]["rating"] == pytest.approx(1563.432, abs=1e-3)
+    assert book.players["a"]["rd"] == pytest.approx(175.220, abs=1e-3)
+    assert book.players["b"]["rating"] < 1400
+    assert book.get_pair("a", "b") == [1, 0, 0]
+    assert book.get_pair("b", "a") == [0, 0, 1]
+
+def test_unrated_games():
+    book = make_book()
+    assert not book.add_game("a", "b", "0", "socket error", 0)
+    assert not book.add_game("a", "a", "B+Resign", "resign", 0)
+    assert book.games == 0
+
+def test_batch_rating_two_engines():
+    # 'a' wins 3 of 4 games, so its gamma is 3 times of 'b' and the
+    # difference is 400 * log10(3).
+    book = make_book()
+    for result in ["B+Resign", "B+Resign", "B+Resign", "W+Resign"]:
+        book.add_game("a", "b", result, "resign", 0)
+    book.recompute()
+    assert book.batch["a"] - book.batch["b"] == pytest.approx(400 * math.log10(3), abs=1e-3)
+    assert (book.batch["a"] + book.batch["b"]) / 2 == pytest.approx(1500)
+
+def test_batch_rating_draws():
+    # One draw is half win and half loss. 2 wins and 2 draws are the
+    # same as 3 wins and 1 loss.
+    book = make_book()
+    for result in ["B+Resign", "B+Resign", "0", "0"]:
+        book.add_game("a", "b", result, "resign", 0)
+    book.recompute()
+    assert book.batch["a"] - book.batch["b"] == pytest.approx(400 * math.log10(3), abs=1e-3)
+
+def test_batch_rating_prior():
+    # The prior games pull the unbeaten engine back to a finite rating.
+    book = make_book(prior_games=2)
+    book.add_game("a", "b", "B+Resign", "resign", 0)
+    book.recompute()
+    assert math.isfinite(book.batch["a"])
+    assert book.batch["a"] > book.batch["b"]
+    assert book.batch["a"] - book.batch["b"] < 400
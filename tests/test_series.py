@@ -0,0 +1,56 @@
+from series import MatchSeries
+
+def make_series(games, concurrency=1):
+    a = { "fid" : None, "name" : "a" }
+    b = { "fid" : None, "name" : "b" }
+    return MatchSeries(0, a, b, games, dict(), concurrency=concurrency)
+
+def submit(series):
+    # Return the submitted game indices.
+    indices = list()
+    for index, _, _, _ in series.next_games():
+        series.set_match_id(index, 100 + index)
+        indices.append(index)
+    return indices
+
+def test_broken_game_is_played_again():
+    series = make_series(4, concurrency=2)
+    assert submit(series) == [0, 1]
+    series.add_result(0, "0", "socket error", 10)
+    series.add_result(1, "W+Resign", "resign", 80)
+
+    # The broken game is not a draw. It is played again first.
+    assert series.finished() == 1
+    assert series.draws == 0
+    assert series.wins == 1
+    assert series.result_types == { "resign" : 1 }
+    assert submit(series) == [0, 2]
+
+def test_lost_game_is_played_again():
+    series = make_series(2)
+    assert submit(series) == [0]
+    # The match is gone without result, like an expired match.
+    series.lose(0)
+    assert submit(series) == [0]
+    series.add_result(0, "B+Resign", "resign", 100)
+    assert submit(series) == [1]
+
+def test_stopped_series_does_not_requeue():
+    series = make_series(4, concurrency=2)
+    assert submit(series) == [0, 1]
+    series.stop("stopped by command")
+    series.add_result(0, "0", "socket error", 10)
+    assert submit(series) == list()
+    assert not series.done()
+    series.add_result(1, "B+Resign", "resign", 100)
+    assert series.done()
+    assert series.finished() == 1
+
+def test_late_result_is_ignored():
+    series = make_series(2)
+    assert submit(series) == [0]
+    series.lose(0)
+    # The result of the requeued game comes back after all.
+    series.add_result(0, "B+Resign", "resign", 100)
+    assert series.finished() == 0
+    assert submit(series) == [0]
@@ -0,0 +1,127 @@
+import collections
+import json
+import logging
+import os
+
+import config
+from master import MasterSocket
+from series import MatchSeries
+from sprt import Sprt
+
+class Engine:
+    def __init__(self, name):
+        self.name = name
+        self.type = "engine"
+
+class Master:
+    # Borrow the snapshot methods. The real master binds the ports
+    # and starts the workers.
+    submit_match = MasterSocket.submit_match
+    cancel_match = MasterSocket.cancel_match
+    create_series = MasterSocket.create_series
+    stop_series = MasterSocket.stop_series
+    handle_series = MasterSocket.handle_series
+    get_match_record = MasterSocket.get_match_record
+    get_interrupted_record = MasterSocket.get_interrupted_record
+    get_snapshot_command = MasterSocket.get_snapshot_command
+    get_snapshot_names = MasterSocket.get_snapshot_names
+    save_snapshot = MasterSocket.save_snapshot
+    restore_snapshot = MasterSocket.restore_snapshot
+    restore_series = MasterSocket.restore_series
+
+    def __init__(self, root, engines):
+        self.logger = logging.getLogger("test.Master")
+        self.client_pool = { fid : { "socket" : Engine(name) } for fid, name in engines.items() }
+        self.game_tasks = dict()
+        self.pending_matches = collections.deque()
+        self.series_pool = dict()
+        self.next_series_id = 0
+        self.next_match_id = 0
+        self.last_game_id = 0
+        self.sgf_root = os.path.join(root, "sgf")
+        self.snapshot_path = os.path.join(root, "snapshot.json")
+        self.last_snapshot = None
+
+def test_snapshot_command_by_name(tmp_path):
+    m = Master(str(tmp_path), { 3 : "leela", 4 : "kata", 5 : "123" })
+    assert m.get_snapshot_command("match fid 3 4 bsize 9") == "match pool leela kata bsize 9"
+    assert m.get_snapshot_command("match fid 3 gnugo") == "match pool leela gnugo"
+    assert m.get_snapshot_command("series 3 4 100 mtime 60") == "series leela kata 100 mtime 60"
+    assert m.get_snapshot_command("series stop 3") == "series stop 3"
+    assert m.get_snapshot_command("match pool a b") == "match pool a b"
+
+    # The closed engine and the name which looks like a fid can not
+    # be kept.
+    assert m.get_snapshot_command("match fid 3 9") is None
+    assert m.get_snapshot_command("series 3 5 100") is None
+    assert m.get_snapshot_command("close 3") is None
+
+def test_series_state():
+    sprt = Sprt(0, 5, 0.05, 0.05, "pentanomial")
+    a = { "fid" : None, "name" : "a" }
+    b = { "fid" : None, "name" : "b" }
+    series = MatchSeries(0, a, b, 10, dict(), concurrency=3, sprt=sprt)
+    for index, _, _, _ in series.next_games():
+        series.set_match_id(index, index)
+    series.add_result(0, "B+Resign", "resign", 120)
+    series.add_result(1, "B+3.5", "score", 200)
+    series.lose(2)
+
+    state = json.loads(json.dumps(series.get_state()))
+    restored = MatchSeries(0, dict(a), dict(b), 10, dict(), concurrency=3,
+                           sprt=Sprt(0, 5, 0.05, 0.05, "pentanomial"))
+    restored.set_state(state)
+    assert restored.get_record() == series.get_record()
+    assert restored.sprt.pairs == series.sprt.pairs
+    assert [ g[0] for g in restored.next_games() ] == [ g[0] for g in series.next_games() ]
+
+def test_snapshot_restores_series(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SNAPSHOT_INTERVAL", 1)
+    m = Master(str(tmp_path), { 1 : "leela", 2 : "kata" })
+    series_id = m.create_series(
+                    { "fid" : 1, "name" : None }, { "fid" : 2, "name" : None }, 6, dict(),
+                    concurrency=2, sprt={ "elo0" : 0, "elo1" : 5 })
+    m.handle_series()
+    assert len(m.pending_matches) == 2
+
+    # The first game is over and the second one waits.
+    first = m.pending_matches.popleft()
+    m.series_pool[series_id].add_result(first["series"][1], "W+Resign", "resign", 80)
+    m.save_snapshot(["match fid 1 2", "close 1"])
+
+    n = Master(str(tmp_path), dict())
+    commands = list()
+    n.restore_snapshot(commands)
+    assert commands == ["match pool leela kata"]
+    assert n.next_series_id == 1
+
+    # The fids are invalid after restart.
+    series = n.series_pool[series_id]
+    assert [ p["fid"] for p in series.players ] == [None, None]
+    assert [ p["name"] for p in series.players ] == ["leela", "kata"]
+    for p in m.series_pool[series_id].players:
+        p["fid"] = None
+    assert series.get_record() == m.series_pool[series_id].get_record()
+
+    # The waiting game is linked again. The series goes on with the
+    # next one.
+    pending = list(n.pending_matches)
+    assert len(pending) == 1
+    assert pending[0]["series"] == [series_id, 1]
+    assert series.inflight == { 1 : pending[0]["match_id"] }
+    n.handle_series()
+    assert [ m["series"] for m in n.pending_matches ] == [[series_id, 1], [series_id, 2]]
+
+def test_snapshot_requeues_lost_series_games(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "SNAPSHOT_INTERVAL", 1)
+    m = Master(str(tmp_path), { 1 : "leela", 2 : "kata" })
+    series_id = m.create_series({ "fid" : 1, "name" : None }, { "fid" : 2, "name" : None }, 4, dict())
+    m.handle_series()
+    # The match is not in the snapshot, so the game is played again.
+    m.pending_matches.clear()
+    m.save_snapshot(list())
+
+    n = Master(str(tmp_path), dict())
+    n.restore_snapshot(list())
+    n.handle_series()
+    assert [ m["series"] for m in n.pending_matches ] == [[series_id, 0]]
@@ -0,0 +1,55 @@
+import math
+
+import pytest
+
+from sprt import Sprt, elo_to_score, get_bounds, get_llr, TRINOMIAL_SCORES, PENTANOMIAL_SCORES
+
+# The known values are computed by hand from the formulas in 'sprt.py'.
+
+def test_sprt_bounds():
+    lower, upper = get_bounds(0.05, 0.05)
+    assert lower == pytest.approx(-math.log(19))
+    assert upper == pytest.approx(math.log(19))
+
+def test_sprt_elo_to_score():
+    assert elo_to_score(0) == 0.5
+    assert elo_to_score(5) == pytest.approx(0.5071950817)
+    assert elo_to_score(400) == pytest.approx(10 / 11)
+
+def test_sprt_trinomial_llr():
+    # 10 losses, 20 draws and 30 wins. The mean is 2/3 and the
+    # variance is 5/36.
+    assert get_llr(TRINOMIAL_SCORES, [10, 20, 30], 0, 5) == pytest.approx(0.5068637357)
+    # The mirrored samples give the opposite sign with the mirrored
+    # hypotheses.
+    assert get_llr(TRINOMIAL_SCORES, [30, 20, 10], -5, 0) == pytest.approx(-0.5068637357)
+
+def test_sprt_no_information():
+    assert get_llr(TRINOMIAL_SCORES, [0, 0, 0], 0, 5) == 0.0
+    assert get_llr(TRINOMIAL_SCORES, [0, 7, 0], 0, 5) == 0.0
+    # The mean is exactly between s0 and s1 of symmetric hypotheses.
+    assert get_llr(PENTANOMIAL_SCORES, [1, 2, 3, 2, 1], -5, 5) == pytest.approx(0.0)
+
+def test_sprt_pentanomial_buckets():
+    s = Sprt(0, 5, 0.05, 0.05, "pentanomial")
+    s.add(0, 1)
+    s.add(1, 0.5) # pair score 0.75
+    s.add(3, 0) # the second game finishes first
+    s.add(2, 0) # pair score 0
+    s.add(4, 1)
+    s.add(5, 1) # pair score 1
+    s.add(6, 0.5) # no pair yet
+    assert s.pentanomial == [1, 0, 0, 1, 1]
+    assert s.trinomial == [2, 2, 3]
+    assert s.pairs == { 3 : 0.5 }
+
+def test_sprt_result():
+    s = Sprt(0, 5, 0.05, 0.05, "trinomial")
+    for i in range(2000):
+        s.add(i, [1, 1, 0.5, 0][i % 4])
+    assert s.get_llr() > s.upper
+    assert s.get_result() == "H1"
+    s = Sprt(0, 5, 0.05, 0.05, "trinomial")
+    for i in range(2000):
+        s.add(i, [0, 0, 0.5, 1][i % 4])
+    assert s.get_result() == "H0"
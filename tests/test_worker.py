@@ -0,0 +1,55 @@
+import multiprocessing as mp
+import os
+import signal
+import time
+
+from handoff import create_channel
+from match import match_loop
+
+# The worker must not outlive the master. An orphaned worker holds the
+# engine connections, so the engines could not connect to the restarted
+# server.
+
+def is_running(pid):
+    # The orphaned worker is reaped by init. Count a zombie as exited
+    # in case nobody reaps it here.
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            state = f.read().rsplit(")", 1)[1].split()[0]
+    except FileNotFoundError:
+        return False
+    return state != "Z"
+
+def fake_master(conn):
+    # Start one worker like the master does, then wait to be killed.
+    ctx = mp.get_context("fork")
+    _, worker_channel = create_channel()
+    p = ctx.Process(
+            target=match_loop,
+            args=(0, ctx.Queue(), ctx.Queue(), ctx.Queue(), worker_channel, ctx.Queue(), list(), ),
+            daemon=True
+        )
+    p.start()
+    conn.send(p.pid)
+    time.sleep(60)
+
+def test_worker_quits_after_master_is_killed():
+    ctx = mp.get_context("fork")
+    conn, child_conn = ctx.Pipe()
+    master = ctx.Process(target=fake_master, args=(child_conn, ))
+    master.start()
+    worker_pid = conn.recv()
+    try:
+        time.sleep(0.5)
+        assert is_running(worker_pid)
+
+        os.kill(master.pid, signal.SIGKILL)
+        master.join()
+
+        deadline = time.time() + 5
+        while is_running(worker_pid) and time.time() < deadline:
+            time.sleep(0.05)
+        assert not is_running(worker_pid)
+    finally:
+        if is_running(worker_pid):
+            os.kill(worker_pid, signal.SIGKILL)